@@ -25,6 +25,9 @@ python3 scripts/build_deltas.py
 # 3. Сбор признаков (Features)
 python3 scripts/build_features.py
 
+# 3a. Агрегаты 1 мин / 15 мин / 1 ч (Rollups)
+python3 scripts/build_rollups.py
+
 # 4. Сбор лексических признаков (Текст запросов)
 python3 scripts/build_lex_features.py
 # 5. Вычисляет аномалии и шлет алерты
@@ -0,0 +1,121 @@
+"""Benchmark deltas_for_window against the NumPy delta engine."""
+
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+try:
+    from build_deltas import (
+        COUNTER_COLUMNS,
+        deltas_for_window,
+        deltas_for_window_np,
+        delta_rows,
+        snapshot_array,
+    )
+except Exception:
+    from scripts.build_deltas import (
+        COUNTER_COLUMNS,
+        deltas_for_window,
+        deltas_for_window_np,
+        delta_rows,
+        snapshot_array,
+    )
+
+SIZES = [10_000, 50_000, 200_000]
+REPEATS = 3
+
+
+def make_snapshots(n, seed=0):
+    """Return (prev_rows, curr_rows) tuples with ~30% changed and 1% new keys."""
+    rng = np.random.default_rng(seed)
+    dbid = rng.integers(1, 8, n)
+    userid = rng.integers(10, 40, n)
+    queryid = rng.integers(-(2**62), 2**62, n)
+    calls = rng.integers(1, 10_000, n)
+    exec_time = rng.random(n) * 1e5
+    other = rng.integers(0, 1_000_000, (6, n))
+
+    prev = list(
+        zip(
+            dbid.tolist(),
+            userid.tolist(),
+            queryid.tolist(),
+            calls.tolist(),
+            exec_time.tolist(),
+            *other.tolist(),
+        )
+    )
+
+    changed = rng.random(n) < 0.3
+    calls = calls + changed * rng.integers(1, 50, n)
+    exec_time = exec_time + changed * rng.random(n) * 100
+    other = other + changed * rng.integers(0, 100, (6, n))
+    # A few counter resets that must be skipped.
+    reset = rng.random(n) < 0.001
+    calls = np.where(reset, 0, calls)
+    queryid = np.where(rng.random(n) < 0.01, rng.integers(-(2**62), 2**62, n), queryid)
+
+    curr = list(
+        zip(
+            dbid.tolist(),
+            userid.tolist(),
+            queryid.tolist(),
+            calls.tolist(),
+            exec_time.tolist(),
+            *other.tolist(),
+        )
+    )
+    return prev, curr
+
+
+def as_snapshot(rows):
+    """Convert tuples to the dict form returned by load_snapshot."""
+    names = ["dbid", "userid", "queryid"] + COUNTER_COLUMNS
+    return {(r[0], r[1], r[2]): dict(zip(names, r)) for r in rows}
+
+
+def best_of(fn):
+    """Return (best seconds, last result) over REPEATS runs."""
+    best = None
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench(n):
+    """Time both engines for one window of n keys and check they agree."""
+    prev_rows, curr_rows = make_snapshots(n)
+    ws = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    we = ws + timedelta(seconds=15)
+
+    prev_snap, curr_snap = as_snapshot(prev_rows), as_snapshot(curr_rows)
+    t_py, py = best_of(lambda: deltas_for_window(prev_snap, curr_snap, ws, we))
+
+    ts = np.datetime64("2024-01-01T00:00:00", "us")
+    prev_arr, curr_arr = snapshot_array(prev_rows, ts), snapshot_array(curr_rows, ts)
+
+    def run_np():
+        rows, deltas = deltas_for_window_np(prev_arr, curr_arr)
+        return delta_rows(ws, we, "local", rows, deltas)
+
+    t_np, fast = best_of(run_np)
+
+    expected = sorted(tuple(d.values()) for d in py)
+    if expected != sorted(fast):
+        raise AssertionError(f"engines disagree at {n} keys")
+
+    print(
+        f"{n:>8} keys: python {t_py * 1000:8.1f} ms, numpy {t_np * 1000:8.1f} ms, "
+        f"speedup x{t_py / t_np:5.1f}, {len(py)} deltas"
+    )
+
+
+if __name__ == "__main__":
+    sizes = [int(a) for a in sys.argv[1:]] or SIZES
+    for n in sizes:
+        bench(n)
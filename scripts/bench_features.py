@@ -0,0 +1,102 @@
+"""Benchmark compute_features against compute_features_batch."""
+
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+try:
+    from build_features import (
+        FEATURE_COLUMNS,
+        compute_features,
+        compute_features_batch,
+    )
+except Exception:
+    from scripts.build_features import (
+        FEATURE_COLUMNS,
+        compute_features,
+        compute_features_batch,
+    )
+
+SIZES = [10_000, 100_000, 1_000_000]
+REPEATS = 3
+
+
+def make_deltas(n, windows=20, seed=0):
+    """Return n delta rows spread over a few windows, with edge cases."""
+    rng = np.random.default_rng(seed)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    bounds = [
+        (start + timedelta(seconds=15 * i), start + timedelta(seconds=15 * (i + 1)))
+        for i in range(windows)
+    ]
+    # Zero-length window: window_len_sec falls back to 1.
+    bounds[0] = (bounds[0][0], bounds[0][0])
+
+    w = rng.integers(0, windows, n).tolist()
+    calls = rng.integers(0, 1000, n).tolist()
+    exec_ms = (rng.random(n) * 1e4).tolist()
+    ints = rng.integers(0, 3, (6, n)) * rng.integers(0, 100_000, (6, n))
+    rows, hit, read, temp_read, temp_written, wal = ints.tolist()
+
+    return [
+        {
+            "window_start": bounds[w[i]][0],
+            "window_end": bounds[w[i]][1],
+            "instance_id": "local",
+            "dbid": 5,
+            "userid": 10,
+            "queryid": i,
+            "calls_delta": calls[i],
+            "total_exec_time_delta": exec_ms[i],
+            "rows_delta": rows[i],
+            "shared_blks_hit_delta": hit[i],
+            "shared_blks_read_delta": read[i],
+            "temp_blks_read_delta": temp_read[i],
+            "temp_blks_written_delta": temp_written[i],
+            "wal_bytes_delta": wal[i],
+        }
+        for i in range(n)
+    ]
+
+
+def best_of(fn):
+    """Return (best seconds, last result) over REPEATS runs."""
+    best = None
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench(n):
+    """Time both implementations on n deltas and check they agree exactly."""
+    deltas = make_deltas(n)
+
+    def run_rows():
+        out = []
+        for r in deltas:
+            f = compute_features(r)
+            if f is not None:
+                out.append(tuple(f[c] for c in FEATURE_COLUMNS))
+        return out
+
+    t_rows, expected = best_of(run_rows)
+    t_batch, got = best_of(lambda: compute_features_batch(deltas))
+
+    if expected != got:
+        raise AssertionError(f"compute_features_batch differs at {n} rows")
+
+    print(
+        f"{n:>8} deltas: per-row {t_rows * 1000:8.1f} ms, "
+        f"batch {t_batch * 1000:8.1f} ms, speedup x{t_rows / t_batch:5.1f}"
+    )
+
+
+if __name__ == "__main__":
+    sizes = [int(a) for a in sys.argv[1:]] or SIZES
+    for n in sizes:
+        bench(n)
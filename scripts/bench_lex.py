@@ -0,0 +1,72 @@
+"""Benchmark compute_lex_features on large ORM-style queries.
+
+Parity with the multi-pass reference is checked in
+tests/test_build_lex_features.py.
+"""
+
+import sys
+import time
+
+import numpy as np
+
+try:
+    from build_lex_features import compute_lex_features
+except Exception:
+    from scripts.build_lex_features import compute_lex_features
+
+SIZES = [1_000, 50_000, 200_000]
+REPEATS = 3
+
+
+def make_orm_query(size, seed=0):
+    """Return an ORM-style query text of roughly size characters."""
+    rng = np.random.default_rng(seed)
+    columns = ", ".join(
+        f'"t{i % 5}"."col_{i}" AS "t{i % 5}__col_{i}"' for i in range(200)
+    )
+    parts = [
+        "WITH recent AS (SELECT id FROM base WHERE created_at > $1) "
+        f"SELECT {columns} FROM t0"
+    ]
+    length = len(parts[0])
+    i = 0
+    while length < size:
+        i += 1
+        t = f"t{i % 5}"
+        part = (
+            f" LEFT OUTER JOIN {t} ON ({t}.id = t0.{t}_id AND "
+            f"COALESCE({t}.name, 'n/a''x') = lower($2)) AND EXISTS "
+            f"(SELECT 1 FROM z WHERE z.a = {i}.5 /* hint */ AND "
+            f"CASE WHEN z.b > {i} THEN 1 ELSE 0 END = 1) -- ref {i}\n"
+        )
+        parts.append(part)
+        length += len(part)
+    ids = ",".join(str(v) for v in rng.integers(1, 10**6, 300).tolist())
+    parts.append(
+        f" WHERE t0.id IN ({ids}) GROUP BY 1, 2 ORDER BY 3 DESC LIMIT 10 OFFSET 20"
+    )
+    return "".join(parts)
+
+
+def best_of(fn):
+    """Return best seconds over REPEATS runs."""
+    best = None
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench(size):
+    """Time compute_lex_features on one query of about size characters."""
+    q = make_orm_query(size)
+    elapsed = best_of(lambda: compute_lex_features(q))
+    print(f"{len(q):>8} chars: {elapsed * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    sizes = [int(a) for a in sys.argv[1:]] or SIZES
+    for size in sizes:
+        bench(size)
@@ -5,6 +5,7 @@ import os
 import sys
 import subprocess
 import psycopg
+from psycopg.rows import dict_row
 
 try:
     from detector_alerts import send_telegram
@@ -24,12 +25,18 @@ except Exception:
     print("❌ Не найден db_config.py / DB_CONFIG")
     sys.exit(1)
 
+from scripts.build_lex_features import classify_stored_keys
+
 S_COLLECT = os.path.join(BASE_DIR, "collector.py")
 S_DELTAS = os.path.join(BASE_DIR, "build_deltas.py")
 S_FEATURES = os.path.join(BASE_DIR, "build_features.py")
+S_ROLLUPS = os.path.join(BASE_DIR, "build_rollups.py")
 S_LEX = os.path.join(BASE_DIR, "build_lex_features.py")
 S_TRAIN = os.path.join(BASE_DIR, "train_model.py")
 S_DETECT = os.path.join(BASE_DIR, "detect_anomalies.py")
+S_DETECTOR = os.path.join(BASE_DIR, "detector_daemon.py")
+S_PARTITIONS = os.path.join(BASE_DIR, "maintain_partitions.py")
+S_STREAM = os.path.join(BASE_DIR, "stream_pipeline.py")
 
 COLLECT_INTERVAL = int(os.getenv("COLLECT_INTERVAL", "15"))
 RETRAIN_INTERVAL = int(os.getenv("RETRAIN_INTERVAL", str(24 * 60 * 60)))
@@ -38,6 +45,24 @@ TRAIN_COLLECT_ITERATIONS = int(os.getenv("TRAIN_COLLECT_ITERATIONS", "40"))
 TRAIN_COLLECT_SLEEP = int(os.getenv("TRAIN_COLLECT_SLEEP", "10"))
 TRAIN_RETRY_LIMIT = int(os.getenv("TRAIN_RETRY_LIMIT", "10"))
 
+MONITORING_PARTITIONED = os.getenv("MONITORING_PARTITIONED", "0").strip().lower() in (
+    "1",
+    "true",
+)
+
+# batch: run stage scripts every COLLECT_INTERVAL; stream: keep stream_pipeline.py running.
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "batch").strip().lower()
+
+# batch: keep detector_daemon.py running instead of starting detect_anomalies.py each cycle.
+DETECTOR_DAEMON = os.getenv("DETECTOR_DAEMON", "1").strip().lower() in ("1", "true")
+
+# build_deltas also writes features_windows; the features stage is skipped.
+FEATURES_FUSED = os.getenv("FEATURES_FUSED", "0").strip().lower() in ("1", "true")
+
+PARTITION_MAINTENANCE_INTERVAL = int(
+    os.getenv("PARTITION_MAINTENANCE_INTERVAL", "3600")
+)
+
 MODEL_FILE = os.getenv("MODEL_FILE", "model_baseline_v1.pkl")
 MODEL_VERSION = os.getenv("MODEL_VERSION", "baseline_v1")
 
@@ -49,6 +74,7 @@ CREATE EXTENSION IF NOT EXISTS pg_stat_statements;
 CREATE TABLE IF NOT EXISTS monitoring.pgss_snapshots_raw (
     snapshot_id       bigserial PRIMARY KEY,
     snapshot_ts       timestamptz NOT NULL,
+    instance_id       text        NOT NULL DEFAULT 'local',
     dbid              oid         NOT NULL,
     userid            oid         NOT NULL,
     queryid           bigint      NOT NULL,
@@ -60,15 +86,58 @@ CREATE TABLE IF NOT EXISTS monitoring.pgss_snapshots_raw (
     temp_blks_read    bigint      NOT NULL,
     temp_blks_written bigint      NOT NULL,
     wal_bytes         bigint      NOT NULL,
-    query_text        text        NULL
+    query_text        text        NULL,
+    text_md5          text        NULL
 );
 
+ALTER TABLE monitoring.pgss_snapshots_raw
+    ADD COLUMN IF NOT EXISTS text_md5 text NULL;
+
 CREATE INDEX IF NOT EXISTS idx_pgss_snapshots_raw_ts_qid
     ON monitoring.pgss_snapshots_raw (snapshot_ts, dbid, userid, queryid);
 
+CREATE TABLE IF NOT EXISTS monitoring.query_texts (
+    queryid       bigint      NOT NULL,
+    text_md5      text        NOT NULL,
+    query_text    text        NOT NULL,
+    first_seen_ts timestamptz NOT NULL DEFAULT now(),
+
+    PRIMARY KEY (queryid, text_md5)
+);
+
+CREATE TABLE IF NOT EXISTS monitoring.pgss_last_calls (
+    instance_id text        NOT NULL,
+    dbid        oid         NOT NULL,
+    userid      oid         NOT NULL,
+    queryid     bigint      NOT NULL,
+    calls       bigint      NOT NULL,
+    snapshot_ts timestamptz NOT NULL,
+
+    PRIMARY KEY (instance_id, dbid, userid, queryid)
+);
+
+CREATE TABLE IF NOT EXISTS monitoring.pgss_delta_carry (
+    instance_id       text        NOT NULL,
+    dbid              oid         NOT NULL,
+    userid            oid         NOT NULL,
+    queryid           bigint      NOT NULL,
+    calls             bigint      NOT NULL,
+    total_exec_time   double precision NOT NULL,
+    rows              bigint      NOT NULL,
+    shared_blks_hit   bigint      NOT NULL,
+    shared_blks_read  bigint      NOT NULL,
+    temp_blks_read    bigint      NOT NULL,
+    temp_blks_written bigint      NOT NULL,
+    wal_bytes         bigint      NOT NULL,
+    snapshot_ts       timestamptz NOT NULL,
+
+    PRIMARY KEY (instance_id, dbid, userid, queryid)
+);
+
 CREATE TABLE IF NOT EXISTS monitoring.pgss_deltas (
     window_start              timestamptz NOT NULL,
     window_end                timestamptz NOT NULL,
+    instance_id               text        NOT NULL DEFAULT 'local',
     dbid                      oid         NOT NULL,
     userid                    oid         NOT NULL,
     queryid                   bigint      NOT NULL,
@@ -82,15 +151,19 @@ CREATE TABLE IF NOT EXISTS monitoring.pgss_deltas (
     temp_blks_written_delta   bigint      NOT NULL,
     wal_bytes_delta           bigint      NOT NULL,
 
-    PRIMARY KEY (window_start, dbid, userid, queryid)
+    PRIMARY KEY (window_start, instance_id, dbid, userid, queryid)
 );
 
 CREATE INDEX IF NOT EXISTS idx_pgss_deltas_qid_ts
     ON monitoring.pgss_deltas (dbid, userid, queryid, window_start);
 
+CREATE INDEX IF NOT EXISTS idx_pgss_deltas_instance_end
+    ON monitoring.pgss_deltas (instance_id, window_end);
+
 CREATE TABLE IF NOT EXISTS monitoring.features_windows (
     window_start           timestamptz NOT NULL,
     window_end             timestamptz NOT NULL,
+    instance_id            text        NOT NULL DEFAULT 'local',
     dbid                   oid         NOT NULL,
     userid                 oid         NOT NULL,
     queryid                bigint      NOT NULL,
@@ -121,21 +194,81 @@ CREATE TABLE IF NOT EXISTS monitoring.features_windows (
     ms_per_row             double precision,
     read_blks_per_row      double precision,
 
-    PRIMARY KEY (window_start, dbid, userid, queryid)
+    exec_time_per_call_ms_z double precision,
+    rows_per_call_z         double precision,
+    shared_read_per_call_z  double precision,
+    wal_bytes_per_call_z    double precision,
+
+    PRIMARY KEY (window_start, instance_id, dbid, userid, queryid)
 );
 
 CREATE INDEX IF NOT EXISTS idx_features_qid_ts
     ON monitoring.features_windows (dbid, userid, queryid, window_start);
 
-CREATE TABLE IF NOT EXISTS monitoring.query_lex_features (
-    dbid oid NOT NULL,
-    userid oid NOT NULL,
-    queryid bigint NOT NULL,
+CREATE INDEX IF NOT EXISTS idx_features_windows_end
+    ON monitoring.features_windows (window_end);
 
-    query_text text NOT NULL,
-    query_md5 text NOT NULL,
+-- z-scores against monitoring.query_baselines, NULL while a baseline warms up.
+ALTER TABLE monitoring.features_windows
+    ADD COLUMN IF NOT EXISTS exec_time_per_call_ms_z double precision,
+    ADD COLUMN IF NOT EXISTS rows_per_call_z double precision,
+    ADD COLUMN IF NOT EXISTS shared_read_per_call_z double precision,
+    ADD COLUMN IF NOT EXISTS wal_bytes_per_call_z double precision;
+
+CREATE TABLE IF NOT EXISTS monitoring.pgss_rollup_1m (
+    window_start              timestamptz NOT NULL,
+    window_end                timestamptz NOT NULL,
+    instance_id               text        NOT NULL,
+    dbid                      oid         NOT NULL,
+    userid                    oid         NOT NULL,
+    queryid                   bigint      NOT NULL,
+
+    windows                   bigint      NOT NULL,
+    window_len_sec            double precision NOT NULL,
+
+    calls_delta               bigint      NOT NULL,
+    total_exec_time_delta     double precision NOT NULL,
+    rows_delta                bigint      NOT NULL,
+    shared_blks_hit_delta     bigint      NOT NULL,
+    shared_blks_read_delta    bigint      NOT NULL,
+    temp_blks_read_delta      bigint      NOT NULL,
+    temp_blks_written_delta   bigint      NOT NULL,
+    wal_bytes_delta           bigint      NOT NULL,
+
+    PRIMARY KEY (window_start, instance_id, dbid, userid, queryid)
+);
+
+CREATE TABLE IF NOT EXISTS monitoring.pgss_rollup_15m
+    (LIKE monitoring.pgss_rollup_1m INCLUDING ALL);
+
+CREATE TABLE IF NOT EXISTS monitoring.pgss_rollup_1h
+    (LIKE monitoring.pgss_rollup_1m INCLUDING ALL);
+
+CREATE TABLE IF NOT EXISTS monitoring.query_baselines (
+    instance_id     text        NOT NULL,
+    dbid            oid         NOT NULL,
+    userid          oid         NOT NULL,
+    queryid         bigint      NOT NULL,
+
+    windows         bigint      NOT NULL,
+    last_window_end timestamptz NOT NULL,
+
+    exec_time_per_call_ms_mean double precision NOT NULL,
+    exec_time_per_call_ms_var  double precision NOT NULL,
+    rows_per_call_mean         double precision NOT NULL,
+    rows_per_call_var          double precision NOT NULL,
+    shared_read_per_call_mean  double precision NOT NULL,
+    shared_read_per_call_var   double precision NOT NULL,
+    wal_bytes_per_call_mean    double precision NOT NULL,
+    wal_bytes_per_call_var     double precision NOT NULL,
+
+    PRIMARY KEY (instance_id, dbid, userid, queryid)
+);
+
+-- Lex features once per normalized query shape (query_md5).
+CREATE TABLE IF NOT EXISTS monitoring.query_shapes (
+    query_md5 text PRIMARY KEY,
 
-    query_len_chars int NOT NULL,
     query_len_norm_chars int NOT NULL,
     num_tokens int NOT NULL,
 
@@ -155,30 +288,72 @@ CREATE TABLE IF NOT EXISTS monitoring.query_lex_features (
     num_case int NOT NULL,
     num_functions int NOT NULL,
 
+    first_seen_ts timestamptz NOT NULL DEFAULT now()
+);
+
+-- Key -> shape; query_len_chars depends on the raw text, not the shape.
+CREATE TABLE IF NOT EXISTS monitoring.query_shape_map (
+    instance_id text NOT NULL DEFAULT 'local',
+    dbid oid NOT NULL,
+    userid oid NOT NULL,
+    queryid bigint NOT NULL,
+
+    query_md5 text NOT NULL,
+    query_text text NULL,
+    text_md5 text NULL,
+    query_len_chars int NOT NULL,
+    -- detector_alerts.is_system_query of the raw text; NULL until classified.
+    is_system boolean NULL,
+
     first_seen_ts timestamptz NOT NULL DEFAULT now(),
     last_seen_ts  timestamptz NOT NULL DEFAULT now(),
 
-    PRIMARY KEY (dbid, userid, queryid)
+    PRIMARY KEY (instance_id, dbid, userid, queryid)
 );
 
-CREATE INDEX IF NOT EXISTS idx_query_lex_features_last_seen
-    ON monitoring.query_lex_features (last_seen_ts DESC);
+ALTER TABLE monitoring.query_shape_map
+    ADD COLUMN IF NOT EXISTS is_system boolean NULL;
+
+CREATE INDEX IF NOT EXISTS idx_query_shape_map_last_seen
+    ON monitoring.query_shape_map (last_seen_ts DESC);
 
-CREATE TABLE IF NOT EXISTS monitoring.detector_state (
-    id              smallint PRIMARY KEY DEFAULT 1,
+CREATE INDEX IF NOT EXISTS idx_query_shape_map_text_md5
+    ON monitoring.query_shape_map (text_md5);
+
+-- Keys left for build_lex_features.classify_stored_keys.
+CREATE INDEX IF NOT EXISTS idx_query_shape_map_unclassified
+    ON monitoring.query_shape_map (queryid)
+    WHERE is_system IS NULL;
+
+CREATE TABLE IF NOT EXISTS monitoring.pipeline_watermarks (
+    stage           text        NOT NULL,
+    instance_id     text        NOT NULL,
     last_window_end timestamptz NULL,
-    bad_runs_streak int NOT NULL DEFAULT 0,
+    bad_runs_streak int         NOT NULL DEFAULT 0,
     updated_at      timestamptz NOT NULL DEFAULT now(),
-    CHECK (id = 1)
+
+    PRIMARY KEY (stage, instance_id)
 );
 
-INSERT INTO monitoring.detector_state (id, last_window_end, bad_runs_streak)
-VALUES (1, NULL, 0)
-ON CONFLICT (id) DO NOTHING;
+-- The detector state singleton became the ('detector', '*') watermark.
+DO $$
+BEGIN
+    IF to_regclass('monitoring.detector_state') IS NOT NULL THEN
+        INSERT INTO monitoring.pipeline_watermarks (
+            stage, instance_id, last_window_end, bad_runs_streak
+        )
+        SELECT 'detector', '*', last_window_end, bad_runs_streak
+        FROM monitoring.detector_state
+        WHERE id = 1
+        ON CONFLICT (stage, instance_id) DO NOTHING;
+        DROP TABLE monitoring.detector_state;
+    END IF;
+END $$;
 
 CREATE TABLE IF NOT EXISTS monitoring.anomaly_scores (
     window_start   timestamptz NOT NULL,
     window_end     timestamptz NOT NULL,
+    instance_id    text        NOT NULL DEFAULT 'local',
     dbid           oid         NOT NULL,
     userid         oid         NOT NULL,
     queryid        bigint      NOT NULL,
@@ -189,38 +364,392 @@ CREATE TABLE IF NOT EXISTS monitoring.anomaly_scores (
     features       jsonb       NOT NULL,
     scored_at      timestamptz NOT NULL DEFAULT now(),
 
-    PRIMARY KEY (model_version, window_end, dbid, userid, queryid)
+    PRIMARY KEY (model_version, window_end, instance_id, dbid, userid, queryid)
 );
 
 CREATE INDEX IF NOT EXISTS idx_anomaly_scores_ts
     ON monitoring.anomaly_scores (window_end DESC);
 
+-- Upgrade tables created before instance_id existed.
+DO $$
+DECLARE
+    t record;
+BEGIN
+    FOR t IN
+        SELECT *
+        FROM (VALUES
+            ('pgss_snapshots_raw', NULL),
+            ('pgss_deltas', 'window_start, instance_id, dbid, userid, queryid'),
+            ('features_windows', 'window_start, instance_id, dbid, userid, queryid'),
+            ('query_lex_features', 'instance_id, dbid, userid, queryid'),
+            ('anomaly_scores', 'model_version, window_end, instance_id, dbid, userid, queryid')
+        ) AS v(tbl, pk)
+    LOOP
+        -- query_lex_features is a view once moved to query_shapes.
+        CONTINUE WHEN NOT EXISTS (
+            SELECT 1
+            FROM pg_class
+            WHERE oid = to_regclass(format('monitoring.%I', t.tbl))
+              AND relkind IN ('r', 'p')
+        );
+        EXECUTE format(
+            'ALTER TABLE monitoring.%I ADD COLUMN IF NOT EXISTS instance_id text NOT NULL DEFAULT %L',
+            t.tbl, 'local'
+        );
+        IF t.pk IS NOT NULL AND NOT EXISTS (
+            SELECT 1
+            FROM pg_index i
+            JOIN pg_attribute a
+              ON a.attrelid = i.indrelid AND a.attnum = ANY (i.indkey)
+            WHERE i.indrelid = format('monitoring.%I', t.tbl)::regclass
+              AND i.indisprimary
+              AND a.attname = 'instance_id'
+        ) THEN
+            EXECUTE format(
+                'ALTER TABLE monitoring.%I DROP CONSTRAINT %I, ADD PRIMARY KEY (%s)',
+                t.tbl, t.tbl || '_pkey', t.pk
+            );
+        END IF;
+    END LOOP;
+END $$;
+
+CREATE INDEX IF NOT EXISTS idx_pgss_snapshots_raw_instance_ts
+    ON monitoring.pgss_snapshots_raw (instance_id, snapshot_ts);
+
+-- Move the per-key query_lex_features table into query_shapes and
+-- query_shape_map; a view with the old name and columns replaces it.
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1
+        FROM pg_class
+        WHERE oid = to_regclass('monitoring.query_lex_features')
+          AND relkind = 'r'
+    ) THEN
+        ALTER TABLE monitoring.query_lex_features
+            ADD COLUMN IF NOT EXISTS text_md5 text NULL;
+
+        INSERT INTO monitoring.query_shapes (
+            query_md5,
+            query_len_norm_chars,
+            num_tokens,
+            num_joins,
+            num_where,
+            num_group_by,
+            num_order_by,
+            num_having,
+            num_union,
+            num_subqueries,
+            num_cte,
+            has_write,
+            has_ddl,
+            has_tx,
+            num_case,
+            num_functions,
+            first_seen_ts
+        )
+        SELECT DISTINCT ON (query_md5)
+            query_md5,
+            query_len_norm_chars,
+            num_tokens,
+            num_joins,
+            num_where,
+            num_group_by,
+            num_order_by,
+            num_having,
+            num_union,
+            num_subqueries,
+            num_cte,
+            has_write,
+            has_ddl,
+            has_tx,
+            num_case,
+            num_functions,
+            first_seen_ts
+        FROM monitoring.query_lex_features
+        ORDER BY query_md5, first_seen_ts
+        ON CONFLICT (query_md5) DO NOTHING;
+
+        INSERT INTO monitoring.query_shape_map (
+            instance_id, dbid, userid, queryid, query_md5, query_text,
+            text_md5, query_len_chars, first_seen_ts, last_seen_ts
+        )
+        SELECT
+            instance_id, dbid, userid, queryid, query_md5, query_text,
+            text_md5, query_len_chars, first_seen_ts, last_seen_ts
+        FROM monitoring.query_lex_features
+        ON CONFLICT (instance_id, dbid, userid, queryid) DO NOTHING;
+
+        DROP TABLE monitoring.query_lex_features CASCADE;
+    END IF;
+END $$;
+
+DROP VIEW IF EXISTS monitoring.query_lex_features;
+
+-- Per-key lex features in the former table layout.
+CREATE VIEW monitoring.query_lex_features AS
+SELECT
+    m.instance_id,
+    m.dbid,
+    m.userid,
+    m.queryid,
+    m.query_text,
+    m.text_md5,
+    m.query_md5,
+    m.query_len_chars,
+    m.is_system,
+    s.query_len_norm_chars,
+    s.num_tokens,
+    s.num_joins,
+    s.num_where,
+    s.num_group_by,
+    s.num_order_by,
+    s.num_having,
+    s.num_union,
+    s.num_subqueries,
+    s.num_cte,
+    s.has_write,
+    s.has_ddl,
+    s.has_tx,
+    s.num_case,
+    s.num_functions,
+    m.first_seen_ts,
+    m.last_seen_ts
+FROM monitoring.query_shape_map m
+JOIN monitoring.query_shapes s ON s.query_md5 = m.query_md5;
+
 DROP VIEW IF EXISTS monitoring.features_with_lex;
 
 CREATE VIEW monitoring.features_with_lex AS
 SELECT
     w.*,
-    l.query_text,
-    l.query_md5,
-    l.query_len_chars,
-    l.query_len_norm_chars,
-    l.num_tokens,
-    l.num_joins,
-    l.num_where,
-    l.num_group_by,
-    l.num_order_by,
-    l.num_having,
-    l.num_union,
-    l.num_subqueries,
-    l.num_cte,
-    l.has_write,
-    l.has_ddl,
-    l.has_tx,
-    l.num_case,
-    l.num_functions
+    COALESCE(t.query_text, m.query_text) AS query_text,
+    m.query_md5,
+    m.query_len_chars,
+    m.is_system,
+    s.query_len_norm_chars,
+    s.num_tokens,
+    s.num_joins,
+    s.num_where,
+    s.num_group_by,
+    s.num_order_by,
+    s.num_having,
+    s.num_union,
+    s.num_subqueries,
+    s.num_cte,
+    s.has_write,
+    s.has_ddl,
+    s.has_tx,
+    s.num_case,
+    s.num_functions
 FROM monitoring.features_windows w
-LEFT JOIN monitoring.query_lex_features l
-  ON l.dbid = w.dbid AND l.userid = w.userid AND l.queryid = w.queryid;
+LEFT JOIN monitoring.query_shape_map m
+  ON m.instance_id = w.instance_id
+ AND m.dbid = w.dbid AND m.userid = w.userid AND m.queryid = w.queryid
+LEFT JOIN monitoring.query_shapes s ON s.query_md5 = m.query_md5
+LEFT JOIN monitoring.query_texts t
+  ON t.queryid = m.queryid AND t.text_md5 = m.text_md5;
+
+DROP VIEW IF EXISTS monitoring.features_rollup_with_lex;
+
+-- Rollup buckets with features recomputed from the summed deltas.
+CREATE VIEW monitoring.features_rollup_with_lex AS
+WITH r AS (
+    SELECT '1m'::text AS resolution, * FROM monitoring.pgss_rollup_1m
+    UNION ALL
+    SELECT '15m', * FROM monitoring.pgss_rollup_15m
+    UNION ALL
+    SELECT '1h', * FROM monitoring.pgss_rollup_1h
+),
+d AS (
+    SELECT
+        r.*,
+        CASE WHEN window_len_sec > 0 THEN window_len_sec ELSE 1.0 END AS len,
+        calls_delta::double precision AS calls
+    FROM r
+    WHERE calls_delta > 0
+)
+SELECT
+    d.resolution,
+    d.window_start,
+    d.window_end,
+    d.instance_id,
+    d.dbid,
+    d.userid,
+    d.queryid,
+    d.windows,
+    d.len AS window_len_sec,
+    d.calls_delta AS calls_in_window,
+    d.calls / d.len AS calls_per_sec,
+    d.total_exec_time_delta / d.calls AS exec_time_per_call_ms,
+    d.total_exec_time_delta / d.len AS exec_ms_per_sec,
+    d.rows_delta / d.calls AS rows_per_call,
+    d.rows_delta / d.len AS rows_per_sec,
+    d.shared_blks_read_delta / d.calls AS shared_read_per_call,
+    d.shared_blks_read_delta / d.len AS shared_read_per_sec,
+    d.temp_blks_read_delta / d.calls AS temp_read_per_call,
+    d.temp_blks_read_delta / d.len AS temp_read_per_sec,
+    d.wal_bytes_delta / d.calls AS wal_bytes_per_call,
+    d.wal_bytes_delta / d.len AS wal_bytes_per_sec,
+    CASE
+        WHEN d.shared_blks_read_delta + d.temp_blks_read_delta > 0
+        THEN d.temp_blks_read_delta::double precision
+            / (d.shared_blks_read_delta + d.temp_blks_read_delta)
+    END AS temp_share,
+    CASE
+        WHEN d.shared_blks_read_delta + d.shared_blks_hit_delta > 0
+        THEN d.shared_blks_read_delta::double precision
+            / (d.shared_blks_read_delta + d.shared_blks_hit_delta)
+    END AS cache_miss_ratio,
+    d.total_exec_time_delta / GREATEST(d.rows_delta, 1) AS ms_per_row,
+    d.shared_blks_read_delta::double precision / GREATEST(d.rows_delta, 1)
+        AS read_blks_per_row,
+    COALESCE(t.query_text, m.query_text) AS query_text,
+    m.query_md5,
+    m.query_len_chars,
+    m.is_system,
+    s.query_len_norm_chars,
+    s.num_tokens,
+    s.num_joins,
+    s.num_where,
+    s.num_group_by,
+    s.num_order_by,
+    s.num_having,
+    s.num_union,
+    s.num_subqueries,
+    s.num_cte,
+    s.has_write,
+    s.has_ddl,
+    s.has_tx,
+    s.num_case,
+    s.num_functions
+FROM d
+LEFT JOIN monitoring.query_shape_map m
+  ON m.instance_id = d.instance_id
+ AND m.dbid = d.dbid AND m.userid = d.userid AND m.queryid = d.queryid
+LEFT JOIN monitoring.query_shapes s ON s.query_md5 = m.query_md5
+LEFT JOIN monitoring.query_texts t
+  ON t.queryid = m.queryid AND t.text_md5 = m.text_md5;
+"""
+
+
+# Partitioned variants of the time-series tables (MONITORING_PARTITIONED=1).
+# Runs before DDL_INIT, whose CREATE TABLE IF NOT EXISTS then leaves them as is.
+# Daily partitions, plus a DEFAULT one, are managed by maintain_partitions.py.
+DDL_PARTITIONED = r"""
+CREATE SCHEMA IF NOT EXISTS monitoring;
+
+CREATE TABLE IF NOT EXISTS monitoring.pgss_snapshots_raw (
+    snapshot_id       bigserial,
+    snapshot_ts       timestamptz NOT NULL,
+    instance_id       text        NOT NULL DEFAULT 'local',
+    dbid              oid         NOT NULL,
+    userid            oid         NOT NULL,
+    queryid           bigint      NOT NULL,
+    calls             bigint      NOT NULL,
+    total_exec_time   double precision NOT NULL,
+    rows              bigint      NOT NULL,
+    shared_blks_hit   bigint      NOT NULL,
+    shared_blks_read  bigint      NOT NULL,
+    temp_blks_read    bigint      NOT NULL,
+    temp_blks_written bigint      NOT NULL,
+    wal_bytes         bigint      NOT NULL,
+    query_text        text        NULL,
+    text_md5          text        NULL,
+
+    PRIMARY KEY (snapshot_id, snapshot_ts)
+) PARTITION BY RANGE (snapshot_ts);
+
+CREATE INDEX IF NOT EXISTS idx_pgss_snapshots_raw_ts_brin
+    ON monitoring.pgss_snapshots_raw USING brin (snapshot_ts);
+
+CREATE TABLE IF NOT EXISTS monitoring.pgss_deltas (
+    window_start              timestamptz NOT NULL,
+    window_end                timestamptz NOT NULL,
+    instance_id               text        NOT NULL DEFAULT 'local',
+    dbid                      oid         NOT NULL,
+    userid                    oid         NOT NULL,
+    queryid                   bigint      NOT NULL,
+
+    calls_delta               bigint      NOT NULL,
+    total_exec_time_delta     double precision NOT NULL,
+    rows_delta                bigint      NOT NULL,
+    shared_blks_hit_delta     bigint      NOT NULL,
+    shared_blks_read_delta    bigint      NOT NULL,
+    temp_blks_read_delta      bigint      NOT NULL,
+    temp_blks_written_delta   bigint      NOT NULL,
+    wal_bytes_delta           bigint      NOT NULL,
+
+    PRIMARY KEY (window_start, instance_id, dbid, userid, queryid)
+) PARTITION BY RANGE (window_start);
+
+CREATE INDEX IF NOT EXISTS idx_pgss_deltas_ts_brin
+    ON monitoring.pgss_deltas USING brin (window_start);
+
+CREATE TABLE IF NOT EXISTS monitoring.features_windows (
+    window_start           timestamptz NOT NULL,
+    window_end             timestamptz NOT NULL,
+    instance_id            text        NOT NULL DEFAULT 'local',
+    dbid                   oid         NOT NULL,
+    userid                 oid         NOT NULL,
+    queryid                bigint      NOT NULL,
+
+    window_len_sec         double precision NOT NULL,
+
+    calls_in_window        bigint      NOT NULL,
+    calls_per_sec          double precision,
+
+    exec_time_per_call_ms  double precision,
+    exec_ms_per_sec        double precision,
+
+    rows_per_call          double precision,
+    rows_per_sec           double precision,
+
+    shared_read_per_call   double precision,
+    shared_read_per_sec    double precision,
+
+    temp_read_per_call     double precision,
+    temp_read_per_sec      double precision,
+
+    wal_bytes_per_call     double precision,
+    wal_bytes_per_sec      double precision,
+
+    temp_share             double precision,
+    cache_miss_ratio       double precision,
+
+    ms_per_row             double precision,
+    read_blks_per_row      double precision,
+
+    exec_time_per_call_ms_z double precision,
+    rows_per_call_z         double precision,
+    shared_read_per_call_z  double precision,
+    wal_bytes_per_call_z    double precision,
+
+    PRIMARY KEY (window_start, instance_id, dbid, userid, queryid)
+) PARTITION BY RANGE (window_start);
+
+CREATE INDEX IF NOT EXISTS idx_features_windows_ts_brin
+    ON monitoring.features_windows USING brin (window_start);
+
+CREATE TABLE IF NOT EXISTS monitoring.anomaly_scores (
+    window_start   timestamptz NOT NULL,
+    window_end     timestamptz NOT NULL,
+    instance_id    text        NOT NULL DEFAULT 'local',
+    dbid           oid         NOT NULL,
+    userid         oid         NOT NULL,
+    queryid        bigint      NOT NULL,
+
+    model_version  text        NOT NULL,
+    anomaly_score  double precision NOT NULL,
+
+    features       jsonb       NOT NULL,
+    scored_at      timestamptz NOT NULL DEFAULT now(),
+
+    PRIMARY KEY (model_version, window_end, instance_id, dbid, userid, queryid)
+) PARTITION BY RANGE (window_end);
+
+CREATE INDEX IF NOT EXISTS idx_anomaly_scores_ts_brin
+    ON monitoring.anomaly_scores USING brin (window_end);
 """
 
 
@@ -245,10 +774,19 @@ def wait_for_db(max_wait_sec: int = 120):
 def init_db_structure():
     """Create the monitoring schema and tables if missing."""
     print("🧱 Инициализация структуры monitoring...")
-    with psycopg.connect(**DB_CONFIG) as conn:
+    with psycopg.connect(**DB_CONFIG, row_factory=dict_row) as conn:
         with conn.cursor() as cur:
+            if MONITORING_PARTITIONED:
+                cur.execute(DDL_PARTITIONED)
             cur.execute(DDL_INIT)
+            # Keys stored before query_shape_map.is_system existed: the
+            # detector daemon starts before the first lex pass and skips
+            # windows whose is_system is still NULL.
+            classified = classify_stored_keys(cur)
         conn.commit()
+    if classified:
+        print(f"🏷 is_system заполнен для {classified} ранее сохранённых ключей.")
+    _run(S_PARTITIONS, check=True)
     print("✅ Структура готова.")
 
 
@@ -257,16 +795,30 @@ def _run(script_path: str, check: bool = True):
     subprocess.run([sys.executable, script_path], check=check)
 
 
+def _keep_running(proc, script_path: str, name: str):
+    """Return a running process of script_path, restarting it if it exited."""
+    if proc is not None and proc.poll() is not None:
+        print(f"❌ {name} завершился с кодом {proc.returncode}, перезапуск...")
+        proc = None
+    if proc is None:
+        proc = subprocess.Popen([sys.executable, script_path])
+    return proc
+
+
 def run_pipeline_once():
     """Run one pipeline pass.
 
-    Runs collection, deltas, features, lex, and detection.
+    Runs collection, deltas, features, lex, and detection (unless the
+    detector daemon scores the windows).
     """
     _run(S_COLLECT, check=True)
     _run(S_DELTAS, check=True)
-    _run(S_FEATURES, check=True)
+    if not FEATURES_FUSED:
+        _run(S_FEATURES, check=True)
+    _run(S_ROLLUPS, check=True)
     _run(S_LEX, check=True)
-    _run(S_DETECT, check=True)
+    if not DETECTOR_DAEMON:
+        _run(S_DETECT, check=True)
 
 
 def run_training_cycle():
@@ -281,7 +833,9 @@ def run_training_cycle():
             try:
                 _run(S_COLLECT, check=True)
                 _run(S_DELTAS, check=True)
-                _run(S_FEATURES, check=True)
+                if not FEATURES_FUSED:
+                    _run(S_FEATURES, check=True)
+                _run(S_ROLLUPS, check=True)
                 _run(S_LEX, check=True)
                 sys.stdout.write(f"\r   progress {i + 1}/{TRAIN_COLLECT_ITERATIONS}\n")
                 sys.stdout.flush()
@@ -321,12 +875,33 @@ def main_loop():
     print("🔁 Запуск основного цикла детекции...")
     send_telegram(f"🚀 Детектор запущен. Модель: {MODEL_FILE} ({MODEL_VERSION}).")
     last_retrain = time.time()
+    last_maintenance = time.time()
+    stream_proc = None
+    detector_proc = None
 
     while True:
-        try:
-            run_pipeline_once()
-        except Exception as e:
-            print(f"❌ Ошибка пайплайна: {e}")
+        if PIPELINE_MODE == "stream":
+            stream_proc = _keep_running(stream_proc, S_STREAM, "stream_pipeline")
+            try:
+                _run(S_ROLLUPS, check=True)
+            except Exception as e:
+                print(f"❌ Ошибка пайплайна: {e}")
+        else:
+            if DETECTOR_DAEMON:
+                detector_proc = _keep_running(
+                    detector_proc, S_DETECTOR, "detector_daemon"
+                )
+            try:
+                run_pipeline_once()
+            except Exception as e:
+                print(f"❌ Ошибка пайплайна: {e}")
+
+        if time.time() - last_maintenance >= PARTITION_MAINTENANCE_INTERVAL:
+            try:
+                _run(S_PARTITIONS, check=True)
+                last_maintenance = time.time()
+            except Exception as e:
+                print(f"❌ Ошибка обслуживания партиций: {e}")
 
         if time.time() - last_retrain >= RETRAIN_INTERVAL:
             try:
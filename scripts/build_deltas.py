@@ -1,28 +1,306 @@
 """Compute pgss metric deltas between snapshots."""
 
-from datetime import datetime
+import os
+from datetime import datetime, timezone
+from itertools import repeat
 
+import numpy as np
 import psycopg
-from psycopg.rows import dict_row
+from psycopg.rows import dict_row, tuple_row
 
 try:
-    from db_config import DB_CONFIG
+    from db_config import DB_CONFIG, collect_instance_ids
+    from bulk_writer import copy_rows
+    from build_features import build_instance_features_sql
 except Exception:
-    from scripts.db_config import DB_CONFIG
-
-
-def get_last_processed_window_end(cur):
-    """Return latest window_end from monitoring.pgss_deltas.
-
-    Return None when the table is empty.
+    from scripts.db_config import DB_CONFIG, collect_instance_ids
+    from scripts.bulk_writer import copy_rows
+    from scripts.build_features import build_instance_features_sql
+
+# Sparse snapshots hold only changed keys; carry last counters forward.
+SNAPSHOT_SPARSE = os.getenv("SNAPSHOT_SPARSE", "0").strip().lower() in ("1", "true")
+
+COUNTER_COLUMNS = [
+    "calls",
+    "total_exec_time",
+    "rows",
+    "shared_blks_hit",
+    "shared_blks_read",
+    "temp_blks_read",
+    "temp_blks_written",
+    "wal_bytes",
+]
+
+# Snapshot rows as loaded by the numpy engine.
+ROW_DTYPE = np.dtype(
+    [
+        ("dbid", "i8"),
+        ("userid", "i8"),
+        ("queryid", "i8"),
+        ("calls", "i8"),
+        ("total_exec_time", "f8"),
+        ("rows", "i8"),
+        ("shared_blks_hit", "i8"),
+        ("shared_blks_read", "i8"),
+        ("temp_blks_read", "i8"),
+        ("temp_blks_written", "i8"),
+        ("wal_bytes", "i8"),
+    ]
+)
+# key: (dbid, userid, queryid) packed into bytes that sort like the tuple.
+STATE_DTYPE = np.dtype(ROW_DTYPE.descr + [("snapshot_ts", "M8[us]"), ("key", "S24")])
+
+LOAD_SNAPSHOT_ROWS = """
+SELECT
+    dbid, userid, queryid,
+    calls, total_exec_time, rows,
+    shared_blks_hit, shared_blks_read,
+    temp_blks_read, temp_blks_written, wal_bytes
+FROM monitoring.pgss_snapshots_raw
+WHERE snapshot_ts = %s
+  AND instance_id = %s;
+"""
+
+CARRY_KEY_COLUMNS = ["instance_id", "dbid", "userid", "queryid"]
+CARRY_VALUE_COLUMNS = COUNTER_COLUMNS + ["snapshot_ts"]
+CARRY_COLUMNS = CARRY_KEY_COLUMNS + CARRY_VALUE_COLUMNS
+
+SELECT_CARRY = """
+SELECT
+    dbid, userid, queryid,
+    calls, total_exec_time, rows,
+    shared_blks_hit, shared_blks_read,
+    temp_blks_read, temp_blks_written, wal_bytes,
+    snapshot_ts
+FROM monitoring.pgss_delta_carry
+WHERE instance_id = %s;
+"""
+
+SEED_CARRY = """
+SELECT DISTINCT ON (dbid, userid, queryid)
+    dbid, userid, queryid,
+    calls, total_exec_time, rows,
+    shared_blks_hit, shared_blks_read,
+    temp_blks_read, temp_blks_written, wal_bytes,
+    snapshot_ts
+FROM monitoring.pgss_snapshots_raw
+WHERE instance_id = %s
+  AND snapshot_ts <= %s
+ORDER BY dbid, userid, queryid, snapshot_ts DESC;
+"""
+
+# python: per-window loop in Python; sql: one INSERT ... SELECT with LAG();
+# numpy: per-window loop over key-sorted NumPy arrays.
+DELTAS_ENGINE = os.getenv("DELTAS_ENGINE", "python").strip().lower()
+
+# Also build features_windows here, in the same transaction.
+FEATURES_FUSED = os.getenv("FEATURES_FUSED", "0").strip().lower() in ("1", "true")
+
+SEED_CARRY_SQL = """
+INSERT INTO monitoring.pgss_delta_carry (
+    instance_id, dbid, userid, queryid,
+    calls, total_exec_time, rows,
+    shared_blks_hit, shared_blks_read,
+    temp_blks_read, temp_blks_written, wal_bytes,
+    snapshot_ts
+)
+SELECT DISTINCT ON (dbid, userid, queryid)
+    instance_id, dbid, userid, queryid,
+    calls, total_exec_time, rows,
+    shared_blks_hit, shared_blks_read,
+    temp_blks_read, temp_blks_written, wal_bytes,
+    snapshot_ts
+FROM monitoring.pgss_snapshots_raw
+WHERE instance_id = %(instance_id)s
+  AND snapshot_ts <= %(since)s
+  AND NOT EXISTS (
+      SELECT 1
+      FROM monitoring.pgss_delta_carry
+      WHERE instance_id = %(instance_id)s
+  )
+ORDER BY dbid, userid, queryid, snapshot_ts DESC;
+"""
+
+# Same rules as deltas_for_window. Dense: the previous row counts only if
+# it is from the window_start snapshot, otherwise prev=0. Sparse: the last
+# known row counts, falling back to pgss_delta_carry.
+INSERT_DELTAS_SQL = """
+WITH ts AS (
+    SELECT
+        snapshot_ts,
+        lag(snapshot_ts) OVER (ORDER BY snapshot_ts) AS prev_ts
+    FROM (
+        SELECT DISTINCT snapshot_ts
+        FROM monitoring.pgss_snapshots_raw
+        WHERE instance_id = %(instance_id)s
+          AND snapshot_ts >= COALESCE(%(since)s::timestamptz, '-infinity')
+    ) s
+),
+src AS (
+    SELECT
+        snapshot_ts, dbid, userid, queryid,
+        calls, total_exec_time, rows,
+        shared_blks_hit, shared_blks_read,
+        temp_blks_read, temp_blks_written, wal_bytes
+    FROM monitoring.pgss_snapshots_raw
+    WHERE instance_id = %(instance_id)s
+      AND snapshot_ts >= COALESCE(%(since)s::timestamptz, '-infinity')
+    UNION ALL
+    SELECT
+        '-infinity'::timestamptz, dbid, userid, queryid,
+        calls, total_exec_time, rows,
+        shared_blks_hit, shared_blks_read,
+        temp_blks_read, temp_blks_written, wal_bytes
+    FROM monitoring.pgss_delta_carry
+    WHERE instance_id = %(instance_id)s
+      AND %(sparse)s
+),
+l AS (
+    SELECT
+        src.*,
+        lag(snapshot_ts) OVER w AS p_ts,
+        lag(calls) OVER w AS p_calls,
+        lag(total_exec_time) OVER w AS p_total_exec_time,
+        lag(rows) OVER w AS p_rows,
+        lag(shared_blks_hit) OVER w AS p_shared_blks_hit,
+        lag(shared_blks_read) OVER w AS p_shared_blks_read,
+        lag(temp_blks_read) OVER w AS p_temp_blks_read,
+        lag(temp_blks_written) OVER w AS p_temp_blks_written,
+        lag(wal_bytes) OVER w AS p_wal_bytes
+    FROM src
+    WINDOW w AS (PARTITION BY dbid, userid, queryid ORDER BY snapshot_ts)
+),
+d AS (
+    SELECT
+        ts.prev_ts AS window_start,
+        l.snapshot_ts AS window_end,
+        l.p_ts = ts.prev_ts OR (%(sparse)s AND l.p_ts IS NOT NULL) AS use_prev,
+        l.*
+    FROM l
+    JOIN ts ON ts.snapshot_ts = l.snapshot_ts
+    WHERE ts.prev_ts IS NOT NULL
+      AND NOT EXISTS (
+          SELECT 1
+          FROM monitoring.pgss_deltas x
+          WHERE x.window_start = ts.prev_ts
+            AND x.instance_id = %(instance_id)s
+      )
+),
+v AS (
+    SELECT
+        window_start,
+        window_end,
+        dbid,
+        userid,
+        queryid,
+        calls - CASE WHEN use_prev THEN p_calls ELSE 0 END
+            AS calls_delta,
+        total_exec_time - CASE WHEN use_prev THEN p_total_exec_time ELSE 0 END
+            AS total_exec_time_delta,
+        rows - CASE WHEN use_prev THEN p_rows ELSE 0 END
+            AS rows_delta,
+        shared_blks_hit - CASE WHEN use_prev THEN p_shared_blks_hit ELSE 0 END
+            AS shared_blks_hit_delta,
+        shared_blks_read - CASE WHEN use_prev THEN p_shared_blks_read ELSE 0 END
+            AS shared_blks_read_delta,
+        temp_blks_read - CASE WHEN use_prev THEN p_temp_blks_read ELSE 0 END
+            AS temp_blks_read_delta,
+        temp_blks_written - CASE WHEN use_prev THEN p_temp_blks_written ELSE 0 END
+            AS temp_blks_written_delta,
+        wal_bytes - CASE WHEN use_prev THEN p_wal_bytes ELSE 0 END
+            AS wal_bytes_delta
+    FROM d
+)
+INSERT INTO monitoring.pgss_deltas (
+    window_start, window_end, instance_id, dbid, userid, queryid,
+    calls_delta, total_exec_time_delta, rows_delta,
+    shared_blks_hit_delta, shared_blks_read_delta,
+    temp_blks_read_delta, temp_blks_written_delta, wal_bytes_delta
+)
+SELECT
+    window_start, window_end, %(instance_id)s, dbid, userid, queryid,
+    calls_delta, total_exec_time_delta, rows_delta,
+    shared_blks_hit_delta, shared_blks_read_delta,
+    temp_blks_read_delta, temp_blks_written_delta, wal_bytes_delta
+FROM v
+WHERE calls_delta > 0
+  AND total_exec_time_delta >= 0
+  AND rows_delta >= 0
+  AND shared_blks_hit_delta >= 0
+  AND shared_blks_read_delta >= 0
+  AND temp_blks_read_delta >= 0
+  AND temp_blks_written_delta >= 0
+  AND wal_bytes_delta >= 0
+ON CONFLICT DO NOTHING;
+"""
+
+SAVE_CARRY_SQL = """
+INSERT INTO monitoring.pgss_delta_carry (
+    instance_id, dbid, userid, queryid,
+    calls, total_exec_time, rows,
+    shared_blks_hit, shared_blks_read,
+    temp_blks_read, temp_blks_written, wal_bytes,
+    snapshot_ts
+)
+SELECT DISTINCT ON (dbid, userid, queryid)
+    instance_id, dbid, userid, queryid,
+    calls, total_exec_time, rows,
+    shared_blks_hit, shared_blks_read,
+    temp_blks_read, temp_blks_written, wal_bytes,
+    snapshot_ts
+FROM monitoring.pgss_snapshots_raw
+WHERE instance_id = %(instance_id)s
+  AND snapshot_ts >= COALESCE(%(since)s::timestamptz, '-infinity')
+ORDER BY dbid, userid, queryid, snapshot_ts DESC
+ON CONFLICT (instance_id, dbid, userid, queryid) DO UPDATE SET
+    calls = EXCLUDED.calls,
+    total_exec_time = EXCLUDED.total_exec_time,
+    rows = EXCLUDED.rows,
+    shared_blks_hit = EXCLUDED.shared_blks_hit,
+    shared_blks_read = EXCLUDED.shared_blks_read,
+    temp_blks_read = EXCLUDED.temp_blks_read,
+    temp_blks_written = EXCLUDED.temp_blks_written,
+    wal_bytes = EXCLUDED.wal_bytes,
+    snapshot_ts = EXCLUDED.snapshot_ts;
+"""
+
+DELTA_COLUMNS = [
+    "window_start",
+    "window_end",
+    "instance_id",
+    "dbid",
+    "userid",
+    "queryid",
+    "calls_delta",
+    "total_exec_time_delta",
+    "rows_delta",
+    "shared_blks_hit_delta",
+    "shared_blks_read_delta",
+    "temp_blks_read_delta",
+    "temp_blks_written_delta",
+    "wal_bytes_delta",
+]
+
+
+def get_last_processed_window_end(cur, instance_id):
+    """Return latest window_end of an instance from monitoring.pgss_deltas.
+
+    Return None when there are no deltas yet.
     """
-    cur.execute("SELECT max(window_end) AS last_end FROM monitoring.pgss_deltas;")
+    cur.execute(
+        """
+        SELECT max(window_end) AS last_end
+        FROM monitoring.pgss_deltas
+        WHERE instance_id = %s;
+        """,
+        (instance_id,),
+    )
     row = cur.fetchone()
     return row["last_end"] if row and row["last_end"] is not None else None
 
 
-def get_snapshot_timestamps(cur, since_ts=None):
-    """Return DISTINCT snapshot_ts in ascending order.
+def get_snapshot_timestamps(cur, instance_id, since_ts=None):
+    """Return DISTINCT snapshot_ts of an instance in ascending order.
 
     If since_ts is set, only returns snapshots >= since_ts.
     """
@@ -31,38 +309,42 @@ def get_snapshot_timestamps(cur, since_ts=None):
             """
             SELECT DISTINCT snapshot_ts
             FROM monitoring.pgss_snapshots_raw
+            WHERE instance_id = %s
             ORDER BY snapshot_ts ASC;
-            """
+            """,
+            (instance_id,),
         )
     else:
         cur.execute(
             """
             SELECT DISTINCT snapshot_ts
             FROM monitoring.pgss_snapshots_raw
-            WHERE snapshot_ts >= %s
+            WHERE instance_id = %s
+              AND snapshot_ts >= %s
             ORDER BY snapshot_ts ASC;
             """,
-            (since_ts,),
+            (instance_id, since_ts),
         )
     rows = cur.fetchall()
     return [r["snapshot_ts"] for r in rows]
 
 
-def window_already_processed(cur, window_start):
+def window_already_processed(cur, instance_id, window_start):
     """Check whether rows exist for the given window_start."""
     cur.execute(
         """
         SELECT 1
         FROM monitoring.pgss_deltas
         WHERE window_start = %s
+          AND instance_id = %s
         LIMIT 1;
         """,
-        (window_start,),
+        (window_start, instance_id),
     )
     return cur.fetchone() is not None
 
 
-def load_snapshot(cur, snapshot_ts):
+def load_snapshot(cur, instance_id, snapshot_ts):
     """Load rows for snapshot_ts into a dict keyed by identifiers.
 
     Key = (dbid, userid, queryid), value = metrics dict.
@@ -80,11 +362,13 @@ def load_snapshot(cur, snapshot_ts):
             shared_blks_read,
             temp_blks_read,
             temp_blks_written,
-            wal_bytes
+            wal_bytes,
+            snapshot_ts
         FROM monitoring.pgss_snapshots_raw
-        WHERE snapshot_ts = %s;
+        WHERE snapshot_ts = %s
+          AND instance_id = %s;
         """,
-        (snapshot_ts,),
+        (snapshot_ts, instance_id),
     )
     rows = cur.fetchall()
 
@@ -95,6 +379,40 @@ def load_snapshot(cur, snapshot_ts):
     return snapshot
 
 
+def load_carry(cur, instance_id, last_end):
+    """Load last known counters per key for sparse snapshots.
+
+    Seeds the state from raw snapshots up to last_end when the carry
+    table has no rows for the instance yet. Returns (state, seeded).
+    """
+    cur.execute(SELECT_CARRY, (instance_id,))
+    rows = cur.fetchall()
+    seeded = False
+    if not rows and last_end is not None:
+        cur.execute(SEED_CARRY, (instance_id, last_end))
+        rows = cur.fetchall()
+        seeded = True
+    return {(r["dbid"], r["userid"], r["queryid"]): r for r in rows}, seeded
+
+
+def save_carry(cur, instance_id, state, keys):
+    """Upsert carried counters of the given keys."""
+    rows = [
+        (instance_id, *key, *(state[key][c] for c in CARRY_VALUE_COLUMNS))
+        for key in keys
+    ]
+    return copy_rows(
+        cur,
+        "monitoring.pgss_delta_carry",
+        CARRY_COLUMNS,
+        rows,
+        on_conflict="update",
+        conflict_cols=CARRY_KEY_COLUMNS,
+        update_cols=CARRY_VALUE_COLUMNS,
+        stage="build_deltas",
+    )
+
+
 def safe_delta(curr_val, prev_val):
     """Return curr - prev, or None if either value is None."""
     if curr_val is None or prev_val is None:
@@ -102,10 +420,14 @@ def safe_delta(curr_val, prev_val):
     return curr_val - prev_val
 
 
-def deltas_for_window(prev_snapshot, curr_snapshot, window_start, window_end):
+def deltas_for_window(
+    prev_snapshot, curr_snapshot, window_start, window_end, instance_id="local"
+):
     """Compute deltas for one window from two snapshots.
 
-    New keys assume prev=0. Negative deltas are skipped.
+    prev_snapshot may also be the carried state with the last known
+    counters of every key. New keys assume prev=0. Negative deltas are
+    skipped.
     """
     deltas = []
 
@@ -162,6 +484,7 @@ def deltas_for_window(prev_snapshot, curr_snapshot, window_start, window_end):
             {
                 "window_start": window_start,
                 "window_end": window_end,
+                "instance_id": instance_id,
                 "dbid": key[0],
                 "userid": key[1],
                 "queryid": key[2],
@@ -189,91 +512,283 @@ def deltas_for_window(prev_snapshot, curr_snapshot, window_start, window_end):
     return deltas
 
 
+def key_bytes(arr):
+    """Pack (dbid, userid, queryid) into 24 bytes that sort like the tuple."""
+    keys = np.empty(len(arr), dtype=[("d", ">u8"), ("u", ">u8"), ("q", ">u8")])
+    keys["d"] = arr["dbid"]
+    keys["u"] = arr["userid"]
+    keys["q"] = arr["queryid"].view(np.uint64) ^ np.uint64(1 << 63)
+    return keys.view("S24")
+
+
+def snapshot_array(rows, snapshot_ts):
+    """Build a key-sorted state array from (key..., counters...) tuples.
+
+    snapshot_ts is a naive UTC datetime64 scalar or array. Duplicate keys
+    keep the last row, like load_snapshot.
+    """
+    raw = np.array(rows, dtype=ROW_DTYPE)
+    arr = np.empty(len(raw), dtype=STATE_DTYPE)
+    for name in ROW_DTYPE.names:
+        arr[name] = raw[name]
+    arr["snapshot_ts"] = snapshot_ts
+    arr["key"] = key_bytes(raw)
+
+    arr = arr[np.argsort(arr["key"], kind="stable")]
+    last = np.ones(len(arr), dtype=bool)
+    last[:-1] = arr["key"][1:] != arr["key"][:-1]
+    return arr[last]
+
+
+def _utc64(ts):
+    """Convert an aware datetime to a naive UTC datetime64[us]."""
+    return np.datetime64(ts.astimezone(timezone.utc).replace(tzinfo=None), "us")
+
+
+def load_snapshot_array(cur, instance_id, snapshot_ts):
+    """Load rows for snapshot_ts into a key-sorted state array."""
+    with cur.connection.cursor(row_factory=tuple_row) as tcur:
+        tcur.execute(LOAD_SNAPSHOT_ROWS, (snapshot_ts, instance_id))
+        rows = tcur.fetchall()
+    return snapshot_array(rows, _utc64(snapshot_ts))
+
+
+def load_carry_array(cur, instance_id, last_end):
+    """Array variant of load_carry. Returns (state, seeded)."""
+    with cur.connection.cursor(row_factory=tuple_row) as tcur:
+        tcur.execute(SELECT_CARRY, (instance_id,))
+        rows = tcur.fetchall()
+        seeded = False
+        if not rows and last_end is not None:
+            tcur.execute(SEED_CARRY, (instance_id, last_end))
+            rows = tcur.fetchall()
+            seeded = True
+    ts = np.array([_utc64(r[-1]) for r in rows], dtype="M8[us]")
+    return snapshot_array([r[:-1] for r in rows], ts), seeded
+
+
+def merge_state(state, curr):
+    """Overlay curr onto state; both are key-sorted state arrays."""
+    if not len(state):
+        return curr
+    idx = np.searchsorted(curr["key"], state["key"])
+    in_curr = idx < len(curr)
+    in_curr[in_curr] = curr["key"][idx[in_curr]] == state["key"][in_curr]
+    merged = np.concatenate([state[~in_curr], curr])
+    return merged[np.argsort(merged["key"], kind="stable")]
+
+
+def deltas_for_window_np(prev, curr):
+    """Vectorized deltas_for_window over key-sorted state arrays.
+
+    Returns (rows, deltas): the curr rows that pass the same filters and a
+    dict of their delta arrays keyed by counter column.
+    """
+    idx = np.searchsorted(prev["key"], curr["key"])
+    found = idx < len(prev)
+    found[found] = prev["key"][idx[found]] == curr["key"][found]
+    matched = idx[found]
+
+    deltas = {}
+    for c in COUNTER_COLUMNS:
+        base = np.zeros(len(curr), dtype=curr.dtype[c])
+        base[found] = prev[c][matched]
+        deltas[c] = curr[c] - base
+
+    valid = deltas["calls"] > 0
+    for c in COUNTER_COLUMNS[1:]:
+        valid &= deltas[c] >= 0
+
+    return curr[valid], {c: d[valid] for c, d in deltas.items()}
+
+
+def delta_rows(window_start, window_end, instance_id, rows, deltas):
+    """Build pgss_deltas rows in DELTA_COLUMNS order from array deltas."""
+    n = len(rows)
+    return list(
+        zip(
+            repeat(window_start, n),
+            repeat(window_end, n),
+            repeat(instance_id, n),
+            rows["dbid"].tolist(),
+            rows["userid"].tolist(),
+            rows["queryid"].tolist(),
+            *(deltas[c].tolist() for c in COUNTER_COLUMNS),
+        )
+    )
+
+
+def save_carry_array(cur, instance_id, state):
+    """Upsert carried counters from a state array."""
+    ts = [t.replace(tzinfo=timezone.utc) for t in state["snapshot_ts"].tolist()]
+    rows = zip(
+        repeat(instance_id, len(state)),
+        state["dbid"].tolist(),
+        state["userid"].tolist(),
+        state["queryid"].tolist(),
+        *(state[c].tolist() for c in COUNTER_COLUMNS),
+        ts,
+    )
+    return copy_rows(
+        cur,
+        "monitoring.pgss_delta_carry",
+        CARRY_COLUMNS,
+        rows,
+        on_conflict="update",
+        conflict_cols=CARRY_KEY_COLUMNS,
+        update_cols=CARRY_VALUE_COLUMNS,
+        stage="build_deltas",
+    )
+
+
 def save_deltas(cur, deltas):
     """Insert computed deltas into monitoring.pgss_deltas."""
     if not deltas:
         return 0
 
-    query = """
-        INSERT INTO monitoring.pgss_deltas (
-            window_start,
-            window_end,
-            dbid,
-            userid,
-            queryid,
-            calls_delta,
-            total_exec_time_delta,
-            rows_delta,
-            shared_blks_hit_delta,
-            shared_blks_read_delta,
-            temp_blks_read_delta,
-            temp_blks_written_delta,
-            wal_bytes_delta
-        )
-        VALUES (
-            %s, %s, %s, %s, %s,
-            %s, %s, %s, %s, %s,
-            %s, %s, %s
-        )
-        ON CONFLICT DO NOTHING;
+    return copy_rows(
+        cur,
+        "monitoring.pgss_deltas",
+        DELTA_COLUMNS,
+        deltas,
+        on_conflict="nothing",
+        stage="build_deltas",
+    )
+
+
+def build_instance_deltas(cur, instance_id):
+    """Backfill missing delta windows of one instance."""
+    last_end = get_last_processed_window_end(cur, instance_id)
+
+    snapshot_ts = get_snapshot_timestamps(cur, instance_id, since_ts=last_end)
+
+    if len(snapshot_ts) < 2:
+        print(f"{instance_id}: not enough snapshots to compute deltas.")
+        return 0
+
+    total_inserted = 0
+
+    prev_snapshot = load_snapshot(cur, instance_id, snapshot_ts[0])
+    if SNAPSHOT_SPARSE:
+        state, seeded = load_carry(cur, instance_id, last_end)
+        changed = set(state) if seeded else set()
+        state.update(prev_snapshot)
+        changed.update(prev_snapshot)
+
+    for i in range(1, len(snapshot_ts)):
+        window_start = snapshot_ts[i - 1]
+        window_end = snapshot_ts[i]
+
+        curr_snapshot = load_snapshot(cur, instance_id, window_end)
+
+        if not window_already_processed(cur, instance_id, window_start):
+            deltas = deltas_for_window(
+                state if SNAPSHOT_SPARSE else prev_snapshot,
+                curr_snapshot,
+                window_start,
+                window_end,
+                instance_id,
+            )
+            total_inserted += save_deltas(cur, deltas)
+
+        if SNAPSHOT_SPARSE:
+            state.update(curr_snapshot)
+            changed.update(curr_snapshot)
+        prev_snapshot = curr_snapshot
+
+    if SNAPSHOT_SPARSE:
+        save_carry(cur, instance_id, state, changed)
+    return total_inserted
+
+
+def build_instance_deltas_numpy(cur, instance_id):
+    """Backfill missing delta windows of one instance with NumPy arrays.
+
+    Each snapshot is loaded once and reused as prev for the next window.
     """
+    last_end = get_last_processed_window_end(cur, instance_id)
 
-    params = [
-        (
-            d["window_start"],
-            d["window_end"],
-            d["dbid"],
-            d["userid"],
-            d["queryid"],
-            d["calls_delta"],
-            d["total_exec_time_delta"],
-            d["rows_delta"],
-            d["shared_blks_hit_delta"],
-            d["shared_blks_read_delta"],
-            d["temp_blks_read_delta"],
-            d["temp_blks_written_delta"],
-            d["wal_bytes_delta"],
-        )
-        for d in deltas
-    ]
+    snapshot_ts = get_snapshot_timestamps(cur, instance_id, since_ts=last_end)
 
-    cur.executemany(query, params)
-    return len(deltas)
+    if len(snapshot_ts) < 2:
+        print(f"{instance_id}: not enough snapshots to compute deltas.")
+        return 0
 
+    total_inserted = 0
 
-def build_deltas_backfill():
-    """Backfill windows that do not have computed deltas."""
-    with psycopg.connect(**DB_CONFIG, row_factory=dict_row) as conn:
-        with conn.cursor() as cur:
-            last_end = get_last_processed_window_end(cur)
+    prev = load_snapshot_array(cur, instance_id, snapshot_ts[0])
+    if SNAPSHOT_SPARSE:
+        state, seeded = load_carry_array(cur, instance_id, last_end)
+        state = merge_state(state, prev)
 
-            snapshot_ts = get_snapshot_timestamps(cur, since_ts=last_end)
+    for i in range(1, len(snapshot_ts)):
+        window_start = snapshot_ts[i - 1]
+        window_end = snapshot_ts[i]
 
-            if len(snapshot_ts) < 2:
-                print("Not enough snapshots to compute deltas.")
-                return
+        curr = load_snapshot_array(cur, instance_id, window_end)
 
-            total_inserted = 0
+        if not window_already_processed(cur, instance_id, window_start):
+            rows, deltas = deltas_for_window_np(
+                state if SNAPSHOT_SPARSE else prev, curr
+            )
+            total_inserted += save_deltas(
+                cur, delta_rows(window_start, window_end, instance_id, rows, deltas)
+            )
 
-            for i in range(1, len(snapshot_ts)):
-                window_start = snapshot_ts[i - 1]
-                window_end = snapshot_ts[i]
+        if SNAPSHOT_SPARSE:
+            state = merge_state(state, curr)
+        prev = curr
 
-                if window_already_processed(cur, window_start):
-                    continue
+    if SNAPSHOT_SPARSE:
+        if not seeded:
+            state = state[state["snapshot_ts"] >= _utc64(snapshot_ts[0])]
+        save_carry_array(cur, instance_id, state)
+    return total_inserted
 
-                prev_snapshot = load_snapshot(cur, window_start)
-                curr_snapshot = load_snapshot(cur, window_end)
 
-                deltas = deltas_for_window(
-                    prev_snapshot, curr_snapshot, window_start, window_end
-                )
-                inserted = save_deltas(cur, deltas)
-                total_inserted += inserted
+def build_instance_deltas_sql(cur, instance_id):
+    """Backfill missing delta windows of one instance in a single INSERT."""
+    params = {
+        "instance_id": instance_id,
+        "since": get_last_processed_window_end(cur, instance_id),
+        "sparse": SNAPSHOT_SPARSE,
+    }
+    if SNAPSHOT_SPARSE and params["since"] is not None:
+        cur.execute(SEED_CARRY_SQL, params)
+
+    cur.execute(INSERT_DELTAS_SQL, params)
+    inserted = cur.rowcount
+
+    if SNAPSHOT_SPARSE:
+        cur.execute(SAVE_CARRY_SQL, params)
+    return inserted
+
+
+def build_deltas_backfill():
+    """Backfill windows that do not have computed deltas."""
+    build = build_instance_deltas
+    if DELTAS_ENGINE == "sql":
+        build = build_instance_deltas_sql
+    elif DELTAS_ENGINE == "numpy":
+        build = build_instance_deltas_numpy
+
+    with psycopg.connect(**DB_CONFIG, row_factory=dict_row) as conn:
+        with conn.cursor() as cur:
+            total_inserted = 0
+            total_features = 0
+            for instance_id in collect_instance_ids():
+                total_inserted += build(cur, instance_id)
+                if FEATURES_FUSED:
+                    total_features += build_instance_features_sql(cur, instance_id)
             conn.commit()
             print(
                 f"{datetime.now()}: inserted {total_inserted} rows into monitoring.pgss_deltas"
             )
+            if FEATURES_FUSED:
+                print(
+                    f"{datetime.now()}: inserted {total_features} rows into "
+                    "monitoring.features_windows"
+                )
 
 
 if __name__ == "__main__":
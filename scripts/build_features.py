@@ -1,23 +1,198 @@
 """Build aggregated features from pgss deltas."""
 
+import math
+import os
 from datetime import datetime
+from operator import itemgetter
 
+import numpy as np
 import psycopg
 from psycopg.rows import dict_row
 
 try:
-    from db_config import DB_CONFIG
+    from db_config import DB_CONFIG, collect_instance_ids
+    from bulk_writer import copy_rows
+    from watermarks import load_watermark, save_watermark
 except Exception:
-    from scripts.db_config import DB_CONFIG
+    from scripts.db_config import DB_CONFIG, collect_instance_ids
+    from scripts.bulk_writer import copy_rows
+    from scripts.watermarks import load_watermark, save_watermark
+
+FEATURES_STAGE = "features"
+
+# Max delta windows read per chunk.
+FEATURES_CHUNK_WINDOWS = int(os.getenv("FEATURES_CHUNK_WINDOWS", "20"))
+
+# Weight of the newest window in the per-query moving mean/variance.
+BASELINE_ALPHA = float(os.getenv("BASELINE_ALPHA", "0.05"))
+# Windows a baseline needs before its z-scores are reported.
+BASELINE_MIN_WINDOWS = int(os.getenv("BASELINE_MIN_WINDOWS", "10"))
+# |z| cap, so a metric that was constant does not produce an unbounded score.
+BASELINE_Z_CLIP = float(os.getenv("BASELINE_Z_CLIP", "10"))
+
+# Same arithmetic as compute_features, for the fused delta->feature mode.
+FEATURES_SQL = """
+WITH d AS (
+    SELECT
+        window_start,
+        window_end,
+        instance_id,
+        dbid,
+        userid,
+        queryid,
+        CASE
+            WHEN extract(epoch FROM window_end - window_start) > 0
+            THEN extract(epoch FROM window_end - window_start)::double precision
+            ELSE 1.0
+        END AS len,
+        calls_delta,
+        calls_delta::double precision AS calls,
+        total_exec_time_delta AS exec_ms,
+        rows_delta,
+        rows_delta::double precision AS rows,
+        shared_blks_hit_delta AS shared_hit,
+        shared_blks_read_delta AS shared_read,
+        temp_blks_read_delta AS temp_read,
+        wal_bytes_delta::double precision AS wal_bytes
+    FROM monitoring.pgss_deltas
+    WHERE instance_id = %(instance_id)s
+      AND window_end > COALESCE(%(after)s::timestamptz, '-infinity')
+      AND calls_delta > 0
+)
+SELECT
+    window_start, window_end, instance_id, dbid, userid, queryid,
+    len AS window_len_sec,
+    calls_delta AS calls_in_window,
+    calls / len AS calls_per_sec,
+    exec_ms / calls AS exec_time_per_call_ms,
+    exec_ms / len AS exec_ms_per_sec,
+    rows / calls AS rows_per_call,
+    rows / len AS rows_per_sec,
+    shared_read / calls AS shared_read_per_call,
+    shared_read / len AS shared_read_per_sec,
+    temp_read / calls AS temp_read_per_call,
+    temp_read / len AS temp_read_per_sec,
+    wal_bytes / calls AS wal_bytes_per_call,
+    wal_bytes / len AS wal_bytes_per_sec,
+    CASE
+        WHEN shared_read + temp_read > 0
+        THEN temp_read::double precision / (shared_read + temp_read)
+    END AS temp_share,
+    CASE
+        WHEN shared_read + shared_hit > 0
+        THEN shared_read::double precision / (shared_read + shared_hit)
+    END AS cache_miss_ratio,
+    exec_ms / GREATEST(rows_delta, 1) AS ms_per_row,
+    shared_read::double precision / GREATEST(rows_delta, 1) AS read_blks_per_row
+FROM d
+ORDER BY window_end;
+"""
+
+MAX_DELTA_WINDOW_END = """
+SELECT max(window_end) AS last_end
+FROM monitoring.pgss_deltas
+WHERE instance_id = %s;
+"""
+
+SEED_WATERMARK = """
+SELECT max(window_end) AS last_end
+FROM monitoring.features_windows
+WHERE instance_id = %s;
+"""
+
+FEATURE_COLUMNS = [
+    "window_start",
+    "window_end",
+    "instance_id",
+    "dbid",
+    "userid",
+    "queryid",
+    "window_len_sec",
+    "calls_in_window",
+    "calls_per_sec",
+    "exec_time_per_call_ms",
+    "exec_ms_per_sec",
+    "rows_per_call",
+    "rows_per_sec",
+    "shared_read_per_call",
+    "shared_read_per_sec",
+    "temp_read_per_call",
+    "temp_read_per_sec",
+    "wal_bytes_per_call",
+    "wal_bytes_per_sec",
+    "temp_share",
+    "cache_miss_ratio",
+    "ms_per_row",
+    "read_blks_per_row",
+]
+
+KEY_COLUMNS = FEATURE_COLUMNS[:6]
+
+BASELINE_METRICS = [
+    "exec_time_per_call_ms",
+    "rows_per_call",
+    "shared_read_per_call",
+    "wal_bytes_per_call",
+]
+
+# Written to features_windows after FEATURE_COLUMNS.
+Z_COLUMNS = [f"{m}_z" for m in BASELINE_METRICS]
+
+BASELINE_KEY_COLUMNS = ["instance_id", "dbid", "userid", "queryid"]
+BASELINE_VALUE_COLUMNS = ["windows", "last_window_end"] + [
+    f"{m}_{s}" for m in BASELINE_METRICS for s in ("mean", "var")
+]
+BASELINE_COLUMNS = BASELINE_KEY_COLUMNS + BASELINE_VALUE_COLUMNS
+
+SELECT_BASELINES = """
+SELECT b.*
+FROM monitoring.query_baselines b
+JOIN unnest(%s::text[], %s::oid[], %s::oid[], %s::bigint[])
+  AS k (instance_id, dbid, userid, queryid)
+  USING (instance_id, dbid, userid, queryid);
+"""
+
+SELECT_ALL_BASELINES = """
+SELECT *
+FROM monitoring.query_baselines
+WHERE instance_id = ANY(%s);
+"""
+
+_WINDOW_END = FEATURE_COLUMNS.index("window_end")
+_BASELINE_KEY = slice(
+    FEATURE_COLUMNS.index("instance_id"), FEATURE_COLUMNS.index("queryid") + 1
+)
+_BASELINE_METRIC_IDX = [FEATURE_COLUMNS.index(m) for m in BASELINE_METRICS]
+
+DELTA_DTYPE = np.dtype(
+    [
+        ("calls_delta", "i8"),
+        ("total_exec_time_delta", "f8"),
+        ("rows_delta", "i8"),
+        ("shared_blks_hit_delta", "i8"),
+        ("shared_blks_read_delta", "i8"),
+        ("temp_blks_read_delta", "i8"),
+        ("wal_bytes_delta", "i8"),
+    ]
+)
 
 
-def load_unprocessed_deltas(cur):
-    """Fetch deltas missing rows in monitoring.features_windows."""
+def load_unprocessed_deltas(cur, instance_id, after, max_windows):
+    """Fetch deltas of up to max_windows windows ending after the watermark."""
     cur.execute(
         """
+        WITH w AS (
+            SELECT DISTINCT window_end
+            FROM monitoring.pgss_deltas
+            WHERE instance_id = %(instance_id)s
+              AND window_end > COALESCE(%(after)s::timestamptz, '-infinity')
+            ORDER BY window_end
+            LIMIT %(max_windows)s
+        )
         SELECT
             d.window_start,
             d.window_end,
+            d.instance_id,
             d.dbid,
             d.userid,
             d.queryid,
@@ -30,13 +205,12 @@ def load_unprocessed_deltas(cur):
             d.temp_blks_written_delta,
             d.wal_bytes_delta
         FROM monitoring.pgss_deltas d
-        LEFT JOIN monitoring.features_windows f
-          ON f.window_start = d.window_start
-         AND f.dbid         = d.dbid
-         AND f.userid       = d.userid
-         AND f.queryid      = d.queryid
-        WHERE f.window_start IS NULL;
-        """
+        WHERE d.instance_id = %(instance_id)s
+          AND d.window_end > COALESCE(%(after)s::timestamptz, '-infinity')
+          AND d.window_end <= (SELECT max(window_end) FROM w)
+        ORDER BY d.window_end;
+        """,
+        {"instance_id": instance_id, "after": after, "max_windows": max_windows},
     )
     return cur.fetchall()
 
@@ -86,6 +260,7 @@ def compute_features(r):
     return {
         "window_start": window_start,
         "window_end": window_end,
+        "instance_id": r["instance_id"],
         "dbid": r["dbid"],
         "userid": r["userid"],
         "queryid": r["queryid"],
@@ -111,125 +286,251 @@ def compute_features(r):
     }
 
 
-def save_features(cur, features):
-    """Insert feature rows into monitoring.features_windows."""
-    if not features:
-        return 0
+def _ratio(num, denom):
+    """Return num / denom as a list with None where denom <= 0."""
+    valid = denom > 0
+    out = np.divide(num, denom, out=np.zeros(len(num)), where=valid)
+    return np.where(valid, out, None).tolist()
 
-    query = """
-        INSERT INTO monitoring.features_windows (
-            window_start,
-            window_end,
-            dbid,
-            userid,
-            queryid,
-            window_len_sec,
 
-            calls_in_window,
-            calls_per_sec,
+def compute_features_batch(deltas):
+    """Columnar compute_features over a list of delta rows.
 
-            exec_time_per_call_ms,
-            exec_ms_per_sec,
+    Returns rows in FEATURE_COLUMNS order, skipping calls <= 0 like
+    compute_features.
+    """
+    if not deltas:
+        return []
+
+    keys = list(map(itemgetter(*KEY_COLUMNS), deltas))
+    d = np.array(list(map(itemgetter(*DELTA_DTYPE.names), deltas)), dtype=DELTA_DTYPE)
+
+    lens = {}
+    for k in keys:
+        if k[:2] not in lens:
+            sec = (k[1] - k[0]).total_seconds()
+            lens[k[:2]] = sec if sec > 0 else 1.0
+    window_len_sec = np.fromiter(
+        (lens[k[:2]] for k in keys), dtype=np.float64, count=len(keys)
+    )
 
-            rows_per_call,
-            rows_per_sec,
+    keep = d["calls_delta"] > 0
+    if not keep.all():
+        keys = [k for k, ok in zip(keys, keep.tolist()) if ok]
+        d, window_len_sec = d[keep], window_len_sec[keep]
+
+    calls = d["calls_delta"]
+    total_exec_ms = d["total_exec_time_delta"]
+    rows = d["rows_delta"]
+    shared_hit = d["shared_blks_hit_delta"]
+    shared_read = d["shared_blks_read_delta"]
+    temp_read = d["temp_blks_read_delta"]
+    wal_bytes = d["wal_bytes_delta"]
+    rows_floor = np.maximum(rows, 1)
+
+    values = zip(
+        window_len_sec.tolist(),
+        calls.tolist(),
+        (calls / window_len_sec).tolist(),
+        (total_exec_ms / calls).tolist(),
+        (total_exec_ms / window_len_sec).tolist(),
+        (rows / calls).tolist(),
+        (rows / window_len_sec).tolist(),
+        (shared_read / calls).tolist(),
+        (shared_read / window_len_sec).tolist(),
+        (temp_read / calls).tolist(),
+        (temp_read / window_len_sec).tolist(),
+        (wal_bytes / calls).tolist(),
+        (wal_bytes / window_len_sec).tolist(),
+        _ratio(temp_read, shared_read + temp_read),
+        _ratio(shared_read, shared_read + shared_hit),
+        (total_exec_ms / rows_floor).tolist(),
+        (shared_read / rows_floor).tolist(),
+    )
+    return [k + v for k, v in zip(keys, values)]
 
-            shared_read_per_call,
-            shared_read_per_sec,
 
-            temp_read_per_call,
-            temp_read_per_sec,
+def load_baselines(cur, keys=None, instance_ids=None):
+    """Load baseline states keyed by (instance_id, dbid, userid, queryid).
 
-            wal_bytes_per_call,
-            wal_bytes_per_sec,
+    Loads the given keys, or every key of instance_ids when keys is None.
+    """
+    if keys is None:
+        cur.execute(SELECT_ALL_BASELINES, (list(instance_ids),))
+    else:
+        keys = set(keys)
+        if not keys:
+            return {}
+        cur.execute(SELECT_BASELINES, [list(c) for c in zip(*keys)])
+    return {
+        tuple(r[c] for c in BASELINE_KEY_COLUMNS): {
+            c: r[c] for c in BASELINE_VALUE_COLUMNS
+        }
+        for r in cur.fetchall()
+    }
 
-            temp_share,
-            cache_miss_ratio,
 
-            ms_per_row,
-            read_blks_per_row
-        )
-        VALUES (
-            %s, %s, %s, %s, %s,
-            %s,
+def _zscore(x, mean, var):
+    """Return the clipped z-score of x against a baseline."""
+    sd = math.sqrt(var)
+    if sd > 0:
+        z = (x - mean) / sd
+    elif x == mean:
+        z = 0.0
+    else:
+        z = math.copysign(BASELINE_Z_CLIP, x - mean)
+    return max(-BASELINE_Z_CLIP, min(BASELINE_Z_CLIP, z))
 
-            %s, %s,
 
-            %s, %s,
+def apply_baselines(features, states):
+    """Append z-scores to feature rows and fold the rows into states.
 
-            %s, %s,
+    features are rows in FEATURE_COLUMNS order, ascending by window_end.
+    Each z-score compares a window with the baseline before it; the
+    EWMA mean/variance update is O(1) per window. Windows at or before a
+    state's last_window_end are scored but not folded in again.
+    Returns (rows with Z_COLUMNS appended, keys of updated states).
+    """
+    out = []
+    changed = set()
+    a = BASELINE_ALPHA
+    for f in features:
+        key = f[_BASELINE_KEY]
+        state = states.get(key)
+        if state is None:
+            state = dict.fromkeys(BASELINE_VALUE_COLUMNS, 0.0)
+            state["windows"] = 0
+            state["last_window_end"] = None
+            states[key] = state
+
+        xs = [f[i] for i in _BASELINE_METRIC_IDX]
+        if state["windows"] >= BASELINE_MIN_WINDOWS:
+            z = tuple(
+                _zscore(x, state[f"{m}_mean"], state[f"{m}_var"])
+                for m, x in zip(BASELINE_METRICS, xs)
+            )
+        else:
+            z = (None,) * len(BASELINE_METRICS)
+        out.append(f + z)
+
+        window_end = f[_WINDOW_END]
+        if (
+            state["last_window_end"] is not None
+            and window_end <= state["last_window_end"]
+        ):
+            continue
+        for m, x in zip(BASELINE_METRICS, xs):
+            if state["windows"] == 0:
+                state[f"{m}_mean"], state[f"{m}_var"] = x, 0.0
+                continue
+            diff = x - state[f"{m}_mean"]
+            incr = a * diff
+            state[f"{m}_mean"] += incr
+            state[f"{m}_var"] = (1 - a) * (state[f"{m}_var"] + diff * incr)
+        state["windows"] += 1
+        state["last_window_end"] = window_end
+        changed.add(key)
+    return out, changed
+
+
+def baseline_rows(states, keys):
+    """Build query_baselines rows for the given keys."""
+    return [(*key, *(states[key][c] for c in BASELINE_VALUE_COLUMNS)) for key in keys]
+
+
+def save_baselines(cur, rows):
+    """Upsert baseline states into monitoring.query_baselines."""
+    return copy_rows(
+        cur,
+        "monitoring.query_baselines",
+        BASELINE_COLUMNS,
+        rows,
+        on_conflict="update",
+        conflict_cols=BASELINE_KEY_COLUMNS,
+        update_cols=BASELINE_VALUE_COLUMNS,
+        stage="build_features",
+    )
 
-            %s, %s,
 
-            %s, %s,
+def save_features(cur, features):
+    """Insert feature rows with z-scores into monitoring.features_windows."""
+    if not features:
+        return 0
 
-            %s, %s,
+    return copy_rows(
+        cur,
+        "monitoring.features_windows",
+        FEATURE_COLUMNS + Z_COLUMNS,
+        features,
+        on_conflict="nothing",
+        stage="build_features",
+    )
 
-            %s, %s,
 
-            %s, %s
-        )
-        ON CONFLICT DO NOTHING;
+def build_instance_features(conn, instance_id):
+    """Process deltas of one instance past its watermark, chunk by chunk."""
+    total_inserted = 0
+    with conn.cursor() as cur:
+        state = load_watermark(cur, FEATURES_STAGE, instance_id, SEED_WATERMARK)
+        last_end = state["last_window_end"]
+        conn.commit()
+
+        while True:
+            deltas = load_unprocessed_deltas(
+                cur, instance_id, last_end, max(1, FEATURES_CHUNK_WINDOWS)
+            )
+            if not deltas:
+                break
+
+            features = compute_features_batch(deltas)
+            states = load_baselines(cur, (f[_BASELINE_KEY] for f in features))
+            features, changed = apply_baselines(features, states)
+            total_inserted += save_features(cur, features)
+            save_baselines(cur, baseline_rows(states, changed))
+            last_end = deltas[-1]["window_end"]
+            save_watermark(cur, FEATURES_STAGE, instance_id, last_end)
+            conn.commit()
+    return total_inserted
+
+
+def build_instance_features_sql(cur, instance_id):
+    """Build features of one instance with one SELECT over its deltas.
+
+    Used by build_deltas in fused mode; runs in the caller's transaction.
     """
+    state = load_watermark(cur, FEATURES_STAGE, instance_id, SEED_WATERMARK)
+    cur.execute(
+        FEATURES_SQL,
+        {"instance_id": instance_id, "after": state["last_window_end"]},
+    )
+    features = [tuple(r[c] for c in FEATURE_COLUMNS) for r in cur.fetchall()]
 
-    params = [
-        (
-            f["window_start"],
-            f["window_end"],
-            f["dbid"],
-            f["userid"],
-            f["queryid"],
-            f["window_len_sec"],
-            f["calls_in_window"],
-            f["calls_per_sec"],
-            f["exec_time_per_call_ms"],
-            f["exec_ms_per_sec"],
-            f["rows_per_call"],
-            f["rows_per_sec"],
-            f["shared_read_per_call"],
-            f["shared_read_per_sec"],
-            f["temp_read_per_call"],
-            f["temp_read_per_sec"],
-            f["wal_bytes_per_call"],
-            f["wal_bytes_per_sec"],
-            f["temp_share"],
-            f["cache_miss_ratio"],
-            f["ms_per_row"],
-            f["read_blks_per_row"],
-        )
-        for f in features
-    ]
+    states = load_baselines(cur, (f[_BASELINE_KEY] for f in features))
+    features, changed = apply_baselines(features, states)
+    inserted = save_features(cur, features)
+    save_baselines(cur, baseline_rows(states, changed))
 
-    cur.executemany(query, params)
-    return len(features)
+    cur.execute(MAX_DELTA_WINDOW_END, (instance_id,))
+    last_end = cur.fetchone()["last_end"]
+    if last_end is not None:
+        save_watermark(cur, FEATURES_STAGE, instance_id, last_end)
+    return inserted
 
 
 def build_features():
     """Load deltas, compute features, and persist them."""
     with psycopg.connect(**DB_CONFIG, row_factory=dict_row) as conn:
-        with conn.cursor() as cur:
-            deltas = load_unprocessed_deltas(cur)
-
-            if not deltas:
-                print("No new deltas to process.")
-                return
-
-            features = []
-            for row in deltas:
-                f = compute_features(row)
-                if f is not None:
-                    features.append(f)
+        inserted = 0
+        for instance_id in collect_instance_ids():
+            inserted += build_instance_features(conn, instance_id)
 
-            if not features:
-                print("No valid features computed.")
-                return
+        if not inserted:
+            print("No new deltas to process.")
+            return
 
-            inserted = save_features(cur, features)
-            conn.commit()
-
-            print(
-                f"{datetime.now()}: inserted {inserted} rows into monitoring.features_windows"
-            )
+        print(
+            f"{datetime.now()}: inserted {inserted} rows into monitoring.features_windows"
+        )
 
 
 if __name__ == "__main__":
@@ -1,87 +1,195 @@
 """Build SQL lexical features and update the DB table."""
 
 import hashlib
+import os
 import re
-from datetime import datetime, timezone
-from typing import List
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 
 import psycopg
 from psycopg.rows import dict_row
 
 try:
-    from db_config import DB_CONFIG
+    from db_config import DB_CONFIG, collect_instance_ids
+    from bulk_writer import copy_rows
+    from watermarks import load_watermark, save_watermark
+    from detector_alerts import is_system_query
 except Exception:
-    from scripts.db_config import DB_CONFIG
-
-GET_CANDIDATES = """
-SELECT DISTINCT ON (s.dbid, s.userid, s.queryid)
-    s.dbid,
-    s.userid,
-    s.queryid,
-    s.query_text,
-    s.snapshot_ts
-FROM monitoring.pgss_snapshots_raw s
-WHERE s.query_text IS NOT NULL
-ORDER BY s.dbid, s.userid, s.queryid, s.snapshot_ts DESC;
-"""
+    from scripts.db_config import DB_CONFIG, collect_instance_ids
+    from scripts.bulk_writer import copy_rows
+    from scripts.watermarks import load_watermark, save_watermark
+    from scripts.detector_alerts import is_system_query
+
+LEX_STAGE = "lex"
+
+# In-process LRU of lex features keyed by md5 of the raw query text; 0 disables.
+LEX_CACHE_SIZE = int(os.getenv("LEX_CACHE_SIZE", "10000"))
+# Reuse features already stored for the same text_md5 in query_shape_map
+# (e.g. one ORM query run by many roles) instead of recomputing them.
+LEX_CACHE_PERSISTENT = os.getenv("LEX_CACHE_PERSISTENT", "true").strip().lower() in (
+    "1",
+    "true",
+)
 
+# Processes for lexical extraction of many texts; 0 means os.cpu_count().
+LEX_WORKERS = int(os.getenv("LEX_WORKERS", "0"))
+# Texts sent to a worker per task.
+LEX_CHUNK_SIZE = int(os.getenv("LEX_CHUNK_SIZE", "500"))
+# Fewer texts than this are featurized in-process: starting workers costs more.
+LEX_PARALLEL_MIN = int(os.getenv("LEX_PARALLEL_MIN", "2000"))
 
-GET_EXISTING_MD5 = """
+# Keys seen in snapshots since the watermark whose text changed or that have
+# no lex row yet; rows without text_md5 (legacy inline texts) are compared by
+# query_md5 in Python.
+GET_CANDIDATES = """
 SELECT
-    dbid, userid, queryid, query_md5
-FROM monitoring.query_lex_features;
-"""
-
-UPSERT_LEX = """
-INSERT INTO monitoring.query_lex_features (
-    dbid, userid, queryid,
-    query_text, query_md5,
-    query_len_chars, query_len_norm_chars, num_tokens,
-    num_joins, num_where, num_group_by, num_order_by, num_having,
-    num_union, num_subqueries, num_cte,
-    has_write, has_ddl, has_tx,
-    num_case, num_functions,
-    last_seen_ts
-)
-VALUES (
-    %(dbid)s, %(userid)s, %(queryid)s,
-    %(query_text)s, %(query_md5)s,
-    %(query_len_chars)s, %(query_len_norm_chars)s, %(num_tokens)s,
-    %(num_joins)s, %(num_where)s, %(num_group_by)s, %(num_order_by)s, %(num_having)s,
-    %(num_union)s, %(num_subqueries)s, %(num_cte)s,
-    %(has_write)s, %(has_ddl)s, %(has_tx)s,
-    %(num_case)s, %(num_functions)s,
-    %(last_seen_ts)s
+    c.instance_id,
+    c.dbid,
+    c.userid,
+    c.queryid,
+    c.text_md5,
+    COALESCE(t.query_text, c.query_text) AS query_text,
+    c.snapshot_ts,
+    l.query_md5 AS old_query_md5
+FROM (
+    SELECT DISTINCT ON (s.dbid, s.userid, s.queryid)
+        s.instance_id,
+        s.dbid,
+        s.userid,
+        s.queryid,
+        s.text_md5,
+        s.query_text,
+        s.snapshot_ts
+    FROM monitoring.pgss_snapshots_raw s
+    WHERE s.instance_id = %(instance_id)s
+      AND s.snapshot_ts > COALESCE(%(after)s::timestamptz, '-infinity')
+      AND s.snapshot_ts <= %(until)s
+      AND (s.text_md5 IS NOT NULL OR s.query_text IS NOT NULL)
+    ORDER BY s.dbid, s.userid, s.queryid, s.snapshot_ts DESC
+) c
+LEFT JOIN monitoring.query_shape_map l
+  ON l.instance_id = c.instance_id
+ AND l.dbid = c.dbid AND l.userid = c.userid AND l.queryid = c.queryid
+LEFT JOIN monitoring.query_texts t
+  ON t.queryid = c.queryid AND t.text_md5 = c.text_md5
+WHERE (
+    l.queryid IS NULL
+    OR c.text_md5 IS NULL
+    OR l.text_md5 IS DISTINCT FROM c.text_md5
 )
-ON CONFLICT (dbid, userid, queryid)
-DO UPDATE SET
-    query_text = EXCLUDED.query_text,
-    query_md5 = EXCLUDED.query_md5,
-
-    query_len_chars = EXCLUDED.query_len_chars,
-    query_len_norm_chars = EXCLUDED.query_len_norm_chars,
-    num_tokens = EXCLUDED.num_tokens,
+  AND COALESCE(t.query_text, c.query_text) IS NOT NULL;
+"""
 
-    num_joins = EXCLUDED.num_joins,
-    num_where = EXCLUDED.num_where,
-    num_group_by = EXCLUDED.num_group_by,
-    num_order_by = EXCLUDED.num_order_by,
-    num_having = EXCLUDED.num_having,
+# Bulk last_seen_ts bump for every key seen since the watermark.
+TOUCH_LAST_SEEN = """
+UPDATE monitoring.query_shape_map l
+SET last_seen_ts = s.last_ts
+FROM (
+    SELECT dbid, userid, queryid, max(snapshot_ts) AS last_ts
+    FROM monitoring.pgss_snapshots_raw
+    WHERE instance_id = %(instance_id)s
+      AND snapshot_ts > COALESCE(%(after)s::timestamptz, '-infinity')
+      AND snapshot_ts <= %(until)s
+    GROUP BY dbid, userid, queryid
+) s
+WHERE l.instance_id = %(instance_id)s
+  AND l.dbid = s.dbid
+  AND l.userid = s.userid
+  AND l.queryid = s.queryid
+  AND l.last_seen_ts < s.last_ts;
+"""
 
-    num_union = EXCLUDED.num_union,
-    num_subqueries = EXCLUDED.num_subqueries,
-    num_cte = EXCLUDED.num_cte,
+SELECT_LEX_BY_TEXT_MD5 = """
+SELECT DISTINCT ON (text_md5) *
+FROM monitoring.query_lex_features
+WHERE text_md5 = ANY(%s)
+  AND is_system IS NOT NULL
+ORDER BY text_md5, last_seen_ts DESC;
+"""
 
-    has_write = EXCLUDED.has_write,
-    has_ddl = EXCLUDED.has_ddl,
-    has_tx = EXCLUDED.has_tx,
+# Keys stored before is_system existed.
+SELECT_UNCLASSIFIED = """
+SELECT
+    m.instance_id,
+    m.dbid,
+    m.userid,
+    m.queryid,
+    COALESCE(t.query_text, m.query_text) AS query_text
+FROM monitoring.query_shape_map m
+LEFT JOIN monitoring.query_texts t
+  ON t.queryid = m.queryid AND t.text_md5 = m.text_md5
+WHERE m.is_system IS NULL;
+"""
 
-    num_case = EXCLUDED.num_case,
-    num_functions = EXCLUDED.num_functions,
+SET_IS_SYSTEM = """
+UPDATE monitoring.query_shape_map m
+SET is_system = k.is_system
+FROM unnest(%s::text[], %s::oid[], %s::oid[], %s::bigint[], %s::boolean[])
+  AS k (instance_id, dbid, userid, queryid, is_system)
+WHERE m.instance_id = k.instance_id
+  AND m.dbid = k.dbid
+  AND m.userid = k.userid
+  AND m.queryid = k.queryid;
+"""
 
-    last_seen_ts = EXCLUDED.last_seen_ts;
+MAX_SNAPSHOT_TS = """
+SELECT max(snapshot_ts) AS until
+FROM monitoring.pgss_snapshots_raw
+WHERE instance_id = %s;
 """
 
+LEX_KEY_COLUMNS = ["instance_id", "dbid", "userid", "queryid"]
+
+LEX_VALUE_COLUMNS = [
+    "query_text",
+    "text_md5",
+    "query_md5",
+    "query_len_chars",
+    "is_system",
+    "query_len_norm_chars",
+    "num_tokens",
+    "num_joins",
+    "num_where",
+    "num_group_by",
+    "num_order_by",
+    "num_having",
+    "num_union",
+    "num_subqueries",
+    "num_cte",
+    "has_write",
+    "has_ddl",
+    "has_tx",
+    "num_case",
+    "num_functions",
+    "last_seen_ts",
+]
+
+# Columns that depend only on the query text, i.e. what the lex cache holds.
+LEX_FEATURE_COLUMNS = [
+    c for c in LEX_VALUE_COLUMNS if c not in ("query_text", "text_md5", "last_seen_ts")
+]
+
+# Lex features that depend only on the normalized text, stored per query_md5.
+SHAPE_COLUMNS = [
+    c
+    for c in LEX_FEATURE_COLUMNS
+    if c not in ("query_md5", "query_len_chars", "is_system")
+]
+
+SHAPE_MAP_VALUE_COLUMNS = [
+    "query_md5",
+    "query_text",
+    "text_md5",
+    "query_len_chars",
+    "is_system",
+    "last_seen_ts",
+]
+
+# text md5 -> {LEX_FEATURE_COLUMNS}, least recently used first.
+_lex_cache = OrderedDict()
+LEX_CACHE_STATS = {"hits": 0, "misses": 0, "loaded": 0}
+
 
 _re_block_comment = re.compile(r"/\*.*?\*/", re.DOTALL)
 _re_line_comment = re.compile(r"--[^\n]*")
@@ -90,51 +198,18 @@ _re_single_quoted = re.compile(r"'([^']|'')*'")
 _re_number = re.compile(r"\b\d+(\.\d+)?\b")
 _re_ws = re.compile(r"\s+")
 _re_token = re.compile(r"[a-z_]+|\d+|<=|>=|<>|!=|[()*,;=]")
-
-
-def normalize_sql(sql):
-    """Normalize SQL for stable comparison and tokenization.
-
-    Removes comments, replaces literals and numbers, lowercases, and
-    collapses whitespace.
-    """
-    s = sql
-    s = _re_block_comment.sub(" ", s)
-    s = _re_line_comment.sub(" ", s)
-    s = _re_dollar_quoted.sub(" ?", s)
-    s = _re_single_quoted.sub(" ?", s)
-    s = _re_number.sub(" 0 ", s)
-    s = s.lower()
-    s = _re_ws.sub(" ", s).strip()
-    return s
-
-
-def md5_text(s):
-    """Return MD5 hash of text as a hex string."""
-    return hashlib.md5(s.encode("utf-8", errors="ignore")).hexdigest()
-
-
-def count_kw(norm, kw):
-    """Count keyword occurrences as standalone tokens."""
-    return len(re.findall(rf"\b{re.escape(kw)}\b", norm))
-
-
-def has_any(norm: str, kws: List[str]) -> bool:
-    """Return True if any keyword is present."""
-    return any(re.search(rf"\b{re.escape(k)}\b", norm) for k in kws)
-
-
-def count_subqueries(norm: str) -> int:
-    """Count subqueries matching the '( select' pattern."""
-    return len(re.findall(r"\(\s*select\b", norm))
-
-
-def count_functions(norm):
-    """Count function calls using a simple pattern.
-
-    Excludes SQL keywords to avoid inflating the count.
-    """
-    blacklist = {
+# One match per word, operator or counted punctuation, paired with the next
+# token when that one is "(", "by" or "select" (the only pairs counted).
+_re_lex = re.compile(r"(\w+|<=|>=|<>|!=|[()*,;=]) ?(?=(\(|by\b|select\b)?)")
+_re_ident = re.compile(r"[a-z_][a-z0-9_]*")
+
+WRITE_KEYWORDS = ["insert", "update", "delete", "merge"]
+DDL_KEYWORDS = ["create", "alter", "drop", "truncate"]
+TX_KEYWORDS = ["begin", "commit", "rollback"]
+
+# SQL keywords followed by "(" that are not function calls.
+NOT_FUNCTIONS = frozenset(
+    [
         "select",
         "from",
         "where",
@@ -166,111 +241,308 @@ def count_functions(norm):
         "then",
         "else",
         "end",
-    }
-    candidates = re.findall(r"\b([a-z_][a-z0-9_]*)\s*\(", norm)
-    return sum(1 for w in candidates if w not in blacklist)
+    ]
+)
 
 
-def compute_lex_features(query_text):
-    """Compute lexical features for a query text."""
-    norm = normalize_sql(query_text)
+def normalize_sql(sql):
+    """Normalize SQL for stable comparison and tokenization.
+
+    Removes comments, replaces literals and numbers, lowercases, and
+    collapses whitespace.
+    """
+    s = sql
+    # The passes are order-dependent (a "--" inside a literal is still a
+    # comment), so they stay separate; absent markers skip the pass.
+    if "/*" in s:
+        s = _re_block_comment.sub(" ", s)
+    if "--" in s:
+        s = _re_line_comment.sub(" ", s)
+    if "$$" in s:
+        s = _re_dollar_quoted.sub(" ?", s)
+    if "'" in s:
+        s = _re_single_quoted.sub(" ?", s)
+    s = _re_number.sub(" 0 ", s)
+    s = s.lower()
+    s = _re_ws.sub(" ", s).strip()
+    return s
+
 
-    tokens = _re_token.findall(norm)
+def md5_text(s):
+    """Return MD5 hash of text as a hex string."""
+    return hashlib.md5(s.encode("utf-8", errors="ignore")).hexdigest()
+
+
+def compute_lex_features(query_text):
+    """Compute lexical features for a query text.
 
-    num_joins = count_kw(norm, "join")
-    num_where = count_kw(norm, "where")
-    num_group_by = len(re.findall(r"\bgroup\s+by\b", norm))
-    num_order_by = len(re.findall(r"\border\s+by\b", norm))
-    num_having = count_kw(norm, "having")
-    num_union = count_kw(norm, "union")
-    num_cte = 1 if norm.startswith("with ") else 0
-    num_subq = count_subqueries(norm)
+    The normalized text is tokenized in a single regex pass that tags each
+    token with the one following it; all counts come from one tally of
+    those pairs.
+    """
+    norm = normalize_sql(query_text)
 
-    has_write = has_any(norm, ["insert", "update", "delete", "merge"])
-    has_ddl = has_any(norm, ["create", "alter", "drop", "truncate"])
-    has_tx = has_any(norm, ["begin", "commit", "rollback"])
+    pairs = Counter(_re_lex.findall(norm))
+    counts = Counter()
+    for (token, _), n in pairs.items():
+        counts[token] += n
 
-    num_case = count_kw(norm, "case")
-    num_functions = count_functions(norm)
+    num_functions = sum(
+        n
+        for (name, nxt), n in pairs.items()
+        if nxt == "("
+        and name not in NOT_FUNCTIONS
+        and _re_ident.fullmatch(name) is not None
+    )
 
     return {
         "query_len_chars": len(query_text),
+        "is_system": is_system_query(query_text),
         "query_len_norm_chars": len(norm),
-        "num_tokens": len(tokens),
-        "num_joins": num_joins,
-        "num_where": num_where,
-        "num_group_by": num_group_by,
-        "num_order_by": num_order_by,
-        "num_having": num_having,
-        "num_union": num_union,
-        "num_subqueries": num_subq,
-        "num_cte": num_cte,
-        "has_write": has_write,
-        "has_ddl": has_ddl,
-        "has_tx": has_tx,
-        "num_case": num_case,
+        # A lex word such as "col_1" is two _re_token tokens.
+        "num_tokens": sum(len(_re_token.findall(t)) * n for t, n in counts.items()),
+        "num_joins": counts["join"],
+        "num_where": counts["where"],
+        "num_group_by": pairs[("group", "by")],
+        "num_order_by": pairs[("order", "by")],
+        "num_having": counts["having"],
+        "num_union": counts["union"],
+        "num_subqueries": pairs[("(", "select")],
+        "num_cte": 1 if norm.startswith("with ") else 0,
+        "has_write": any(counts[k] for k in WRITE_KEYWORDS),
+        "has_ddl": any(counts[k] for k in DDL_KEYWORDS),
+        "has_tx": any(counts[k] for k in TX_KEYWORDS),
+        "num_case": counts["case"],
         "num_functions": num_functions,
         "query_md5": md5_text(norm),
         "query_text": query_text,
     }
 
 
-def load_existing_md5(cur):
-    """Load stored md5 values keyed by (dbid, userid, queryid)."""
-    cur.execute(GET_EXISTING_MD5)
-    rows = cur.fetchall()
-    return {(r["dbid"], r["userid"], r["queryid"]): r["query_md5"] for r in rows}
+def remember_lex_features(text_md5, feats):
+    """Put lex features of a text into the LRU cache."""
+    if LEX_CACHE_SIZE <= 0 or text_md5 is None:
+        return
+    _lex_cache[text_md5] = {c: feats[c] for c in LEX_FEATURE_COLUMNS}
+    _lex_cache.move_to_end(text_md5)
+    while len(_lex_cache) > LEX_CACHE_SIZE:
+        _lex_cache.popitem(last=False)
 
 
-def load_candidates(cur):
-    """Load candidate queries from recent pgss snapshots."""
-    cur.execute(GET_CANDIDATES)
-    return cur.fetchall()
+def _lex_tuples(texts):
+    """Return LEX_FEATURE_COLUMNS tuples for texts (runs in pool workers)."""
+    out = []
+    for text in texts:
+        feats = compute_lex_features(text)
+        out.append(tuple(feats[c] for c in LEX_FEATURE_COLUMNS))
+    return out
 
 
-def build_lex_features():
-    """Compute features and upsert monitoring.query_lex_features."""
-    with psycopg.connect(**DB_CONFIG, row_factory=dict_row) as conn:
-        with conn.cursor() as cur:
-            existing = load_existing_md5(cur)
-            candidates = load_candidates(cur)
-
-            if not candidates:
-                print("No candidates with query_text found.")
-                return
+def compute_lex_many(texts):
+    """Featurize texts, sharding them over a process pool when there are many.
 
-            now_ts = datetime.now(timezone.utc)
-            to_upsert = []
+    Workers get only the texts and return compact tuples; below
+    LEX_PARALLEL_MIN texts or with one worker everything stays in-process.
+    """
+    workers = LEX_WORKERS or os.cpu_count() or 1
+    chunk = max(1, LEX_CHUNK_SIZE)
+    if workers <= 1 or len(texts) < max(LEX_PARALLEL_MIN, 2):
+        rows = _lex_tuples(texts)
+    else:
+        chunks = [texts[i : i + chunk] for i in range(0, len(texts), chunk)]
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+            rows = [t for part in pool.map(_lex_tuples, chunks) for t in part]
+    return [dict(zip(LEX_FEATURE_COLUMNS, t)) for t in rows]
+
+
+def lex_features_many(items):
+    """Return lex features for (query_text, text_md5) pairs.
+
+    Texts are looked up by raw text md5 first; each distinct uncached text
+    is computed once, all of them together via compute_lex_many.
+    """
+    keys = [text_md5 or md5_text(text) for text, text_md5 in items]
+    found = {}
+    todo = {}
+    for key, (text, _) in zip(keys, items):
+        if key in found or key in todo:
+            continue
+        feats = _lex_cache.get(key)
+        if feats is None:
+            todo[key] = text
+        else:
+            _lex_cache.move_to_end(key)
+            found[key] = feats
+
+    if todo:
+        for key, feats in zip(todo, compute_lex_many(list(todo.values()))):
+            found[key] = feats
+            remember_lex_features(key, feats)
+
+    LEX_CACHE_STATS["misses"] += len(todo)
+    LEX_CACHE_STATS["hits"] += len(items) - len(todo)
+    return [{**found[key], "query_text": text} for key, (text, _) in zip(keys, items)]
+
+
+def cached_lex_features(query_text, text_md5=None):
+    """Return compute_lex_features(query_text), memoized by raw text md5.
+
+    text_md5 is md5 of the raw text as stored in query_texts; it is
+    computed here when not known, which is still far cheaper than
+    normalizing the text.
+    """
+    return lex_features_many([(query_text, text_md5)])[0]
 
-            for row in candidates:
-                key = (row["dbid"], row["userid"], row["queryid"])
-                query_text = row["query_text"]
 
-                feats = compute_lex_features(query_text)
+def preload_lex_cache(cur, text_md5s):
+    """Load stored features of texts missing from the LRU cache."""
+    if not LEX_CACHE_PERSISTENT or LEX_CACHE_SIZE <= 0:
+        return 0
+    missing = list({m for m in text_md5s if m is not None} - _lex_cache.keys())
+    if not missing:
+        return 0
+    cur.execute(SELECT_LEX_BY_TEXT_MD5, (missing,))
+    rows = cur.fetchall()
+    for r in rows:
+        remember_lex_features(r["text_md5"], r)
+    LEX_CACHE_STATS["loaded"] += len(rows)
+    return len(rows)
+
+
+def lex_cache_summary():
+    """Return hit/miss counters of the lex cache as a log fragment."""
+    s = LEX_CACHE_STATS
+    return (
+        f"lex cache: {s['hits']} hits, {s['misses']} misses, "
+        f"{s['loaded']} loaded, {len(_lex_cache)} cached"
+    )
+
+
+def load_candidates(cur, instance_id, after, until):
+    """Load new or changed keys from snapshots in (after, until]."""
+    cur.execute(
+        GET_CANDIDATES, {"instance_id": instance_id, "after": after, "until": until}
+    )
+    return cur.fetchall()
 
-                old_md5 = existing.get(key)
-                if old_md5 is not None and old_md5 == feats["query_md5"]:
-                    continue
 
-                to_upsert.append(
-                    {
-                        "dbid": row["dbid"],
-                        "userid": row["userid"],
-                        "queryid": row["queryid"],
-                        "last_seen_ts": now_ts,
-                        **feats,
-                    }
-                )
+def touch_last_seen(cur, instance_id, after, until):
+    """Move last_seen_ts of keys seen in (after, until] forward in bulk."""
+    cur.execute(
+        TOUCH_LAST_SEEN, {"instance_id": instance_id, "after": after, "until": until}
+    )
+    return cur.rowcount
+
+
+def save_lex_rows(cur, rows, stage="build_lex_features"):
+    """Write lex rows: new shapes into query_shapes, keys into query_shape_map."""
+    shapes = {r["query_md5"]: r for r in rows}
+    copy_rows(
+        cur,
+        "monitoring.query_shapes",
+        ["query_md5"] + SHAPE_COLUMNS,
+        list(shapes.values()),
+        on_conflict="nothing",
+        conflict_cols=["query_md5"],
+        stage=stage,
+    )
+    return copy_rows(
+        cur,
+        "monitoring.query_shape_map",
+        LEX_KEY_COLUMNS + SHAPE_MAP_VALUE_COLUMNS,
+        rows,
+        on_conflict="update",
+        conflict_cols=LEX_KEY_COLUMNS,
+        update_cols=SHAPE_MAP_VALUE_COLUMNS,
+        stage=stage,
+    )
+
+
+def classify_stored_keys(cur):
+    """Fill is_system of keys stored before the column existed."""
+    cur.execute(SELECT_UNCLASSIFIED)
+    rows = cur.fetchall()
+    if not rows:
+        return 0
+    keys = [[r[c] for r in rows] for c in LEX_KEY_COLUMNS]
+    flags = [is_system_query(r["query_text"]) for r in rows]
+    cur.execute(SET_IS_SYSTEM, keys + [flags])
+    return len(rows)
+
+
+def build_instance_lex_features(cur, instance_id):
+    """Featurize keys of one instance that are new or changed since the watermark."""
+    state = load_watermark(cur, LEX_STAGE, instance_id)
+    after = state["last_window_end"]
+    cur.execute(MAX_SNAPSHOT_TS, (instance_id,))
+    until = cur.fetchone()["until"]
+    if until is None or (after is not None and until <= after):
+        return 0, 0
+
+    touched = touch_last_seen(cur, instance_id, after, until)
+
+    candidates = load_candidates(cur, instance_id, after, until)
+    preload_lex_cache(cur, [row["text_md5"] for row in candidates])
+
+    all_feats = lex_features_many(
+        [(row["query_text"], row["text_md5"]) for row in candidates]
+    )
+
+    to_upsert = []
+    for row, feats in zip(candidates, all_feats):
+        query_text = row["query_text"]
+
+        if row["old_query_md5"] == feats["query_md5"] and row["text_md5"] is None:
+            continue
+
+        to_upsert.append(
+            {
+                "instance_id": row["instance_id"],
+                "dbid": row["dbid"],
+                "userid": row["userid"],
+                "queryid": row["queryid"],
+                "last_seen_ts": row["snapshot_ts"],
+                **feats,
+                # The text itself lives in monitoring.query_texts.
+                "query_text": None if row["text_md5"] else query_text,
+                "text_md5": row["text_md5"],
+            }
+        )
+
+    upserted = 0
+    if to_upsert:
+        upserted = save_lex_rows(cur, to_upsert)
+    save_watermark(cur, LEX_STAGE, instance_id, until)
+    return upserted, touched
 
-            if not to_upsert:
-                print("Lex features are up-to-date (nothing to insert/update).")
-                return
 
-            cur.executemany(UPSERT_LEX, to_upsert)
+def build_lex_features():
+    """Compute features and upsert query_shapes and query_shape_map."""
+    with psycopg.connect(**DB_CONFIG, row_factory=dict_row) as conn:
+        with conn.cursor() as cur:
+            classified = classify_stored_keys(cur)
             conn.commit()
+            if classified:
+                print(f"{datetime.now()}: classified is_system of {classified} keys")
+
+            upserted = touched = 0
+            for instance_id in collect_instance_ids():
+                u, t = build_instance_lex_features(cur, instance_id)
+                conn.commit()
+                upserted += u
+                touched += t
+
+            if not upserted:
+                print(
+                    f"Lex features are up-to-date (nothing to insert/update, "
+                    f"{touched} last_seen_ts bumped)."
+                )
+                return
 
             print(
-                f"{datetime.now()}: upserted {len(to_upsert)} rows into monitoring.query_lex_features"
+                f"{datetime.now()}: upserted {upserted} rows into "
+                f"monitoring.query_shape_map ({touched} last_seen_ts bumped, "
+                f"{lex_cache_summary()})"
             )
 
 
@@ -0,0 +1,156 @@
+"""Roll pgss deltas up into 1 min / 15 min / 1 h buckets."""
+
+from datetime import datetime
+
+import psycopg
+from psycopg import sql
+from psycopg.rows import dict_row
+
+try:
+    from db_config import DB_CONFIG, collect_instance_ids
+    from watermarks import load_watermark, save_watermark
+except Exception:
+    from scripts.db_config import DB_CONFIG, collect_instance_ids
+    from scripts.watermarks import load_watermark, save_watermark
+
+# (resolution, bucket seconds, source table); each level sums the previous one.
+ROLLUPS = [
+    ("1m", 60, "pgss_deltas"),
+    ("15m", 15 * 60, "pgss_rollup_1m"),
+    ("1h", 60 * 60, "pgss_rollup_15m"),
+]
+
+ROLLUP_SUM_COLUMNS = [
+    "calls_delta",
+    "total_exec_time_delta",
+    "rows_delta",
+    "shared_blks_hit_delta",
+    "shared_blks_read_delta",
+    "temp_blks_read_delta",
+    "temp_blks_written_delta",
+    "wal_bytes_delta",
+]
+
+# A bucket is complete once the source has a window starting after it, so
+# only buckets before the one holding the latest window_start are rolled up.
+LATEST_BUCKET = """
+SELECT to_timestamp(
+    floor(extract(epoch FROM max(window_start)) / %(width)s) * %(width)s
+) AS until
+FROM {source}
+WHERE instance_id = %(instance_id)s;
+"""
+
+INSERT_ROLLUP = """
+INSERT INTO {target} (
+    window_start, window_end, instance_id, dbid, userid, queryid,
+    windows, window_len_sec, {sums}
+)
+SELECT
+    b.bucket,
+    b.bucket + make_interval(secs => %(width)s),
+    s.instance_id,
+    s.dbid,
+    s.userid,
+    s.queryid,
+    sum({windows}),
+    sum({window_len}),
+    {sum_exprs}
+FROM {source} s
+CROSS JOIN LATERAL (
+    SELECT to_timestamp(
+        floor(extract(epoch FROM s.window_start) / %(width)s) * %(width)s
+    ) AS bucket
+) b
+WHERE s.instance_id = %(instance_id)s
+  AND s.window_start >= COALESCE(%(after)s::timestamptz, '-infinity')
+  AND s.window_start < %(until)s
+GROUP BY b.bucket, s.instance_id, s.dbid, s.userid, s.queryid
+ON CONFLICT DO NOTHING;
+"""
+
+SEED_WATERMARK = """
+SELECT max(window_end) AS last_end
+FROM {target}
+WHERE instance_id = %s;
+"""
+
+
+def rollup_stage(resolution):
+    """Return the pipeline_watermarks stage name of a resolution."""
+    return f"rollup_{resolution}"
+
+
+def rollup_queries(resolution, source):
+    """Build (latest bucket, insert, seed) queries for one resolution."""
+    target = sql.Identifier("monitoring", f"pgss_rollup_{resolution}")
+    src = sql.Identifier("monitoring", source)
+    if source == "pgss_deltas":
+        windows = sql.SQL("1")
+        window_len = sql.SQL("extract(epoch FROM s.window_end - s.window_start)")
+    else:
+        windows = sql.SQL("s.windows")
+        window_len = sql.SQL("s.window_len_sec")
+
+    insert = sql.SQL(INSERT_ROLLUP).format(
+        target=target,
+        source=src,
+        sums=sql.SQL(", ").join(map(sql.Identifier, ROLLUP_SUM_COLUMNS)),
+        windows=windows,
+        window_len=window_len,
+        sum_exprs=sql.SQL(", ").join(
+            sql.SQL("sum(s.{})").format(sql.Identifier(c)) for c in ROLLUP_SUM_COLUMNS
+        ),
+    )
+    latest = sql.SQL(LATEST_BUCKET).format(source=src)
+    seed = sql.SQL(SEED_WATERMARK).format(target=target)
+    return latest, insert, seed
+
+
+def build_instance_rollup(cur, instance_id, resolution, width, source):
+    """Roll up complete buckets of one instance past its watermark."""
+    latest, insert, seed = rollup_queries(resolution, source)
+    stage = rollup_stage(resolution)
+
+    state = load_watermark(cur, stage, instance_id, seed)
+    cur.execute(latest, {"width": width, "instance_id": instance_id})
+    until = cur.fetchone()["until"]
+    if until is None or (
+        state["last_window_end"] is not None and until <= state["last_window_end"]
+    ):
+        return 0
+
+    cur.execute(
+        insert,
+        {
+            "width": width,
+            "instance_id": instance_id,
+            "after": state["last_window_end"],
+            "until": until,
+        },
+    )
+    inserted = cur.rowcount
+    save_watermark(cur, stage, instance_id, until)
+    return inserted
+
+
+def build_rollups():
+    """Update every rollup resolution for all instances."""
+    with psycopg.connect(**DB_CONFIG, row_factory=dict_row) as conn:
+        with conn.cursor() as cur:
+            for resolution, width, source in ROLLUPS:
+                inserted = 0
+                for instance_id in collect_instance_ids():
+                    inserted += build_instance_rollup(
+                        cur, instance_id, resolution, width, source
+                    )
+                conn.commit()
+                if inserted:
+                    print(
+                        f"{datetime.now()}: inserted {inserted} rows into "
+                        f"monitoring.pgss_rollup_{resolution}"
+                    )
+
+
+if __name__ == "__main__":
+    build_rollups()
@@ -0,0 +1,165 @@
+"""COPY-based bulk writer shared by pipeline stages."""
+
+import time
+from collections.abc import Mapping
+from datetime import datetime
+
+from psycopg import sql
+
+
+def _table_ident(table: str) -> sql.Identifier:
+    """Return a quoted identifier for a 'schema.table' name."""
+    return sql.Identifier(*table.split("."))
+
+
+def _staging_ident(table: str) -> sql.Identifier:
+    """Return the temp staging table identifier for a target table."""
+    return sql.Identifier(f"_stage_{table.split('.')[-1]}")
+
+
+def _row_values(row, columns):
+    """Return row values in column order for dicts or sequences."""
+    if isinstance(row, Mapping):
+        return tuple(row[c] for c in columns)
+    return row
+
+
+def _copy_into(cur, target, columns, rows) -> int:
+    """Stream rows into target with COPY FROM STDIN."""
+    query = sql.SQL("COPY {} ({}) FROM STDIN").format(
+        target, sql.SQL(", ").join(map(sql.Identifier, columns))
+    )
+    n = 0
+    with cur.copy(query) as copy:
+        for row in rows:
+            copy.write_row(_row_values(row, columns))
+            n += 1
+    return n
+
+
+def _merge_query(table, columns, on_conflict, conflict_cols, update_cols):
+    """Build INSERT ... SELECT from staging with the conflict clause."""
+    cols = sql.SQL(", ").join(map(sql.Identifier, columns))
+    query = sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {}").format(
+        _table_ident(table), cols, cols, _staging_ident(table)
+    )
+    if on_conflict == "nothing":
+        target = sql.SQL("")
+        if conflict_cols:
+            target = sql.SQL(" ({})").format(
+                sql.SQL(", ").join(map(sql.Identifier, conflict_cols))
+            )
+        return query + sql.SQL(" ON CONFLICT{} DO NOTHING").format(target)
+    if on_conflict == "update":
+        sets = sql.SQL(", ").join(
+            sql.SQL("{} = EXCLUDED.{}").format(sql.Identifier(c), sql.Identifier(c))
+            for c in update_cols
+        )
+        return query + sql.SQL(" ON CONFLICT ({}) DO UPDATE SET {}").format(
+            sql.SQL(", ").join(map(sql.Identifier, conflict_cols)), sets
+        )
+    return query
+
+
+def _staging_query(table, columns):
+    """Build CREATE TEMP TABLE for the staging copy of table."""
+    return sql.SQL(
+        "CREATE TEMP TABLE IF NOT EXISTS {} ON COMMIT DELETE ROWS AS "
+        "SELECT {} FROM {} WITH NO DATA"
+    ).format(
+        _staging_ident(table),
+        sql.SQL(", ").join(map(sql.Identifier, columns)),
+        _table_ident(table),
+    )
+
+
+def _report(stage, table, written, started):
+    """Print the rows/s line for a finished write."""
+    elapsed = time.perf_counter() - started
+    if written:
+        rate = written / elapsed if elapsed > 0 else float(written)
+        print(
+            f"{datetime.now()}: {stage or table}: wrote {written} rows into {table} "
+            f"in {elapsed:.3f}s ({rate:.0f} rows/s)"
+        )
+
+
+def copy_rows(
+    cur,
+    table: str,
+    columns,
+    rows,
+    on_conflict=None,
+    conflict_cols=(),
+    update_cols=(),
+    stage=None,
+) -> int:
+    """Bulk write rows into table and return the number of rows written.
+
+    Rows are dicts keyed by column or sequences in column order. Without
+    on_conflict rows are copied straight into the table. With
+    on_conflict="nothing"/"update" rows are copied into a temp staging
+    table and merged with a single INSERT ... SELECT ... ON CONFLICT.
+    """
+    started = time.perf_counter()
+
+    if on_conflict is None:
+        written = _copy_into(cur, _table_ident(table), columns, rows)
+    else:
+        staging = _staging_ident(table)
+        cur.execute(_staging_query(table, columns))
+        copied = _copy_into(cur, staging, columns, rows)
+        written = 0
+        if copied:
+            cur.execute(
+                _merge_query(table, columns, on_conflict, conflict_cols, update_cols)
+            )
+            written = cur.rowcount
+            cur.execute(sql.SQL("TRUNCATE {}").format(staging))
+
+    _report(stage, table, written, started)
+    return written
+
+
+async def _acopy_into(cur, target, columns, rows) -> int:
+    """Async variant of _copy_into."""
+    query = sql.SQL("COPY {} ({}) FROM STDIN").format(
+        target, sql.SQL(", ").join(map(sql.Identifier, columns))
+    )
+    n = 0
+    async with cur.copy(query) as copy:
+        for row in rows:
+            await copy.write_row(_row_values(row, columns))
+            n += 1
+    return n
+
+
+async def acopy_rows(
+    cur,
+    table: str,
+    columns,
+    rows,
+    on_conflict=None,
+    conflict_cols=(),
+    update_cols=(),
+    stage=None,
+) -> int:
+    """Async variant of copy_rows for psycopg.AsyncCursor."""
+    started = time.perf_counter()
+
+    if on_conflict is None:
+        written = await _acopy_into(cur, _table_ident(table), columns, rows)
+    else:
+        staging = _staging_ident(table)
+        await cur.execute(_staging_query(table, columns))
+        copied = await _acopy_into(cur, staging, columns, rows)
+        written = 0
+        if copied:
+            await cur.execute(
+                _merge_query(table, columns, on_conflict, conflict_cols, update_cols)
+            )
+            written = cur.rowcount
+            await cur.execute(sql.SQL("TRUNCATE {}").format(staging))
+
+    _report(stage, table, written, started)
+    return written
@@ -1,13 +1,38 @@
 """Collect pg_stat_statements snapshots into the raw table."""
 
+import asyncio
+import hashlib
+import os
 from datetime import datetime, timezone
 
 import psycopg
+from psycopg.rows import dict_row, tuple_row
 
 try:
-    from db_config import DB_CONFIG
+    from db_config import (
+        DB_CONFIG,
+        SOURCE_DB_CONFIG,
+        INSTANCE_ID,
+        load_collect_targets,
+    )
+    from bulk_writer import copy_rows, acopy_rows
 except Exception:
-    from scripts.db_config import DB_CONFIG
+    from scripts.db_config import (
+        DB_CONFIG,
+        SOURCE_DB_CONFIG,
+        INSTANCE_ID,
+        load_collect_targets,
+    )
+    from scripts.bulk_writer import copy_rows, acopy_rows
+
+# auto: server-side when the source and monitoring DB are the same server.
+COLLECT_MODE = (os.getenv("COLLECT_MODE", "auto") or "auto").strip().lower()
+
+# Write only entries whose calls changed since the previous snapshot.
+SNAPSHOT_SPARSE = os.getenv("SNAPSHOT_SPARSE", "0").strip().lower() in ("1", "true")
+
+COLLECT_CONCURRENCY = int(os.getenv("COLLECT_CONCURRENCY", "8"))
+COLLECT_TARGET_TIMEOUT = float(os.getenv("COLLECT_TARGET_TIMEOUT", "10"))
 
 SELECT_PGSS = """
 SELECT
@@ -21,67 +46,348 @@ SELECT
     shared_blks_read,
     temp_blks_read,
     temp_blks_written,
-    wal_bytes,
+    wal_bytes
+FROM pg_stat_statements(showtext := false);
+"""
+
+SELECT_PGSS_TEXTS = """
+SELECT DISTINCT ON (queryid)
+    queryid,
     query AS query_text
-FROM pg_stat_statements;
+FROM pg_stat_statements(showtext := true)
+WHERE queryid = ANY(%s)
+  AND query IS NOT NULL;
 """
 
-INSERT_SNAPSHOT = """
-INSERT INTO monitoring.pgss_snapshots_raw (
-    snapshot_ts,
-    dbid,
-    userid,
+# Full queryid -> text_md5 map, seeded once by the long-lived stream_pipeline.
+SELECT_KNOWN_TEXTS = """
+SELECT DISTINCT ON (queryid)
     queryid,
-    calls,
-    total_exec_time,
-    rows,
-    shared_blks_hit,
-    shared_blks_read,
-    temp_blks_read,
-    temp_blks_written,
-    wal_bytes,
-    query_text
+    text_md5
+FROM monitoring.query_texts
+ORDER BY queryid, first_seen_ts DESC;
+"""
+
+# Known texts of the polled queryids only; uses the query_texts primary key.
+SELECT_KNOWN_TEXTS_FOR = """
+SELECT DISTINCT ON (queryid)
+    queryid,
+    text_md5
+FROM monitoring.query_texts
+WHERE queryid = ANY(%s)
+ORDER BY queryid, first_seen_ts DESC;
+"""
+
+SNAPSHOT_COLUMNS = [
+    "snapshot_ts",
+    "instance_id",
+    "dbid",
+    "userid",
+    "queryid",
+    "calls",
+    "total_exec_time",
+    "rows",
+    "shared_blks_hit",
+    "shared_blks_read",
+    "temp_blks_read",
+    "temp_blks_written",
+    "wal_bytes",
+    "text_md5",
+]
+
+QUERY_TEXT_COLUMNS = ["queryid", "text_md5", "query_text"]
+
+LAST_CALLS_KEY_COLUMNS = ["instance_id", "dbid", "userid", "queryid"]
+
+SELECT_LAST_CALLS = """
+SELECT dbid, userid, queryid, calls
+FROM monitoring.pgss_last_calls
+WHERE instance_id = %s;
+"""
+
+INSERT_SNAPSHOT_SERVER_SIDE = """
+WITH p AS (
+    SELECT s.*
+    FROM pg_stat_statements(showtext := false) s
+    LEFT JOIN monitoring.pgss_last_calls l
+      ON l.instance_id = %(instance_id)s
+     AND l.dbid = s.dbid AND l.userid = s.userid AND l.queryid = s.queryid
+    WHERE NOT %(sparse)s OR l.calls IS DISTINCT FROM s.calls
+),
+last_calls AS (
+    INSERT INTO monitoring.pgss_last_calls (
+        instance_id, dbid, userid, queryid, calls, snapshot_ts
+    )
+    SELECT DISTINCT ON (dbid, userid, queryid)
+        %(instance_id)s, dbid, userid, queryid, calls, now()
+    FROM p
+    WHERE %(sparse)s
+    ON CONFLICT (instance_id, dbid, userid, queryid)
+    DO UPDATE SET calls = EXCLUDED.calls, snapshot_ts = EXCLUDED.snapshot_ts
+),
+ins AS (
+    INSERT INTO monitoring.pgss_snapshots_raw (
+        snapshot_ts,
+        instance_id,
+        dbid,
+        userid,
+        queryid,
+        calls,
+        total_exec_time,
+        rows,
+        shared_blks_hit,
+        shared_blks_read,
+        temp_blks_read,
+        temp_blks_written,
+        wal_bytes,
+        text_md5
+    )
+    SELECT
+        now(),
+        %(instance_id)s,
+        p.dbid,
+        p.userid,
+        p.queryid,
+        p.calls,
+        p.total_exec_time,
+        p.rows,
+        p.shared_blks_hit,
+        p.shared_blks_read,
+        p.temp_blks_read,
+        p.temp_blks_written,
+        p.wal_bytes,
+        t.text_md5
+    FROM p
+    LEFT JOIN LATERAL (
+        SELECT qt.text_md5
+        FROM monitoring.query_texts qt
+        WHERE qt.queryid = p.queryid
+        ORDER BY qt.first_seen_ts DESC
+        LIMIT 1
+    ) t ON true
+    RETURNING queryid, text_md5
 )
-VALUES (
-    %(snapshot_ts)s,
-    %(dbid)s,
-    %(userid)s,
-    %(queryid)s,
-    %(calls)s,
-    %(total_exec_time)s,
-    %(rows)s,
-    %(shared_blks_hit)s,
-    %(shared_blks_read)s,
-    %(temp_blks_read)s,
-    %(temp_blks_written)s,
-    %(wal_bytes)s,
-    %(query_text)s
-);
+SELECT
+    count(*) AS inserted,
+    array_agg(DISTINCT queryid) FILTER (WHERE text_md5 IS NULL) AS new_queryids
+FROM ins;
 """
 
+# Same transaction as INSERT_SNAPSHOT_SERVER_SIDE, so now() is its snapshot_ts.
+FILL_NEW_TEXTS_SERVER_SIDE = """
+WITH new_texts AS (
+    INSERT INTO monitoring.query_texts (queryid, text_md5, query_text)
+    SELECT DISTINCT ON (p.queryid) p.queryid, md5(p.query), p.query
+    FROM pg_stat_statements(showtext := true) p
+    WHERE p.queryid = ANY(%(queryids)s)
+      AND p.query IS NOT NULL
+    ON CONFLICT (queryid, text_md5) DO NOTHING
+    RETURNING queryid, text_md5
+)
+UPDATE monitoring.pgss_snapshots_raw s
+SET text_md5 = n.text_md5
+FROM new_texts n
+WHERE s.snapshot_ts = now()
+  AND s.instance_id = %(instance_id)s
+  AND s.queryid = n.queryid
+  AND s.text_md5 IS NULL;
+"""
 
-def collect_snapshot():
-    """Collect one snapshot and insert rows into pgss_snapshots_raw."""
-    with psycopg.connect(**DB_CONFIG, row_factory=psycopg.rows.dict_row) as conn:
+
+def text_md5(query_text):
+    """Return md5 of the raw query text, matching PostgreSQL md5()."""
+    if query_text is None:
+        return None
+    return hashlib.md5(query_text.encode("utf-8")).hexdigest()
+
+
+def use_server_side():
+    """Return True when the snapshot can be written by the server itself."""
+    if COLLECT_MODE == "server":
+        return True
+    if COLLECT_MODE == "client":
+        return False
+    return SOURCE_DB_CONFIG == DB_CONFIG
+
+
+def load_last_calls(cur, instance_id):
+    """Load last written calls per key for sparse snapshots."""
+    cur.execute(SELECT_LAST_CALLS, (instance_id,))
+    return {(r[0], r[1], r[2]): r[3] for r in cur.fetchall()}
+
+
+def filter_changed(records, last_calls):
+    """Keep records whose calls changed since the last written snapshot."""
+    return [
+        r
+        for r in records
+        if last_calls.get((r["dbid"], r["userid"], r["queryid"])) != r["calls"]
+    ]
+
+
+def last_calls_rows(records):
+    """Build pgss_last_calls rows from tagged snapshot records."""
+    rows = {}
+    for r in records:
+        key = (r["instance_id"], r["dbid"], r["userid"], r["queryid"])
+        rows[key] = (*key, r["calls"], r["snapshot_ts"])
+    return list(rows.values())
+
+
+def load_known_texts(cur, queryids):
+    """Return queryid -> text_md5 of stored texts for the given queryids.
+
+    collector.py runs as a new process every cycle, so only the queryids
+    of the current poll are looked up, not the whole query_texts table.
+    """
+    queryids = list(set(queryids))
+    if not queryids:
+        return {}
+    cur.execute(SELECT_KNOWN_TEXTS_FOR, (queryids,))
+    return {qid: md5 for qid, md5 in cur.fetchall()}
+
+
+def fetch_new_texts(cur, queryids):
+    """Fetch query texts for the given queryids only."""
+    if not queryids:
+        return {}
+    cur.execute(SELECT_PGSS_TEXTS, (list(queryids),))
+    return {qid: query_text for qid, query_text in cur.fetchall()}
+
+
+def save_last_calls(cur, records):
+    """Upsert last written calls for the keys in records."""
+    copy_rows(
+        cur,
+        "monitoring.pgss_last_calls",
+        LAST_CALLS_KEY_COLUMNS + ["calls", "snapshot_ts"],
+        last_calls_rows(records),
+        on_conflict="update",
+        conflict_cols=LAST_CALLS_KEY_COLUMNS,
+        update_cols=["calls", "snapshot_ts"],
+        stage="collector",
+    )
+
+
+def prepare_snapshot_rows(records, known, new_texts, instance_id, snapshot_ts):
+    """Tag records for insertion and return (new text rows, new md5 map).
+
+    Each record gets snapshot_ts, instance_id and the text_md5 of its
+    queryid, either already known or computed from new_texts.
+    """
+    new_md5 = {qid: text_md5(t) for qid, t in new_texts.items()}
+    texts = [(qid, new_md5[qid], t) for qid, t in new_texts.items()]
+
+    for r in records:
+        r["snapshot_ts"] = snapshot_ts
+        r["instance_id"] = instance_id
+        r["text_md5"] = known.get(r["queryid"]) or new_md5.get(r["queryid"])
+
+    return texts, new_md5
+
+
+def collect_snapshot_server_side():
+    """Capture one snapshot with a single INSERT ... SELECT on the server.
+
+    Counters are read without texts; texts are pulled from
+    pg_stat_statements only for queryids missing from query_texts.
+    """
+    with psycopg.connect(**DB_CONFIG) as conn:
         with conn.cursor() as cur:
             try:
-                cur.execute(SELECT_PGSS)
-                records = cur.fetchall()
+                cur.execute(
+                    INSERT_SNAPSHOT_SERVER_SIDE,
+                    {"instance_id": INSTANCE_ID, "sparse": SNAPSHOT_SPARSE},
+                )
+                inserted, new_queryids = cur.fetchone()
+                if new_queryids:
+                    cur.execute(
+                        FILL_NEW_TEXTS_SERVER_SIDE,
+                        {"queryids": new_queryids, "instance_id": INSTANCE_ID},
+                    )
+                conn.commit()
 
-                if not records:
+                if not inserted:
                     print("No records found in pg_stat_statements.")
                     return
 
-                snapshot_ts = datetime.now(timezone.utc)
+                print(
+                    f"{datetime.now()}: inserted {inserted} rows into monitoring.pgss_snapshots_raw"
+                    f" ({len(new_queryids or [])} new query texts)"
+                )
+
+            except Exception as e:
+                conn.rollback()
+                print(f"Error: {e}")
+
+
+def collect_snapshot_client_side():
+    """Read pg_stat_statements from the source DB and insert rows via Python.
+
+    Used when the monitoring schema lives on a different server. Texts
+    are fetched only for polled queryids not yet in query_texts.
+    """
+    with psycopg.connect(**DB_CONFIG) as conn:
+        with conn.cursor() as cur:
+            last_calls = load_last_calls(cur, INSTANCE_ID) if SNAPSHOT_SPARSE else None
+        conn.commit()
 
-                for r in records:
-                    r["snapshot_ts"] = snapshot_ts
+        try:
+            with psycopg.connect(**SOURCE_DB_CONFIG, row_factory=dict_row) as src:
+                with src.cursor() as cur:
+                    cur.execute(SELECT_PGSS)
+                    records = cur.fetchall()
+                total = len(records)
+                if last_calls is not None:
+                    records = filter_changed(records, last_calls)
 
-                cur.executemany(INSERT_SNAPSHOT, records)
+                with conn.cursor() as cur:
+                    known = load_known_texts(cur, [r["queryid"] for r in records])
                 conn.commit()
+                new_ids = {r["queryid"] for r in records} - known.keys()
+                with src.cursor(row_factory=tuple_row) as cur:
+                    new_texts = fetch_new_texts(cur, new_ids)
+        except Exception as e:
+            print(f"Error: {e}")
+            return
+
+        if not records:
+            if total:
+                print("No pg_stat_statements entries changed since last snapshot.")
+            else:
+                print("No records found in pg_stat_statements.")
+            return
+
+        texts, new_md5 = prepare_snapshot_rows(
+            records, known, new_texts, INSTANCE_ID, datetime.now(timezone.utc)
+        )
+
+        with conn.cursor() as cur:
+            try:
+                copy_rows(
+                    cur,
+                    "monitoring.query_texts",
+                    QUERY_TEXT_COLUMNS,
+                    texts,
+                    on_conflict="nothing",
+                    conflict_cols=["queryid", "text_md5"],
+                    stage="collector",
+                )
+                inserted = copy_rows(
+                    cur,
+                    "monitoring.pgss_snapshots_raw",
+                    SNAPSHOT_COLUMNS,
+                    records,
+                    stage="collector",
+                )
+                if last_calls is not None:
+                    save_last_calls(cur, records)
+                conn.commit()
+                known.update(new_md5)
 
                 print(
-                    f"{datetime.now()}: inserted {len(records)} rows into monitoring.pgss_snapshots_raw"
+                    f"{datetime.now()}: inserted {inserted} rows into monitoring.pgss_snapshots_raw"
+                    f" ({len(texts)} new query texts)"
                 )
 
             except Exception as e:
@@ -89,5 +395,136 @@ def collect_snapshot():
                 print(f"Error: {e}")
 
 
+async def _collect_target(target, known):
+    """Poll one target and write its snapshot into the monitoring DB."""
+    instance_id = target["instance_id"]
+    connect_timeout = max(1, int(COLLECT_TARGET_TIMEOUT))
+
+    last_calls = None
+    if SNAPSHOT_SPARSE:
+        async with await psycopg.AsyncConnection.connect(
+            **DB_CONFIG, connect_timeout=connect_timeout
+        ) as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(SELECT_LAST_CALLS, (instance_id,))
+                last_calls = {(r[0], r[1], r[2]): r[3] for r in await cur.fetchall()}
+
+    async with await psycopg.AsyncConnection.connect(
+        target["conninfo"], row_factory=dict_row, connect_timeout=connect_timeout
+    ) as src:
+        async with src.cursor() as cur:
+            await cur.execute(SELECT_PGSS)
+            records = await cur.fetchall()
+        if last_calls is not None:
+            records = filter_changed(records, last_calls)
+
+        unknown = list({r["queryid"] for r in records} - known.keys())
+        if unknown:
+            async with await psycopg.AsyncConnection.connect(
+                **DB_CONFIG, connect_timeout=connect_timeout
+            ) as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(SELECT_KNOWN_TEXTS_FOR, (unknown,))
+                    known.update(await cur.fetchall())
+
+        new_ids = {r["queryid"] for r in records} - known.keys()
+        new_texts = {}
+        if new_ids:
+            async with src.cursor(row_factory=tuple_row) as cur:
+                await cur.execute(SELECT_PGSS_TEXTS, (list(new_ids),))
+                new_texts = {qid: t for qid, t in await cur.fetchall()}
+
+    if not records:
+        print(f"{instance_id}: no new or changed pg_stat_statements entries.")
+        return 0
+
+    texts, new_md5 = prepare_snapshot_rows(
+        records, known, new_texts, instance_id, datetime.now(timezone.utc)
+    )
+
+    async with await psycopg.AsyncConnection.connect(
+        **DB_CONFIG, connect_timeout=connect_timeout
+    ) as conn:
+        async with conn.cursor() as cur:
+            await acopy_rows(
+                cur,
+                "monitoring.query_texts",
+                QUERY_TEXT_COLUMNS,
+                texts,
+                on_conflict="nothing",
+                conflict_cols=["queryid", "text_md5"],
+                stage=f"collector[{instance_id}]",
+            )
+            inserted = await acopy_rows(
+                cur,
+                "monitoring.pgss_snapshots_raw",
+                SNAPSHOT_COLUMNS,
+                records,
+                stage=f"collector[{instance_id}]",
+            )
+            if last_calls is not None:
+                await acopy_rows(
+                    cur,
+                    "monitoring.pgss_last_calls",
+                    LAST_CALLS_KEY_COLUMNS + ["calls", "snapshot_ts"],
+                    last_calls_rows(records),
+                    on_conflict="update",
+                    conflict_cols=LAST_CALLS_KEY_COLUMNS,
+                    update_cols=["calls", "snapshot_ts"],
+                    stage=f"collector[{instance_id}]",
+                )
+        await conn.commit()
+
+    known.update(new_md5)
+    print(
+        f"{datetime.now()}: {instance_id}: inserted {inserted} rows into "
+        f"monitoring.pgss_snapshots_raw ({len(texts)} new query texts)"
+    )
+    return inserted
+
+
+async def _collect_target_bounded(target, known, sem):
+    """Run _collect_target under the semaphore and per-target timeout."""
+    async with sem:
+        try:
+            return await asyncio.wait_for(
+                _collect_target(target, known), COLLECT_TARGET_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            print(f"{target['instance_id']}: timed out after {COLLECT_TARGET_TIMEOUT}s")
+        except Exception as e:
+            print(f"{target['instance_id']}: Error: {e}")
+        return 0
+
+
+async def collect_targets(targets):
+    """Poll all targets concurrently into the central monitoring DB.
+
+    Concurrency is bounded by COLLECT_CONCURRENCY and each target has its
+    own COLLECT_TARGET_TIMEOUT, so a slow target does not delay others.
+    """
+    # queryid -> text_md5, filled per target with the queryids it polled.
+    known = {}
+    sem = asyncio.Semaphore(max(1, COLLECT_CONCURRENCY))
+    results = await asyncio.gather(
+        *(_collect_target_bounded(t, known, sem) for t in targets)
+    )
+    print(
+        f"{datetime.now()}: collected {sum(results)} rows from "
+        f"{sum(1 for r in results if r)}/{len(targets)} targets"
+    )
+
+
+def collect_snapshot():
+    """Collect one snapshot and insert rows into pgss_snapshots_raw."""
+    targets = load_collect_targets()
+    if targets:
+        asyncio.run(collect_targets(targets))
+    elif use_server_side():
+        collect_snapshot_server_side()
+    else:
+        collect_snapshot_client_side()
+
+
 if __name__ == "__main__":
     collect_snapshot()
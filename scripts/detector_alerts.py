@@ -2,10 +2,29 @@
 
 import os
 import re
-from typing import Any, Dict, Iterable
+from typing import Any, Dict, Iterable, Tuple
 
+import psycopg
 import requests
+from psycopg.rows import dict_row
+
+try:
+    from db_config import (
+        DB_CONFIG,
+        SOURCE_DB_CONFIG,
+        INSTANCE_ID,
+        load_collect_targets,
+    )
+except Exception:
+    from scripts.db_config import (
+        DB_CONFIG,
+        SOURCE_DB_CONFIG,
+        INSTANCE_ID,
+        load_collect_targets,
+    )
 
+# Connect timeout for role lookups on monitored instances.
+ROLE_LOOKUP_TIMEOUT = max(1, int(float(os.getenv("COLLECT_TARGET_TIMEOUT", "10"))))
 
 SYSTEM_SUBSTRINGS = [
     "pg_catalog",
@@ -34,8 +53,31 @@ SYS_SELECT_PREFIXES = (
     "select pg_backend_pid",
 )
 
-_re_select_params_only = re.compile(
-    r"^select\s+(\$\d+\s*(,\s*\$\d+\s*)*)$", re.IGNORECASE
+SYS_PREFIXES = (
+    "savepoint ",
+    "release ",
+    "rollback to savepoint ",
+    "set ",
+    "show ",
+    "reset ",
+) + SYS_SELECT_PREFIXES
+
+
+def _alternation(words):
+    """Return a regex alternation matching any of the literal words."""
+    return "|".join(re.escape(w) for w in sorted(words, key=lambda w: (-len(w), w)))
+
+
+# All rules in one search over the stripped, lowercased text: anchored
+# exact/prefix rules first, then the substrings anywhere.
+_re_system = re.compile(
+    r"^(?:"
+    rf"(?:{_alternation(TX_EXACT)})\Z"
+    rf"|(?:{_alternation(SYS_PREFIXES)})"
+    r"|create schema.*monitoring"
+    r"|select\s+\$\d+\s*(?:,\s*\$\d+\s*)*$"
+    rf")|{_alternation(SYSTEM_SUBSTRINGS)}",
+    re.DOTALL,
 )
 
 
@@ -45,28 +87,7 @@ def is_system_query(text: Any) -> bool:
         return True
 
     t = text.strip().lower().rstrip(";")
-    if not t:
-        return True
-
-    if t in TX_EXACT:
-        return True
-
-    if t.startswith(("savepoint ", "release ", "rollback to savepoint ")):
-        return True
-
-    if t.startswith("create schema") and "monitoring" in t:
-        return True
-
-    if t.startswith(("set ", "show ", "reset ")):
-        return True
-
-    if t.startswith(SYS_SELECT_PREFIXES):
-        return True
-
-    if _re_select_params_only.match(t):
-        return True
-
-    return any(s in t for s in SYSTEM_SUBSTRINGS)
+    return not t or _re_system.search(t) is not None
 
 
 def send_telegram(text: str) -> None:
@@ -103,8 +124,55 @@ def fetch_usernames_batch(conn, userids: Iterable[int]) -> Dict[int, str]:
     return {r["oid"]: r["rolname"] for r in rows}
 
 
+def _instance_connect_kwargs(instance_id):
+    """Return psycopg.connect kwargs for an instance, or None if unknown."""
+    kwargs = {"row_factory": dict_row, "connect_timeout": ROLE_LOOKUP_TIMEOUT}
+    for t in load_collect_targets():
+        if t["instance_id"] == instance_id:
+            return {"conninfo": t["conninfo"], **kwargs}
+    if instance_id == INSTANCE_ID:
+        return {**SOURCE_DB_CONFIG, **kwargs}
+    return None
+
+
+def fetch_usernames_by_instance(
+    conn, keys: Iterable[Tuple[str, int]]
+) -> Dict[Tuple[str, int], str]:
+    """Fetch role names for (instance_id, userid) pairs on their own instance.
+
+    userid oids mean nothing outside their server, so each instance is
+    looked up in its own pg_roles: COLLECT_TARGETS entries on their target,
+    INSTANCE_ID on SOURCE_DB_CONFIG (conn when that is the monitoring DB).
+    Instances that cannot be reached are left out.
+    """
+    by_instance = {}
+    for instance_id, userid in keys:
+        by_instance.setdefault(instance_id, set()).add(userid)
+
+    names = {}
+    for instance_id, userids in by_instance.items():
+        kwargs = _instance_connect_kwargs(instance_id)
+        if kwargs is None:
+            continue
+        try:
+            if "conninfo" not in kwargs and SOURCE_DB_CONFIG == DB_CONFIG:
+                found = fetch_usernames_batch(conn, userids)
+            else:
+                with psycopg.connect(**kwargs) as src:
+                    found = fetch_usernames_batch(src, userids)
+        except Exception as e:
+            print(f"{instance_id}: role lookup failed: {e}")
+            continue
+        names.update(((instance_id, oid), name) for oid, name in found.items())
+    return names
+
+
 def build_alert_message(
-    username: str, score: float, query_text: str, metrics: Dict[str, float]
+    username: str,
+    score: float,
+    query_text: str,
+    metrics: Dict[str, float],
+    instance_id: str | None = None,
 ) -> str:
     """Build a formatted Telegram alert message."""
     sql_safe = (str(query_text)[:200]).replace("<", "&lt;")
@@ -119,8 +187,10 @@ def build_alert_message(
         parts.append(f"🧾 {int(metrics['wal_bytes_per_call'])} wal")
 
     metrics_str = " | ".join(parts)
+    instance_line = f"🖥 <b>Instance:</b> {instance_id}\n" if instance_id else ""
     return (
         f"🚨 <b>ANOMALY DETECTED</b> 🚨\n"
+        f"{instance_line}"
         f"👤 <b>User:</b> {username}\n"
         f"<b>Anomaly score:</b> {score:.3f}\n"
         f"{metrics_str}\n"
@@ -0,0 +1,37 @@
+"""Long-lived detector: keeps the model in memory and scores new windows."""
+
+import os
+import signal
+import time
+from datetime import datetime
+
+from detector_runner import hot_model, run_once
+
+DETECT_INTERVAL = int(os.getenv("DETECT_INTERVAL", os.getenv("COLLECT_INTERVAL", "15")))
+
+STAGE = "detector_daemon"
+
+
+def _raise_exit(signum, frame):
+    """Turn SIGTERM into SystemExit so connections are closed cleanly."""
+    raise SystemExit(0)
+
+
+def serve():
+    """Score new windows every DETECT_INTERVAL seconds with a hot model."""
+    signal.signal(signal.SIGTERM, _raise_exit)
+    model_state = hot_model()
+    print(f"{datetime.now()}: {STAGE}: scoring every {DETECT_INTERVAL}s")
+
+    while True:
+        started = time.monotonic()
+        try:
+            model_state = hot_model(model_state)
+            run_once(model_state)
+        except Exception as e:
+            print(f"{datetime.now()}: {STAGE}: Error: {e}")
+        time.sleep(max(0.0, DETECT_INTERVAL - (time.monotonic() - started)))
+
+
+if __name__ == "__main__":
+    serve()
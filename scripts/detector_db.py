@@ -1,93 +1,191 @@
 """Database helpers for detector state and anomaly storage."""
 
+import numpy as np
 import psycopg
-from psycopg.rows import dict_row
+from psycopg.rows import dict_row, tuple_row
 
 try:
-    from scripts.db_config import DB_CONFIG
+    from scripts.db_config import DB_CONFIG, collect_instance_ids
+    from scripts.bulk_writer import copy_rows
+    from scripts.watermarks import ALL_INSTANCES, load_watermark, save_watermark
+    from scripts.detector_features import ALL_FEATURES, META_COLS
 except Exception:
-    from db_config import DB_CONFIG
-
-
-STATE_SELECT = """
-SELECT last_window_end, bad_runs_streak
-FROM monitoring.detector_state
-WHERE id = 1;
-"""
-
-STATE_UPSERT_INIT = """
-INSERT INTO monitoring.detector_state (id, last_window_end, bad_runs_streak)
-VALUES (1, NULL, 0)
-ON CONFLICT (id) DO NOTHING;
-"""
-
-STATE_UPDATE = """
-UPDATE monitoring.detector_state
-SET last_window_end = %s,
-    bad_runs_streak = %s,
-    updated_at = now()
-WHERE id = 1;
+    from db_config import DB_CONFIG, collect_instance_ids
+    from bulk_writer import copy_rows
+    from watermarks import ALL_INSTANCES, load_watermark, save_watermark
+    from detector_features import ALL_FEATURES, META_COLS
+
+
+DETECTOR_STAGE = "detector"
+
+# Whole windows only: the chunk ends at the window_end of the limit-th
+# window (system queries included), so a window is never split between runs.
+# It also stops at the features/lex watermark of every instance that still
+# has deltas or snapshots past it: windows there are not (fully) featurized
+# or lex'ed yet, and the watermark must not skip them.
+SELECT_CHUNK_END = """
+WITH wm AS (
+    SELECT
+        i.instance_id,
+        COALESCE(f.last_window_end, '-infinity'::timestamptz) AS features_end,
+        COALESCE(l.last_window_end, '-infinity'::timestamptz) AS lex_end
+    FROM unnest(%(instance_ids)s::text[]) AS i (instance_id)
+    LEFT JOIN monitoring.pipeline_watermarks f
+      ON f.stage = 'features' AND f.instance_id = i.instance_id
+    LEFT JOIN monitoring.pipeline_watermarks l
+      ON l.stage = 'lex' AND l.instance_id = i.instance_id
+),
+ready AS (
+    SELECT COALESCE(
+        min(
+            LEAST(
+                CASE WHEN EXISTS (
+                    SELECT 1
+                    FROM monitoring.pgss_deltas d
+                    WHERE d.instance_id = wm.instance_id
+                      AND d.window_end > wm.features_end
+                ) THEN wm.features_end END,
+                CASE WHEN EXISTS (
+                    SELECT 1
+                    FROM monitoring.pgss_snapshots_raw s
+                    WHERE s.instance_id = wm.instance_id
+                      AND s.snapshot_ts > wm.lex_end
+                ) THEN wm.lex_end END
+            )
+        ),
+        'infinity'::timestamptz
+    ) AS ready_end
+    FROM wm
+)
+SELECT COALESCE(
+    (
+        SELECT window_end
+        FROM monitoring.features_windows
+        WHERE window_end > COALESCE(%(after)s::timestamptz, '-infinity'::timestamptz)
+          AND window_end <= (SELECT ready_end FROM ready)
+        ORDER BY window_end ASC
+        OFFSET %(limit)s - 1
+        LIMIT 1
+    ),
+    (
+        SELECT max(window_end)
+        FROM monitoring.features_windows
+        WHERE window_end > COALESCE(%(after)s::timestamptz, '-infinity'::timestamptz)
+          AND window_end <= (SELECT ready_end FROM ready)
+    )
+) AS chunk_end;
 """
 
-FETCH_WINDOWS = """
-SELECT *
+# Only what scoring needs: query texts are fetched later for anomalies, and
+# system queries and keys without lex features never leave the database.
+WINDOW_COLUMNS = META_COLS + ALL_FEATURES
+
+# NumPy dtypes of the fetched columns; NULL features become NaN.
+WINDOW_DTYPES = {
+    "window_start": object,
+    "window_end": object,
+    "instance_id": object,
+    "dbid": np.int64,
+    "userid": np.int64,
+    "queryid": np.int64,
+    **{c: np.float64 for c in ALL_FEATURES},
+}
+
+FETCH_WINDOWS = f"""
+SELECT {", ".join(WINDOW_COLUMNS)}
 FROM monitoring.features_with_lex
-WHERE window_end > COALESCE(%s::timestamptz, '-infinity'::timestamptz)
-ORDER BY window_end ASC
-LIMIT %s;
+WHERE window_end > COALESCE(%(after)s::timestamptz, '-infinity'::timestamptz)
+  AND window_end <= %(until)s
+  AND is_system = false
+  AND query_text IS NOT NULL
+ORDER BY window_end ASC;
 """
 
-INSERT_ANOMALIES = """
-INSERT INTO monitoring.anomaly_scores (
-  window_start, window_end, dbid, userid, queryid,
-  model_version, anomaly_score, features, scored_at
-) VALUES (
-  %s, %s, %s, %s, %s,
-  %s, %s, %s::jsonb, %s
-)
-ON CONFLICT (model_version, window_end, dbid, userid, queryid) DO NOTHING;
+FETCH_QUERY_TEXTS = """
+SELECT
+    m.instance_id,
+    m.dbid,
+    m.userid,
+    m.queryid,
+    COALESCE(t.query_text, m.query_text) AS query_text
+FROM monitoring.query_shape_map m
+JOIN unnest(%s::text[], %s::oid[], %s::oid[], %s::bigint[])
+  AS k (instance_id, dbid, userid, queryid)
+  USING (instance_id, dbid, userid, queryid)
+LEFT JOIN monitoring.query_texts t
+  ON t.queryid = m.queryid AND t.text_md5 = m.text_md5;
 """
 
+ANOMALY_COLUMNS = [
+    "window_start",
+    "window_end",
+    "instance_id",
+    "dbid",
+    "userid",
+    "queryid",
+    "model_version",
+    "anomaly_score",
+    "features",
+    "scored_at",
+]
+
 
 def connect():
     """Create a psycopg connection with dict row mapping."""
     return psycopg.connect(**DB_CONFIG, row_factory=dict_row)
 
 
-def ensure_state_row(conn):
-    """Ensure the singleton detector_state row exists."""
-    with conn.cursor() as cur:
-        cur.execute(STATE_UPSERT_INIT)
-    conn.commit()
-
-
 def load_state(conn):
-    """Load detector state, creating defaults if needed."""
-    ensure_state_row(conn)
+    """Load the detector watermark, creating defaults if needed."""
     with conn.cursor() as cur:
-        cur.execute(STATE_SELECT)
-        row = cur.fetchone()
-        if not row:
-            return {"last_window_end": None, "bad_runs_streak": 0}
-        return {
-            "last_window_end": row["last_window_end"],
-            "bad_runs_streak": row["bad_runs_streak"],
-        }
+        state = load_watermark(cur, DETECTOR_STAGE, ALL_INSTANCES)
+    conn.commit()
+    return state
 
 
 def save_state(conn, last_window_end, bad_runs_streak):
     """Persist last_window_end and bad_runs_streak."""
     with conn.cursor() as cur:
-        cur.execute(STATE_UPDATE, (last_window_end, bad_runs_streak))
+        save_watermark(
+            cur, DETECTOR_STAGE, ALL_INSTANCES, last_window_end, bad_runs_streak
+        )
     conn.commit()
 
 
 def fetch_new_windows(conn, last_window_end, limit: int):
-    """Fetch feature windows newer than last_window_end."""
+    """Fetch whole feature windows newer than last_window_end.
+
+    Returns (columns, chunk_end): WINDOW_COLUMNS of the non-system rows of
+    about limit windows as NumPy arrays, read with binary transfer, and
+    the window_end the chunk covers; (None, None) when nothing new is ready.
+    """
+    params = {"after": last_window_end, "limit": max(1, int(limit))}
     with conn.cursor() as cur:
-        cur.execute(FETCH_WINDOWS, (last_window_end, limit))
+        cur.execute(
+            SELECT_CHUNK_END, {**params, "instance_ids": collect_instance_ids()}
+        )
+        chunk_end = cur.fetchone()["chunk_end"]
+    if chunk_end is None:
+        return None, None
+
+    with conn.cursor(binary=True, row_factory=tuple_row) as cur:
+        cur.execute(FETCH_WINDOWS, {**params, "until": chunk_end})
         rows = cur.fetchall()
-        return rows
+    values = list(zip(*rows)) or [()] * len(WINDOW_COLUMNS)
+    columns = {
+        c: np.array(v, dtype=WINDOW_DTYPES[c]) for c, v in zip(WINDOW_COLUMNS, values)
+    }
+    return columns, chunk_end
+
+
+def fetch_query_texts(conn, keys):
+    """Return {(instance_id, dbid, userid, queryid): query_text} for keys."""
+    keys = set(keys)
+    if not keys:
+        return {}
+    with conn.cursor(row_factory=tuple_row) as cur:
+        cur.execute(FETCH_QUERY_TEXTS, [list(c) for c in zip(*keys)])
+        return {r[:4]: r[4] for r in cur.fetchall()}
 
 
 def insert_anomaly_rows(conn, rows):
@@ -95,5 +193,20 @@ def insert_anomaly_rows(conn, rows):
     if not rows:
         return
     with conn.cursor() as cur:
-        cur.executemany(INSERT_ANOMALIES, rows)
+        copy_rows(
+            cur,
+            "monitoring.anomaly_scores",
+            ANOMALY_COLUMNS,
+            rows,
+            on_conflict="nothing",
+            conflict_cols=[
+                "model_version",
+                "window_end",
+                "instance_id",
+                "dbid",
+                "userid",
+                "queryid",
+            ],
+            stage="detect_anomalies",
+        )
     conn.commit()
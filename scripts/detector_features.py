@@ -3,6 +3,9 @@
 import json
 import math
 
+import numpy as np
+import pandas as pd
+
 LOG_FEATURES = ["shared_read_per_call", "temp_read_per_call", "ms_per_row"]
 OTHER_NUM_FEATURES = [
     "calls_per_sec",
@@ -24,8 +27,18 @@ LEX_FEATURES = [
     "has_ddl",
 ]
 
-ALL_FEATURES = LOG_FEATURES + OTHER_NUM_FEATURES + LEX_FEATURES
-META_COLS = ["window_start", "window_end", "dbid", "userid", "queryid"]
+# z-scores against per-query EWMA baselines (build_features.Z_COLUMNS).
+BASELINE_Z_FEATURES = [
+    "exec_time_per_call_ms_z",
+    "rows_per_call_z",
+    "shared_read_per_call_z",
+    "wal_bytes_per_call_z",
+]
+
+ALL_FEATURES = LOG_FEATURES + OTHER_NUM_FEATURES + LEX_FEATURES + BASELINE_Z_FEATURES
+# Inputs of models pickled without a "features" list.
+LEGACY_FEATURES = LOG_FEATURES + OTHER_NUM_FEATURES + LEX_FEATURES
+META_COLS = ["window_start", "window_end", "instance_id", "dbid", "userid", "queryid"]
 
 MODEL_LOG1P_FEATURES = [
     "exec_time_per_call_ms",
@@ -54,26 +67,84 @@ def _to_number(v):
         return 0.0
 
 
+def _numpy_log1p_is_libm():
+    """True when np.log1p matches math.log1p bit for bit on a probe sample.
+
+    NumPy builds with AVX-512 use their own log1p, which is 1 ulp off
+    libm for some inputs; model inputs must not depend on the CPU.
+    """
+    probe = np.geomspace(1e-12, 1e12, 4096)
+    exact = np.fromiter(map(math.log1p, probe.tolist()), np.float64, len(probe))
+    return np.array_equal(np.log1p(probe), exact)
+
+
+NUMPY_LOG1P_EXACT = _numpy_log1p_is_libm()
+
+
+def _log1p_positive(col):
+    """Apply log1p to col in place where col > 0, setting the rest to 0.0."""
+    positive = col > 0
+    if NUMPY_LOG1P_EXACT:
+        np.log1p(col, out=col, where=positive)
+    else:
+        values = col[positive]
+        col[positive] = np.fromiter(
+            map(math.log1p, values.tolist()), np.float64, len(values)
+        )
+    col[~positive] = 0.0
+
+
+def _number_column(s):
+    """Return a Series as a float64 array with _to_number semantics.
+
+    Object columns go through pd.to_numeric; the few values it rejects but
+    float() accepts (e.g. "1_000", bytes) fall back to _to_number.
+    """
+    if s.dtype == object:
+        parsed = pd.to_numeric(s, errors="coerce")
+        values = parsed.to_numpy(dtype=np.float64, na_value=np.nan)
+        retry = np.flatnonzero(np.isnan(values) & s.notna().to_numpy())
+        if len(retry):
+            raw = s.to_numpy()
+            values[retry] = [_to_number(raw[i]) for i in retry]
+    else:
+        values = s.to_numpy(dtype=np.float64, na_value=np.nan)
+    return np.nan_to_num(values, nan=0.0, posinf=0.0, neginf=0.0)
+
+
 def coerce_features_df(df):
     """Normalize types and NaN values for model inputs.
 
-    Also suitable for JSON feature vectors.
+    Also suitable for JSON feature vectors. Every feature column becomes
+    float64, equal to df[c].map(_to_number) value by value.
     """
     for c in ALL_FEATURES:
         if c not in df.columns:
-            df[c] = 0
-        df[c] = df[c].map(_to_number)
+            df[c] = 0.0
+        else:
+            df[c] = _number_column(df[c])
     return df
 
 
-def prepare_model_features_df(df):
+def model_features_matrix(df, features=ALL_FEATURES, dtype=np.float64):
+    """Return a C-contiguous feature matrix with log1p for selected columns.
+
+    Values <= 0 become 0.0, exactly as math.log1p(v) if v > 0 else 0.0.
+    """
+    # Built column by column, then transposed in one blocked copy.
+    columns = np.empty((len(features), len(df)), dtype=np.float64)
+    for j, c in enumerate(features):
+        columns[j] = df[c].to_numpy(dtype=np.float64, na_value=np.nan)
+        if c in MODEL_LOG1P_FEATURES:
+            _log1p_positive(columns[j])
+    return np.ascontiguousarray(columns.T, dtype=dtype)
+
+
+def prepare_model_features_df(df, features=ALL_FEATURES):
     """Prepare feature matrix with log1p for selected columns."""
-    X = df[ALL_FEATURES].copy()
-    for c in MODEL_LOG1P_FEATURES:
-        if c not in X.columns:
-            continue
-        X[c] = X[c].map(lambda v: math.log1p(v) if v > 0 else 0.0)
-    return X
+    return pd.DataFrame(
+        model_features_matrix(df, features), index=df.index, columns=features
+    )
 
 
 def build_features_json(row) -> dict:
@@ -81,6 +152,17 @@ def build_features_json(row) -> dict:
     return {c: _to_number(row.get(c)) for c in ALL_FEATURES}
 
 
+def features_json_column(df):
+    """Return dumps_json(build_features_json(row)) for every row of df.
+
+    Values are taken column-wise as floats with NaN/inf as 0, which is
+    what build_features_json yields for coerced rows.
+    """
+    values = df.reindex(columns=ALL_FEATURES, fill_value=0).to_numpy(dtype=float)
+    values = np.nan_to_num(values, nan=0.0, posinf=0.0, neginf=0.0)
+    return [dumps_json(dict(zip(ALL_FEATURES, v))) for v in values.tolist()]
+
+
 def dumps_json(obj) -> str:
     """Serialize an object to JSON, preserving Unicode."""
     return json.dumps(obj, ensure_ascii=False)
@@ -2,27 +2,29 @@
 
 import os
 import pickle
+import time
 from datetime import datetime, timezone
 
 import pandas as pd
 
 from detector_features import (
+    LEGACY_FEATURES,
+    META_COLS,
     coerce_features_df,
     prepare_model_features_df,
-    build_features_json,
-    dumps_json,
+    features_json_column,
 )
 from detector_db import (
     connect,
     load_state,
     save_state,
     fetch_new_windows,
+    fetch_query_texts,
     insert_anomaly_rows,
 )
 from detector_alerts import (
-    is_system_query,
     send_telegram,
-    fetch_usernames_batch,
+    fetch_usernames_by_instance,
     build_alert_message,
 )
 from detector_drift import update_streak
@@ -33,6 +35,8 @@ MODEL_VERSION = os.getenv("MODEL_VERSION", "baseline_v1")
 BATCH_LIMIT = int(os.getenv("DETECT_BATCH_LIMIT", "2000"))
 CONSECUTIVE_RUNS_LIMIT = int(os.getenv("DRIFT_CONSECUTIVE_LIMIT", "5"))
 
+QUERY_KEY_COLS = ["instance_id", "dbid", "userid", "queryid"]
+
 ALERT_METRICS = [
     "exec_time_per_call_ms",
     "rows_per_call",
@@ -60,16 +64,6 @@ def _score_threshold_from_env_or_model(model_threshold: float | None) -> float:
         return float(model_threshold or 0.0)
 
 
-def _is_significant(metrics) -> bool:
-    """Check whether metrics exceed significance thresholds."""
-    return (
-        metrics.get("exec_time_per_call_ms", 0.0) >= SIGNIF_EXEC_MS
-        or metrics.get("rows_per_call", 0.0) >= SIGNIF_ROWS
-        or metrics.get("shared_read_per_call", 0.0) >= SIGNIF_SHARED_READ
-        or metrics.get("wal_bytes_per_call", 0.0) >= SIGNIF_WAL_BYTES
-    )
-
-
 def load_model_or_train():
     """Load the model or run emergency training."""
     if os.path.exists(MODEL_FILENAME):
@@ -88,108 +82,211 @@ def load_model_or_train():
         return pickle.load(f)
 
 
-def run_once():
-    """Run one scoring cycle and persist alerts/state."""
+def load_model():
+    """Return (model, score_threshold, features) from the model file."""
     model_obj = load_model_or_train()
     model_threshold = None
+    features = LEGACY_FEATURES
     if isinstance(model_obj, dict) and "pipeline" in model_obj:
         model_threshold = model_obj.get("threshold")
+        features = model_obj.get("features", LEGACY_FEATURES)
         model = model_obj["pipeline"]
     else:
         model = model_obj
-    score_threshold = _score_threshold_from_env_or_model(model_threshold)
+    return model, _score_threshold_from_env_or_model(model_threshold), features
+
+
+def model_stamp():
+    """Return (mtime_ns, size, inode) of MODEL_FILE, or None if it is missing."""
+    try:
+        st = os.stat(MODEL_FILENAME)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def hot_model(current=None):
+    """Return the loaded model, reloading it only when MODEL_FILE changed.
+
+    The result is a dict with model, score_threshold, features, the file
+    stamp it was loaded from and load_sec. A failed reload keeps the model,
+    so a half-written or broken file never replaces a working model.
+    """
+    stamp = model_stamp()
+    if current is not None and (stamp is None or stamp == current["stamp"]):
+        return current
+
+    started = time.perf_counter()
+    try:
+        model, score_threshold, features = load_model()
+    except Exception as e:
+        if current is None:
+            raise
+        print(f"{datetime.now()}: detector: reload of {MODEL_FILENAME} failed: {e}")
+        # Not retried until the file changes again.
+        return {**current, "stamp": stamp}
+    load_sec = time.perf_counter() - started
+    print(f"{datetime.now()}: detector: loaded {MODEL_FILENAME} in {load_sec:.3f}s")
+    return {
+        "model": model,
+        "score_threshold": score_threshold,
+        "features": features,
+        # Taken before loading: a write during the load triggers another one.
+        "stamp": stamp if stamp is not None else model_stamp(),
+        "load_sec": load_sec,
+    }
+
+
+def scorable_windows(df_all):
+    """Return the rows of df_all that are scored.
+
+    System queries (is_system of the lex features) and rows without query
+    text are skipped; fetch_new_windows already does this in SQL.
+    """
+    qt = df_all.get("query_text")
+    is_system = df_all.get("is_system")
+    if qt is None or is_system is None:
+        return df_all.iloc[0:0].copy()
+    return df_all[qt.notna() & is_system.eq(False)].copy()
+
+
+def score_windows(df, model, score_threshold, features):
+    """Score coerced feature windows and return (scored, anomalous)."""
+    if df.empty:
+        return df, df
+
+    X = prepare_model_features_df(df, features)
+    scores = model.decision_function(X)
+
+    df["anomaly_score"] = scores
+
+    df["is_anomaly"] = df["anomaly_score"] <= score_threshold
+    return df, df[df["is_anomaly"]].copy()
+
+
+def attach_query_texts(conn, df_anom):
+    """Add query_text to anomalous rows, fetching only their texts."""
+    keys = list(zip(*(df_anom[c].tolist() for c in QUERY_KEY_COLS)))
+    texts = fetch_query_texts(conn, keys)
+    df_anom["query_text"] = [texts.get(k) for k in keys]
+    return df_anom
+
+
+def anomaly_rows(df_anom, now_ts):
+    """Build anomaly_scores rows in ANOMALY_COLUMNS order, column-wise."""
+    n = len(df_anom)
+    return list(
+        zip(
+            *(df_anom[c].tolist() for c in META_COLS),
+            [MODEL_VERSION] * n,
+            df_anom["anomaly_score"].astype(float).tolist(),
+            features_json_column(df_anom),
+            [now_ts] * n,
+        )
+    )
+
+
+def send_alerts(conn, df_anom, score_threshold):
+    """Send Telegram alerts and return the number of significant ones."""
+    if df_anom.empty:
+        return 0
+
+    scores = df_anom["anomaly_score"].astype(float)
+    qtexts = df_anom["query_text"]
+    keep = scores <= score_threshold
+    if not keep.any():
+        return 0
+
+    alerts = df_anom[keep]
+    metrics = alerts.reindex(columns=ALERT_METRICS, fill_value=0).astype(float)
+    significant = (
+        (metrics["exec_time_per_call_ms"] >= SIGNIF_EXEC_MS)
+        | (metrics["rows_per_call"] >= SIGNIF_ROWS)
+        | (metrics["shared_read_per_call"] >= SIGNIF_SHARED_READ)
+        | (metrics["wal_bytes_per_call"] >= SIGNIF_WAL_BYTES)
+    )
+
+    userids = alerts["userid"].tolist()
+    instance_ids = alerts["instance_id"].tolist()
+    user_map = fetch_usernames_by_instance(conn, zip(instance_ids, userids))
+    for userid, score, qtext, instance_id, m in zip(
+        userids,
+        scores[keep].tolist(),
+        qtexts[keep].tolist(),
+        instance_ids,
+        metrics.to_dict("records"),
+    ):
+        username = user_map.get((instance_id, userid), f"Unknown({userid})")
+        msg = build_alert_message(username, score, qtext, m, instance_id=instance_id)
+        send_telegram(msg)
+
+    return int(significant.sum())
+
+
+def check_drift(bad_runs_streak, significant_alerts_sent):
+    """Update the streak and retrain on drift; return the new streak."""
+    bad_runs_streak, drift = update_streak(
+        bad_runs_streak=bad_runs_streak,
+        real_alerts_sent=significant_alerts_sent,
+        consecutive_limit=CONSECUTIVE_RUNS_LIMIT,
+    )
+
+    if drift:
+        send_telegram(
+            f"🛑 <b>DRIFT DETECTED</b>\n"
+            f"{bad_runs_streak} runs подряд с существенными алертами.\n"
+            "🔄 Retraining..."
+        )
+        from train_model import train as retrain
+
+        retrain()
+        bad_runs_streak = 0
+        send_telegram("✅ Retrained.")
+    return bad_runs_streak
+
+
+def run_once(model_state=None):
+    """Run one scoring cycle and persist alerts/state.
+
+    model_state comes from hot_model(); without it the model is loaded here.
+    Returns the window_end the detector watermark moved to, or None when no
+    new windows were ready.
+    """
+    if model_state is None:
+        model_state = hot_model()
+    model = model_state["model"]
+    score_threshold = model_state["score_threshold"]
+    features = model_state["features"]
 
     with connect() as conn:
         state = load_state(conn)
         last_window_end = state["last_window_end"]
         bad_runs_streak = int(state["bad_runs_streak"] or 0)
 
-        rows = fetch_new_windows(conn, last_window_end, BATCH_LIMIT)
-        if not rows:
-            return
-
-        df_all = pd.DataFrame(rows)
-        df_all = coerce_features_df(df_all)
-        new_last_window_end = df_all["window_end"].max()
+        columns, new_last_window_end = fetch_new_windows(
+            conn, last_window_end, BATCH_LIMIT
+        )
+        if new_last_window_end is None:
+            return None
 
-        qt = df_all.get("query_text")
-        if qt is None:
-            df = df_all.iloc[0:0].copy()
-        else:
-            mask = qt.notna() & ~qt.apply(is_system_query)
-            df = df_all[mask].copy()
+        df_all = coerce_features_df(pd.DataFrame(columns))
 
+        started = time.perf_counter()
+        df, df_anom = score_windows(df_all, model, score_threshold, features)
+        print(
+            f"{datetime.now()}: detector: scored {len(df)} of {len(df_all)} windows "
+            f"in {time.perf_counter() - started:.3f}s, {len(df_anom)} anomalies"
+        )
         if df.empty:
             save_state(conn, new_last_window_end, bad_runs_streak)
-            return
-
-        X = prepare_model_features_df(df)
-        scores = model.decision_function(X)
-
-        df["anomaly_score"] = scores
-
-        df["is_anomaly"] = df["anomaly_score"] <= score_threshold
-        df_anom = df[df["is_anomaly"]].copy()
-        now_ts = datetime.now(timezone.utc)
-
-        insert_rows = []
-        for _, r in df_anom.iterrows():
-            features = build_features_json(r)
-            insert_rows.append(
-                (
-                    r["window_start"],
-                    r["window_end"],
-                    r["dbid"],
-                    r["userid"],
-                    r["queryid"],
-                    MODEL_VERSION,
-                    float(r["anomaly_score"]),
-                    dumps_json(features),
-                    now_ts,
-                )
-            )
-        insert_anomaly_rows(conn, insert_rows)
-
-        real_alerts_sent = 0
-        significant_alerts_sent = 0
-        if not df_anom.empty:
-            user_map = fetch_usernames_batch(conn, set(df_anom["userid"].tolist()))
-
-            for _, r in df_anom.iterrows():
-                score = float(r["anomaly_score"])
-                if score > score_threshold:
-                    continue
-
-                qtext = r.get("query_text")
-                if is_system_query(qtext):
-                    continue
-
-                username = user_map.get(r["userid"], f"Unknown({r['userid']})")
-                metrics = {m: float(r.get(m, 0) or 0) for m in ALERT_METRICS}
-
-                msg = build_alert_message(username, score, qtext, metrics)
-                send_telegram(msg)
-                real_alerts_sent += 1
-
-                if _is_significant(metrics):
-                    significant_alerts_sent += 1
-
-        bad_runs_streak, drift = update_streak(
-            bad_runs_streak=bad_runs_streak,
-            real_alerts_sent=significant_alerts_sent,
-            consecutive_limit=CONSECUTIVE_RUNS_LIMIT,
-        )
+            return new_last_window_end
+
+        insert_anomaly_rows(conn, anomaly_rows(df_anom, datetime.now(timezone.utc)))
 
-        if drift:
-            send_telegram(
-                f"🛑 <b>DRIFT DETECTED</b>\n"
-                f"{bad_runs_streak} runs подряд с существенными алертами.\n"
-                "🔄 Retraining..."
-            )
-            from train_model import train as retrain
+        df_anom = attach_query_texts(conn, df_anom)
 
-            retrain()
-            bad_runs_streak = 0
-            send_telegram("✅ Retrained.")
+        significant_alerts_sent = send_alerts(conn, df_anom, score_threshold)
+        bad_runs_streak = check_drift(bad_runs_streak, significant_alerts_sent)
 
         save_state(conn, new_last_window_end, bad_runs_streak)
+        return new_last_window_end
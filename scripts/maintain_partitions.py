@@ -0,0 +1,241 @@
+"""Pre-create daily partitions and drop expired ones."""
+
+import os
+import re
+from datetime import datetime, timedelta, timezone
+
+import psycopg
+from psycopg import sql
+
+try:
+    from db_config import DB_CONFIG
+except Exception:
+    from scripts.db_config import DB_CONFIG
+
+PARTITION_PREMAKE_DAYS = int(os.getenv("PARTITION_PREMAKE_DAYS", "3"))
+
+# Days to keep per table; 0 keeps partitions forever.
+RETENTION_SNAPSHOTS_DAYS = int(os.getenv("RETENTION_SNAPSHOTS_DAYS", "3"))
+RETENTION_DELTAS_DAYS = int(os.getenv("RETENTION_DELTAS_DAYS", "14"))
+RETENTION_FEATURES_DAYS = int(os.getenv("RETENTION_FEATURES_DAYS", "30"))
+RETENTION_ANOMALIES_DAYS = int(os.getenv("RETENTION_ANOMALIES_DAYS", "180"))
+
+PARTITIONED_TABLES = [
+    "pgss_snapshots_raw",
+    "pgss_deltas",
+    "features_windows",
+    "anomaly_scores",
+]
+
+# Range partition key of each table (DDL_PARTITIONED in boot.py).
+PARTITION_KEYS = {
+    "pgss_snapshots_raw": "snapshot_ts",
+    "pgss_deltas": "window_start",
+    "features_windows": "window_start",
+    "anomaly_scores": "window_end",
+}
+
+IS_PARTITIONED = """
+SELECT 1
+FROM pg_partitioned_table p
+JOIN pg_class c ON c.oid = p.partrelid
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = 'monitoring'
+  AND c.relname = %s;
+"""
+
+LIST_PARTITIONS = """
+SELECT c.relname
+FROM pg_inherits i
+JOIN pg_class c ON c.oid = i.inhrelid
+JOIN pg_class p ON p.oid = i.inhparent
+JOIN pg_namespace n ON n.oid = p.relnamespace
+WHERE n.nspname = 'monitoring'
+  AND p.relname = %s;
+"""
+
+
+def retention_days():
+    """Return effective retention per table.
+
+    Downstream tables keep at least as long as their source, otherwise
+    a stage would recompute rows for a range whose partition is gone.
+    """
+    deltas = RETENTION_DELTAS_DAYS
+    if RETENTION_SNAPSHOTS_DAYS == 0 or 0 < deltas < RETENTION_SNAPSHOTS_DAYS:
+        deltas = RETENTION_SNAPSHOTS_DAYS
+    features = RETENTION_FEATURES_DAYS
+    if deltas == 0 or 0 < features < deltas:
+        features = deltas
+    return {
+        "pgss_snapshots_raw": RETENTION_SNAPSHOTS_DAYS,
+        "pgss_deltas": deltas,
+        "features_windows": features,
+        "anomaly_scores": RETENTION_ANOMALIES_DAYS,
+    }
+
+
+def partition_name(table, day):
+    """Return the partition name of table for a UTC day."""
+    return f"{table}_p{day:%Y%m%d}"
+
+
+def default_partition_name(table):
+    """Return the name of the DEFAULT partition of table."""
+    return f"{table}_default"
+
+
+def partition_day(table, name):
+    """Return the UTC day of a partition name, or None if not ours."""
+    m = re.fullmatch(rf"{re.escape(table)}_p(\d{{8}})", name)
+    if not m:
+        return None
+    return datetime.strptime(m.group(1), "%Y%m%d").replace(tzinfo=timezone.utc)
+
+
+def is_partitioned(cur, table):
+    """Check whether monitoring.table is a partitioned table."""
+    cur.execute(IS_PARTITIONED, (table,))
+    return cur.fetchone() is not None
+
+
+def create_default_partition(cur, table):
+    """Create the DEFAULT partition, which takes rows outside daily ranges.
+
+    Without it an insert for a day whose partition is missing (maintenance
+    behind, out-of-range backfill) fails and stops the pipeline.
+    """
+    cur.execute(
+        sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT").format(
+            sql.Identifier("monitoring", default_partition_name(table)),
+            sql.Identifier("monitoring", table),
+        )
+    )
+
+
+def create_partition(cur, table, day):
+    """Create the partition of one day; return rows moved out of DEFAULT.
+
+    Rows of that day already in the DEFAULT partition would make
+    CREATE ... PARTITION OF fail, so they are moved into a new table
+    which is then attached.
+    """
+    target = sql.Identifier("monitoring", table)
+    part = sql.Identifier("monitoring", partition_name(table, day))
+    default = sql.Identifier("monitoring", default_partition_name(table))
+    key = sql.Identifier(PARTITION_KEYS[table])
+    bounds = sql.SQL("FROM ({}) TO ({})").format(
+        sql.Literal(day), sql.Literal(day + timedelta(days=1))
+    )
+    in_day = sql.SQL("{} >= %s AND {} < %s").format(key, key)
+    params = (day, day + timedelta(days=1))
+
+    cur.execute(
+        sql.SQL("SELECT EXISTS (SELECT 1 FROM {} WHERE {})").format(default, in_day),
+        params,
+    )
+    if not cur.fetchone()[0]:
+        cur.execute(
+            sql.SQL(
+                "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES {}"
+            ).format(part, target, bounds)
+        )
+        return 0
+
+    cur.execute(
+        sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS)").format(part, target)
+    )
+    cur.execute(
+        sql.SQL(
+            "WITH moved AS (DELETE FROM {} WHERE {} RETURNING *) "
+            "INSERT INTO {} SELECT * FROM moved"
+        ).format(default, in_day, part),
+        params,
+    )
+    moved = cur.rowcount
+    cur.execute(
+        sql.SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES {}").format(
+            target, part, bounds
+        )
+    )
+    return moved
+
+
+def create_partitions(cur, table, today, existing):
+    """Create daily partitions from today up to PARTITION_PREMAKE_DAYS ahead.
+
+    Returns (created, rows moved out of the DEFAULT partition).
+    """
+    create_default_partition(cur, table)
+    created = moved = 0
+    for i in range(PARTITION_PREMAKE_DAYS + 1):
+        day = today + timedelta(days=i)
+        if partition_name(table, day) in existing:
+            continue
+        moved += create_partition(cur, table, day)
+        created += 1
+    return created, moved
+
+
+def default_partition_rows(cur, table):
+    """Return the number of rows in the DEFAULT partition of table."""
+    cur.execute(
+        sql.SQL("SELECT count(*) FROM {}").format(
+            sql.Identifier("monitoring", default_partition_name(table))
+        )
+    )
+    return cur.fetchone()[0]
+
+
+def drop_partitions(cur, table, today, existing, keep_days):
+    """Drop daily partitions that ended before the retention cutoff."""
+    if keep_days <= 0:
+        return 0
+    cutoff = today - timedelta(days=keep_days)
+    dropped = 0
+    for name in sorted(existing):
+        day = partition_day(table, name)
+        if day is None or day + timedelta(days=1) > cutoff:
+            continue
+        cur.execute(
+            sql.SQL("DROP TABLE IF EXISTS {}").format(
+                sql.Identifier("monitoring", name)
+            )
+        )
+        dropped += 1
+    return dropped
+
+
+def maintain_partitions():
+    """Create upcoming partitions and drop expired ones for every table."""
+    today = datetime.now(timezone.utc).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    retention = retention_days()
+
+    with psycopg.connect(**DB_CONFIG) as conn:
+        with conn.cursor() as cur:
+            for table in PARTITIONED_TABLES:
+                if not is_partitioned(cur, table):
+                    continue
+                cur.execute(LIST_PARTITIONS, (table,))
+                existing = {r[0] for r in cur.fetchall()}
+                created, moved = create_partitions(cur, table, today, existing)
+                dropped = drop_partitions(cur, table, today, existing, retention[table])
+                print(
+                    f"{datetime.now()}: monitoring.{table}: "
+                    f"created {created}, dropped {dropped} partitions"
+                    + (f", moved {moved} rows out of DEFAULT" if moved else "")
+                )
+                stray = default_partition_rows(cur, table)
+                if stray:
+                    print(
+                        f"{datetime.now()}: WARNING: monitoring."
+                        f"{default_partition_name(table)} holds {stray} rows "
+                        "outside the daily partitions; retention does not drop them"
+                    )
+        conn.commit()
+
+
+if __name__ == "__main__":
+    maintain_partitions()
@@ -0,0 +1,571 @@
+"""Long-running in-memory pipeline: collect, deltas, features and scoring.
+
+Each cycle polls pg_stat_statements, computes deltas against the previous
+poll kept in memory, builds features and lex features and scores them.
+All layers are written to the monitoring DB by a background writer, so
+the DB is never read back between stages; alerts go out once the anomaly
+rows of their cycle are committed.
+"""
+
+import os
+import queue
+import signal
+import threading
+import time
+from datetime import datetime, timezone
+
+import pandas as pd
+import psycopg
+from psycopg.rows import dict_row, tuple_row
+
+try:
+    from db_config import DB_CONFIG, SOURCE_DB_CONFIG, INSTANCE_ID
+    from db_config import load_collect_targets
+    from bulk_writer import copy_rows
+    from watermarks import load_watermark, save_watermark
+    from collector import (
+        LAST_CALLS_KEY_COLUMNS,
+        QUERY_TEXT_COLUMNS,
+        SELECT_KNOWN_TEXTS,
+        SELECT_PGSS,
+        SNAPSHOT_COLUMNS,
+        SNAPSHOT_SPARSE,
+        fetch_new_texts,
+        filter_changed,
+        last_calls_rows,
+        load_last_calls,
+        prepare_snapshot_rows,
+    )
+    from build_deltas import (
+        CARRY_COLUMNS,
+        CARRY_KEY_COLUMNS,
+        CARRY_VALUE_COLUMNS,
+        FEATURES_FUSED,
+        build_deltas_backfill,
+        deltas_for_window,
+        load_carry,
+        load_snapshot,
+        save_deltas,
+    )
+    from build_features import (
+        FEATURE_COLUMNS,
+        FEATURES_STAGE,
+        Z_COLUMNS,
+        apply_baselines,
+        baseline_rows,
+        build_features,
+        compute_features_batch,
+        load_baselines,
+        save_baselines,
+        save_features,
+    )
+    from build_lex_features import (
+        LEX_FEATURE_COLUMNS,
+        LEX_KEY_COLUMNS,
+        LEX_STAGE,
+        build_lex_features,
+        cached_lex_features,
+        lex_cache_summary,
+        remember_lex_features,
+        save_lex_rows,
+        touch_last_seen,
+    )
+    from detector_features import coerce_features_df
+    from detector_db import insert_anomaly_rows, load_state, save_state
+    from detector_runner import (
+        anomaly_rows,
+        check_drift,
+        hot_model,
+        run_once,
+        scorable_windows,
+        score_windows,
+        send_alerts,
+    )
+except Exception:
+    from scripts.db_config import DB_CONFIG, SOURCE_DB_CONFIG, INSTANCE_ID
+    from scripts.db_config import load_collect_targets
+    from scripts.bulk_writer import copy_rows
+    from scripts.watermarks import load_watermark, save_watermark
+    from scripts.collector import (
+        LAST_CALLS_KEY_COLUMNS,
+        QUERY_TEXT_COLUMNS,
+        SELECT_KNOWN_TEXTS,
+        SELECT_PGSS,
+        SNAPSHOT_COLUMNS,
+        SNAPSHOT_SPARSE,
+        fetch_new_texts,
+        filter_changed,
+        last_calls_rows,
+        load_last_calls,
+        prepare_snapshot_rows,
+    )
+    from scripts.build_deltas import (
+        CARRY_COLUMNS,
+        CARRY_KEY_COLUMNS,
+        CARRY_VALUE_COLUMNS,
+        FEATURES_FUSED,
+        build_deltas_backfill,
+        deltas_for_window,
+        load_carry,
+        load_snapshot,
+        save_deltas,
+    )
+    from scripts.build_features import (
+        FEATURE_COLUMNS,
+        FEATURES_STAGE,
+        Z_COLUMNS,
+        apply_baselines,
+        baseline_rows,
+        build_features,
+        compute_features_batch,
+        load_baselines,
+        save_baselines,
+        save_features,
+    )
+    from scripts.build_lex_features import (
+        LEX_FEATURE_COLUMNS,
+        LEX_KEY_COLUMNS,
+        LEX_STAGE,
+        build_lex_features,
+        cached_lex_features,
+        lex_cache_summary,
+        remember_lex_features,
+        save_lex_rows,
+        touch_last_seen,
+    )
+    from scripts.detector_features import coerce_features_df
+    from scripts.detector_db import insert_anomaly_rows, load_state, save_state
+    from scripts.detector_runner import (
+        anomaly_rows,
+        check_drift,
+        hot_model,
+        run_once,
+        scorable_windows,
+        score_windows,
+        send_alerts,
+    )
+
+COLLECT_INTERVAL = int(os.getenv("COLLECT_INTERVAL", "15"))
+COLLECT_TARGET_TIMEOUT = float(os.getenv("COLLECT_TARGET_TIMEOUT", "10"))
+
+# Cycles the writer may lag behind before polling blocks.
+STREAM_WRITE_QUEUE = int(os.getenv("STREAM_WRITE_QUEUE", "8"))
+
+STAGE = "stream_pipeline"
+
+SELECT_LAST_SNAPSHOT_TS = """
+SELECT max(snapshot_ts) AS last_ts
+FROM monitoring.pgss_snapshots_raw
+WHERE instance_id = %s;
+"""
+
+SELECT_LEX_CACHE = """
+SELECT
+    l.*,
+    COALESCE(t.query_text, l.query_text) AS full_text
+FROM monitoring.query_lex_features l
+LEFT JOIN monitoring.query_texts t
+  ON t.queryid = l.queryid AND t.text_md5 = l.text_md5;
+"""
+
+
+def load_sources():
+    """Return one state dict per monitored instance."""
+    targets = load_collect_targets() or [{"instance_id": INSTANCE_ID, "conninfo": None}]
+    return [
+        {
+            "instance_id": t["instance_id"],
+            "conninfo": t["conninfo"],
+            "conn": None,
+            "prev": None,
+            "prev_ts": None,
+            "last_calls": None,
+        }
+        for t in targets
+    ]
+
+
+def source_connection(source):
+    """Return the persistent source connection, reconnecting if needed."""
+    conn = source["conn"]
+    if conn is not None and not conn.closed:
+        return conn
+    kwargs = {
+        "autocommit": True,
+        "row_factory": dict_row,
+        "connect_timeout": max(1, int(COLLECT_TARGET_TIMEOUT)),
+    }
+    if source["conninfo"] is None:
+        conn = psycopg.connect(**SOURCE_DB_CONFIG, **kwargs)
+    else:
+        conn = psycopg.connect(source["conninfo"], **kwargs)
+    source["conn"] = conn
+    return conn
+
+
+def close_source(source):
+    """Drop the source connection after an error."""
+    if source["conn"] is not None:
+        try:
+            source["conn"].close()
+        except Exception:
+            pass
+    source["conn"] = None
+
+
+def lex_entry(feats, text_md5):
+    """Return the in-memory lex cache entry for computed features."""
+    entry = {c: feats[c] for c in LEX_FEATURE_COLUMNS}
+    entry["query_text"] = feats["query_text"]
+    entry["text_md5"] = text_md5
+    return entry
+
+
+def load_lex_cache(cur):
+    """Load lex features keyed by (instance_id, dbid, userid, queryid)."""
+    cur.execute(SELECT_LEX_CACHE)
+    cache = {}
+    for r in cur.fetchall():
+        key = tuple(r[c] for c in LEX_KEY_COLUMNS)
+        cache[key] = lex_entry({**r, "query_text": r["full_text"]}, r["text_md5"])
+        remember_lex_features(r["text_md5"], r)
+    return cache
+
+
+def seed_source(cur, source):
+    """Restore the previous snapshot of a source from the monitoring DB."""
+    instance_id = source["instance_id"]
+    cur.execute(SELECT_LAST_SNAPSHOT_TS, (instance_id,))
+    last_ts = cur.fetchone()["last_ts"]
+    if last_ts is None:
+        return
+
+    prev = load_snapshot(cur, instance_id, last_ts)
+    if SNAPSHOT_SPARSE:
+        state, _ = load_carry(cur, instance_id, last_ts)
+        state.update(prev)
+        prev = state
+    source["prev"] = prev
+    source["prev_ts"] = last_ts
+
+
+def catch_up(model_state):
+    """Run the batch stages once so the DB is current before streaming."""
+    build_deltas_backfill()
+    if not FEATURES_FUSED:
+        build_features()
+    build_lex_features()
+    # One run_once call scores a single DETECT_BATCH_LIMIT chunk, and the
+    # first stream cycle moves the watermark to now: score the whole backlog.
+    while run_once(model_state) is not None:
+        pass
+
+
+def new_batch():
+    """Return an empty set of rows written at the end of a cycle."""
+    return {
+        "texts": [],
+        "snapshots": [],
+        "deltas": [],
+        "features": [],
+        "lex": [],
+        "baselines": [],
+        "anomalies": [],
+        "features_ends": {},
+        "lex_ends": {},
+        "alerts": None,
+        "detector_end": None,
+    }
+
+
+def lex_for_keys(source, keys, records_by_key, new_texts, lex_cache, batch, now_ts):
+    """Return lex entries of keys, computing misses from source texts."""
+    instance_id = source["instance_id"]
+    misses = []
+    for key in keys:
+        md5 = records_by_key[key]["text_md5"]
+        cached = lex_cache.get((instance_id, *key))
+        if md5 is not None and (cached is None or cached["text_md5"] != md5):
+            misses.append(key)
+
+    texts = dict(new_texts)
+    missing = {key[2] for key in misses} - texts.keys()
+    if missing:
+        with source["conn"].cursor(row_factory=tuple_row) as cur:
+            texts.update(fetch_new_texts(cur, missing))
+
+    for key in misses:
+        query_text = texts.get(key[2])
+        if query_text is None:
+            continue
+        md5 = records_by_key[key]["text_md5"]
+        feats = cached_lex_features(query_text, md5)
+        lex_cache[(instance_id, *key)] = lex_entry(feats, md5)
+        batch["lex"].append(
+            {
+                "instance_id": instance_id,
+                "dbid": key[0],
+                "userid": key[1],
+                "queryid": key[2],
+                "last_seen_ts": now_ts,
+                **feats,
+                # The text itself lives in monitoring.query_texts.
+                "query_text": None,
+                "text_md5": md5,
+            }
+        )
+
+    return {key: lex_cache.get((instance_id, *key)) for key in keys}
+
+
+def poll_source(source, known, lex_cache, baselines, batch):
+    """Poll one source and return its feature rows joined with lex features."""
+    instance_id = source["instance_id"]
+    conn = source_connection(source)
+
+    with conn.cursor() as cur:
+        cur.execute(SELECT_PGSS)
+        records = cur.fetchall()
+    snapshot_ts = datetime.now(timezone.utc)
+
+    new_ids = {r["queryid"] for r in records} - known.keys()
+    with conn.cursor(row_factory=tuple_row) as cur:
+        new_texts = fetch_new_texts(cur, new_ids)
+
+    texts, new_md5 = prepare_snapshot_rows(
+        records, known, new_texts, instance_id, snapshot_ts
+    )
+    curr = {(r["dbid"], r["userid"], r["queryid"]): r for r in records}
+
+    written = records
+    if SNAPSHOT_SPARSE:
+        written = filter_changed(records, source["last_calls"])
+
+    # Every key of the snapshot, like the lex stage, so its watermark can
+    # move to snapshot_ts.
+    lex = lex_for_keys(source, curr, curr, new_texts, lex_cache, batch, snapshot_ts)
+    batch["lex_ends"][instance_id] = snapshot_ts
+
+    scored = []
+    if source["prev"] is not None:
+        deltas = deltas_for_window(
+            source["prev"], curr, source["prev_ts"], snapshot_ts, instance_id
+        )
+        features, changed = apply_baselines(compute_features_batch(deltas), baselines)
+        keys = [tuple(f[3:6]) for f in features]
+
+        for key, f in zip(keys, features):
+            row = dict(zip(FEATURE_COLUMNS + Z_COLUMNS, f))
+            if lex[key] is not None:
+                row.update(lex[key])
+            scored.append(row)
+
+        batch["deltas"].extend(deltas)
+        batch["features"].extend(features)
+        batch["baselines"].extend(baseline_rows(baselines, changed))
+        if features:
+            batch["features_ends"][instance_id] = snapshot_ts
+
+    batch["texts"].extend(texts)
+    batch["snapshots"].extend(written)
+    known.update(new_md5)
+
+    if SNAPSHOT_SPARSE:
+        source["last_calls"].update(
+            ((r["dbid"], r["userid"], r["queryid"]), r["calls"]) for r in written
+        )
+    source["prev"] = curr
+    source["prev_ts"] = snapshot_ts
+    return scored
+
+
+def write_batch(conn, batch):
+    """Write all layers of one cycle in a single transaction."""
+    with conn.cursor() as cur:
+        copy_rows(
+            cur,
+            "monitoring.query_texts",
+            QUERY_TEXT_COLUMNS,
+            batch["texts"],
+            on_conflict="nothing",
+            conflict_cols=["queryid", "text_md5"],
+            stage=STAGE,
+        )
+        copy_rows(
+            cur,
+            "monitoring.pgss_snapshots_raw",
+            SNAPSHOT_COLUMNS,
+            batch["snapshots"],
+            stage=STAGE,
+        )
+        if SNAPSHOT_SPARSE and batch["snapshots"]:
+            copy_rows(
+                cur,
+                "monitoring.pgss_last_calls",
+                LAST_CALLS_KEY_COLUMNS + ["calls", "snapshot_ts"],
+                last_calls_rows(batch["snapshots"]),
+                on_conflict="update",
+                conflict_cols=LAST_CALLS_KEY_COLUMNS,
+                update_cols=["calls", "snapshot_ts"],
+                stage=STAGE,
+            )
+            copy_rows(
+                cur,
+                "monitoring.pgss_delta_carry",
+                CARRY_COLUMNS,
+                batch["snapshots"],
+                on_conflict="update",
+                conflict_cols=CARRY_KEY_COLUMNS,
+                update_cols=CARRY_VALUE_COLUMNS,
+                stage=STAGE,
+            )
+        save_deltas(cur, batch["deltas"])
+        save_features(cur, batch["features"])
+        save_baselines(cur, batch["baselines"])
+        save_lex_rows(cur, batch["lex"], stage=STAGE)
+        for instance_id, last_end in batch["features_ends"].items():
+            save_watermark(cur, FEATURES_STAGE, instance_id, last_end)
+        for instance_id, last_end in batch["lex_ends"].items():
+            after = load_watermark(cur, LEX_STAGE, instance_id)["last_window_end"]
+            touch_last_seen(cur, instance_id, after, last_end)
+            save_watermark(cur, LEX_STAGE, instance_id, last_end)
+    # Commits the whole cycle.
+    insert_anomaly_rows(conn, batch["anomalies"])
+    conn.commit()
+
+
+def finish_detector(conn, batch, bad_runs_streak):
+    """Send alerts of a committed cycle, then save the detector watermark.
+
+    Same order as run_once: anomaly rows, alerts, watermark. Returns the
+    new bad_runs_streak.
+    """
+    if batch["alerts"] is not None:
+        df_anom, score_threshold = batch["alerts"]
+        significant = send_alerts(conn, df_anom, score_threshold)
+        bad_runs_streak = check_drift(bad_runs_streak, significant)
+    save_state(conn, batch["detector_end"], bad_runs_streak)
+    return bad_runs_streak
+
+
+def writer_loop(writes, failed, bad_runs_streak):
+    """Drain queued batches into the monitoring DB until a None sentinel.
+
+    After the first failure the remaining batches are dropped unwritten:
+    each builds on the in-memory state of the failed one, so nothing past
+    it may be saved. The stream then restarts from the DB state.
+    """
+    with psycopg.connect(**DB_CONFIG, row_factory=dict_row) as conn:
+        while True:
+            batch = writes.get()
+            if batch is None:
+                return
+            if failed.is_set():
+                continue
+            try:
+                write_batch(conn, batch)
+                bad_runs_streak = finish_detector(conn, batch, bad_runs_streak)
+            except Exception as e:
+                conn.rollback()
+                print(
+                    f"{datetime.now()}: {STAGE}: write failed, "
+                    f"dropping queued batches: {e}"
+                )
+                failed.set()
+
+
+def _raise_exit(signum, frame):
+    """Turn SIGTERM into SystemExit so queued writes are flushed."""
+    raise SystemExit(0)
+
+
+def stream():
+    """Run the in-memory pipeline every COLLECT_INTERVAL seconds."""
+    model_state = hot_model()
+    catch_up(model_state)
+
+    sources = load_sources()
+    mon = psycopg.connect(**DB_CONFIG, row_factory=dict_row, autocommit=True)
+    with mon.cursor() as cur:
+        for source in sources:
+            seed_source(cur, source)
+            if SNAPSHOT_SPARSE:
+                with mon.cursor(row_factory=tuple_row) as tcur:
+                    source["last_calls"] = load_last_calls(tcur, source["instance_id"])
+        with mon.cursor(row_factory=tuple_row) as tcur:
+            tcur.execute(SELECT_KNOWN_TEXTS)
+            known = {qid: md5 for qid, md5 in tcur.fetchall()}
+        lex_cache = load_lex_cache(cur)
+        baselines = load_baselines(
+            cur, instance_ids=[source["instance_id"] for source in sources]
+        )
+    state = load_state(mon)
+
+    writes = queue.Queue(maxsize=max(1, STREAM_WRITE_QUEUE))
+    failed = threading.Event()
+    writer = threading.Thread(
+        target=writer_loop,
+        args=(writes, failed, int(state["bad_runs_streak"] or 0)),
+        daemon=True,
+    )
+    writer.start()
+    signal.signal(signal.SIGTERM, _raise_exit)
+
+    print(
+        f"{datetime.now()}: {STAGE}: streaming {len(sources)} instance(s) "
+        f"every {COLLECT_INTERVAL}s"
+    )
+    try:
+        while not failed.is_set():
+            started = time.monotonic()
+
+            model_state = hot_model(model_state)
+
+            batch = new_batch()
+            scored = []
+            for source in sources:
+                try:
+                    scored.extend(
+                        poll_source(source, known, lex_cache, baselines, batch)
+                    )
+                except Exception as e:
+                    print(f"{source['instance_id']}: Error: {e}")
+                    close_source(source)
+
+            if scored:
+                df_all = coerce_features_df(pd.DataFrame(scored))
+                state["last_window_end"] = df_all["window_end"].max()
+                df, df_anom = score_windows(
+                    scorable_windows(df_all),
+                    model_state["model"],
+                    model_state["score_threshold"],
+                    model_state["features"],
+                )
+                if not df.empty:
+                    batch["anomalies"] = anomaly_rows(
+                        df_anom, datetime.now(timezone.utc)
+                    )
+                    # Sent by the writer once the anomaly rows are committed.
+                    batch["alerts"] = (df_anom, model_state["score_threshold"])
+            batch["detector_end"] = state["last_window_end"]
+            writes.put(batch)
+
+            elapsed = time.monotonic() - started
+            print(
+                f"{datetime.now()}: {STAGE}: {len(batch['snapshots'])} snapshot rows, "
+                f"{len(batch['features'])} windows, {len(batch['anomalies'])} "
+                f"anomalies in {elapsed:.3f}s, {lex_cache_summary()}"
+            )
+            time.sleep(max(0.0, COLLECT_INTERVAL - elapsed))
+    finally:
+        writes.put(None)
+        writer.join()
+        mon.close()
+        for source in sources:
+            close_source(source)
+
+    raise SystemExit(f"{STAGE}: write failed, restarting from the DB state.")
+
+
+if __name__ == "__main__":
+    stream()
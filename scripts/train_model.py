@@ -19,20 +19,17 @@ try:
 except Exception:
     from db_config import DB_CONFIG
 
-try:
-    from detector_alerts import is_system_query
-except Exception:
-    from scripts.detector_alerts import is_system_query
-
 try:
     from detector_features import (
         ALL_FEATURES,
+        BASELINE_Z_FEATURES,
         coerce_features_df,
         prepare_model_features_df,
     )
 except Exception:
     from scripts.detector_features import (
         ALL_FEATURES,
+        BASELINE_Z_FEATURES,
         coerce_features_df,
         prepare_model_features_df,
     )
@@ -48,35 +45,51 @@ MODEL_MAX_SAMPLES_PER_QUERYID = int(os.getenv("MODEL_MAX_SAMPLES_PER_QUERYID", "
 
 MODEL_ALERT_QUANTILE = float(os.getenv("MODEL_ALERT_QUANTILE", "0.002"))
 
+# raw: 15 s windows from features_with_lex; 1m/15m/1h: rollup buckets.
+TRAIN_RESOLUTION = (os.getenv("TRAIN_RESOLUTION", "raw") or "raw").strip().lower()
+ROLLUP_RESOLUTIONS = ("1m", "15m", "1h")
+
+
+def model_features():
+    """Return model inputs for TRAIN_RESOLUTION.
+
+    Rollups have no baseline z-scores, which are defined per raw window.
+    """
+    if TRAIN_RESOLUTION == "raw":
+        return list(ALL_FEATURES)
+    return [c for c in ALL_FEATURES if c not in BASELINE_Z_FEATURES]
+
 
 def load_data():
-    """Load training data and filter out system queries."""
+    """Load training data; system queries are filtered out in SQL."""
     conn_str = (
         f"postgresql+psycopg://{DB_CONFIG['user']}:{DB_CONFIG['password']}"
         f"@{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['dbname']}"
     )
 
-    query = """
-    SELECT f.*
-    FROM monitoring.features_with_lex f
-    WHERE f.query_text IS NOT NULL;
-    """
+    if TRAIN_RESOLUTION == "raw":
+        query = """
+        SELECT f.*
+        FROM monitoring.features_with_lex f
+        WHERE f.is_system = false
+          AND f.query_text IS NOT NULL;
+        """
+    elif TRAIN_RESOLUTION in ROLLUP_RESOLUTIONS:
+        query = f"""
+        SELECT f.*
+        FROM monitoring.features_rollup_with_lex f
+        WHERE f.resolution = '{TRAIN_RESOLUTION}'
+          AND f.is_system = false
+          AND f.query_text IS NOT NULL;
+        """
+    else:
+        raise ValueError(f"Unknown TRAIN_RESOLUTION: {TRAIN_RESOLUTION!r}")
 
     try:
-        df = pd.read_sql(query, conn_str)
+        return pd.read_sql(query, conn_str)
     except Exception:
         return pd.DataFrame()
 
-    if df.empty:
-        return df
-
-    qt = df.get("query_text")
-    if qt is None:
-        return pd.DataFrame()
-
-    mask = qt.notna() & ~qt.apply(is_system_query)
-    return df[mask].copy()
-
 
 def train():
     """Train the model pipeline and write it to disk."""
@@ -86,22 +99,25 @@ def train():
             "No training data: monitoring.features_with_lex is empty after filtering."
         )
 
+    features = model_features()
     df = coerce_features_df(df)
-    df = df.dropna(subset=ALL_FEATURES)
+    df = df.dropna(subset=features)
 
     df = df.sample(frac=1.0, random_state=42)
-    df = df.groupby(["dbid", "userid", "queryid"], group_keys=False).head(
-        MODEL_MAX_SAMPLES_PER_QUERYID
-    )
+    df = df.groupby(
+        ["instance_id", "dbid", "userid", "queryid"], group_keys=False
+    ).head(MODEL_MAX_SAMPLES_PER_QUERYID)
 
-    n_queryids = int(df[["dbid", "userid", "queryid"]].drop_duplicates().shape[0])
+    n_queryids = int(
+        df[["instance_id", "dbid", "userid", "queryid"]].drop_duplicates().shape[0]
+    )
     if len(df) < MODEL_MIN_ROWS or n_queryids < MODEL_MIN_QUERYIDS:
         raise RuntimeError(
             f"Not enough training data: rows={len(df)} (min {MODEL_MIN_ROWS}), "
             f"unique_queryids={n_queryids} (min {MODEL_MIN_QUERYIDS})."
         )
 
-    X = prepare_model_features_df(df)
+    X = prepare_model_features_df(df, features)
 
     pipeline = Pipeline(
         steps=[
@@ -124,11 +140,15 @@ def train():
     train_scores = pipeline.decision_function(X)
     auto_threshold = float(np.quantile(train_scores, MODEL_ALERT_QUANTILE))
 
-    with open(MODEL_FILENAME, "wb") as f:
+    # Written aside and renamed, so a running detector never reads a partial file.
+    tmp_filename = f"{MODEL_FILENAME}.tmp"
+    with open(tmp_filename, "wb") as f:
         pickle.dump(
             {
                 "pipeline": pipeline,
                 "threshold": auto_threshold,
+                "features": features,
+                "resolution": TRAIN_RESOLUTION,
                 "trained_at": datetime.now(timezone.utc).isoformat(),
                 "n_rows": int(len(df)),
                 "n_queryids": n_queryids,
@@ -136,6 +156,7 @@ def train():
             },
             f,
         )
+    os.replace(tmp_filename, MODEL_FILENAME)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,58 @@
+"""Per-stage progress stored in monitoring.pipeline_watermarks."""
+
+# Stages that process all instances together use this instance_id.
+ALL_INSTANCES = "*"
+
+SELECT_WATERMARK = """
+SELECT last_window_end, bad_runs_streak
+FROM monitoring.pipeline_watermarks
+WHERE stage = %s
+  AND instance_id = %s;
+"""
+
+INIT_WATERMARK = """
+INSERT INTO monitoring.pipeline_watermarks (stage, instance_id, last_window_end)
+VALUES (%s, %s, %s)
+ON CONFLICT (stage, instance_id) DO NOTHING;
+"""
+
+UPSERT_WATERMARK = """
+INSERT INTO monitoring.pipeline_watermarks (
+    stage, instance_id, last_window_end, bad_runs_streak, updated_at
+)
+VALUES (%s, %s, %s, %s, now())
+ON CONFLICT (stage, instance_id) DO UPDATE
+SET last_window_end = EXCLUDED.last_window_end,
+    bad_runs_streak = EXCLUDED.bad_runs_streak,
+    updated_at = EXCLUDED.updated_at;
+"""
+
+
+def load_watermark(cur, stage, instance_id, seed_query=None):
+    """Return {"last_window_end", "bad_runs_streak"} for a stage.
+
+    When no row exists yet, it is created with last_window_end taken from
+    seed_query (a query returning one timestamp for %s = instance_id), so
+    an existing deployment does not reprocess its whole history.
+    """
+    cur.execute(SELECT_WATERMARK, (stage, instance_id))
+    row = cur.fetchone()
+    if row is None:
+        last_end = None
+        if seed_query is not None:
+            cur.execute(seed_query, (instance_id,))
+            seed = cur.fetchone()
+            last_end = next(iter(seed.values())) if seed else None
+        cur.execute(INIT_WATERMARK, (stage, instance_id, last_end))
+        return {"last_window_end": last_end, "bad_runs_streak": 0}
+    return {
+        "last_window_end": row["last_window_end"],
+        "bad_runs_streak": row["bad_runs_streak"],
+    }
+
+
+def save_watermark(cur, stage, instance_id, last_window_end, bad_runs_streak=0):
+    """Persist the last processed window_end of a stage."""
+    cur.execute(
+        UPSERT_WATERMARK, (stage, instance_id, last_window_end, bad_runs_streak)
+    )
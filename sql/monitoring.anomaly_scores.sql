@@ -1,6 +1,7 @@
 CREATE TABLE IF NOT EXISTS monitoring.anomaly_scores (
     window_start   timestamptz NOT NULL,
     window_end     timestamptz NOT NULL,
+    instance_id    text        NOT NULL DEFAULT 'local',
     dbid           oid         NOT NULL,
     userid         oid         NOT NULL,
     queryid        bigint      NOT NULL,
@@ -11,5 +12,5 @@ CREATE TABLE IF NOT EXISTS monitoring.anomaly_scores (
     features       jsonb       NOT NULL,
     scored_at      timestamptz NOT NULL DEFAULT now(),
 
-    PRIMARY KEY (model_version, window_end, dbid, userid, queryid)
+    PRIMARY KEY (model_version, window_end, instance_id, dbid, userid, queryid)
 );
\ No newline at end of file
@@ -1,6 +1,7 @@
 CREATE TABLE IF NOT EXISTS monitoring.features_windows (
     window_start           timestamptz NOT NULL,
     window_end             timestamptz NOT NULL,
+    instance_id            text        NOT NULL DEFAULT 'local',
     dbid                   oid         NOT NULL,
     userid                 oid         NOT NULL,
     queryid                bigint      NOT NULL,
@@ -31,8 +32,16 @@ CREATE TABLE IF NOT EXISTS monitoring.features_windows (
     ms_per_row             double precision,
     read_blks_per_row      double precision,
 
-    PRIMARY KEY (window_start, dbid, userid, queryid)
+    exec_time_per_call_ms_z double precision,
+    rows_per_call_z         double precision,
+    shared_read_per_call_z  double precision,
+    wal_bytes_per_call_z    double precision,
+
+    PRIMARY KEY (window_start, instance_id, dbid, userid, queryid)
 );
 
 CREATE INDEX IF NOT EXISTS idx_features_qid_ts
-    ON monitoring.features_windows (dbid, userid, queryid, window_start);
\ No newline at end of file
+    ON monitoring.features_windows (dbid, userid, queryid, window_start);
+
+CREATE INDEX IF NOT EXISTS idx_features_windows_end
+    ON monitoring.features_windows (window_end);
\ No newline at end of file
@@ -0,0 +1,113 @@
+CREATE SCHEMA IF NOT EXISTS monitoring;
+
+CREATE TABLE IF NOT EXISTS monitoring.pgss_snapshots_raw (
+    snapshot_id       bigserial,
+    snapshot_ts       timestamptz NOT NULL,
+    instance_id       text        NOT NULL DEFAULT 'local',
+    dbid              oid         NOT NULL,
+    userid            oid         NOT NULL,
+    queryid           bigint      NOT NULL,
+    calls             bigint      NOT NULL,
+    total_exec_time   double precision NOT NULL,
+    rows              bigint      NOT NULL,
+    shared_blks_hit   bigint      NOT NULL,
+    shared_blks_read  bigint      NOT NULL,
+    temp_blks_read    bigint      NOT NULL,
+    temp_blks_written bigint      NOT NULL,
+    wal_bytes         bigint      NOT NULL,
+    query_text        text        NULL,
+    text_md5          text        NULL,
+
+    PRIMARY KEY (snapshot_id, snapshot_ts)
+) PARTITION BY RANGE (snapshot_ts);
+
+CREATE INDEX IF NOT EXISTS idx_pgss_snapshots_raw_ts_brin
+    ON monitoring.pgss_snapshots_raw USING brin (snapshot_ts);
+
+CREATE TABLE IF NOT EXISTS monitoring.pgss_deltas (
+    window_start              timestamptz NOT NULL,
+    window_end                timestamptz NOT NULL,
+    instance_id               text        NOT NULL DEFAULT 'local',
+    dbid                      oid         NOT NULL,
+    userid                    oid         NOT NULL,
+    queryid                   bigint      NOT NULL,
+
+    calls_delta               bigint      NOT NULL,
+    total_exec_time_delta     double precision NOT NULL,
+    rows_delta                bigint      NOT NULL,
+    shared_blks_hit_delta     bigint      NOT NULL,
+    shared_blks_read_delta    bigint      NOT NULL,
+    temp_blks_read_delta      bigint      NOT NULL,
+    temp_blks_written_delta   bigint      NOT NULL,
+    wal_bytes_delta           bigint      NOT NULL,
+
+    PRIMARY KEY (window_start, instance_id, dbid, userid, queryid)
+) PARTITION BY RANGE (window_start);
+
+CREATE INDEX IF NOT EXISTS idx_pgss_deltas_ts_brin
+    ON monitoring.pgss_deltas USING brin (window_start);
+
+CREATE TABLE IF NOT EXISTS monitoring.features_windows (
+    window_start           timestamptz NOT NULL,
+    window_end             timestamptz NOT NULL,
+    instance_id            text        NOT NULL DEFAULT 'local',
+    dbid                   oid         NOT NULL,
+    userid                 oid         NOT NULL,
+    queryid                bigint      NOT NULL,
+
+    window_len_sec         double precision NOT NULL,
+
+    calls_in_window        bigint      NOT NULL,
+    calls_per_sec          double precision,
+
+    exec_time_per_call_ms  double precision,
+    exec_ms_per_sec        double precision,
+
+    rows_per_call          double precision,
+    rows_per_sec           double precision,
+
+    shared_read_per_call   double precision,
+    shared_read_per_sec    double precision,
+
+    temp_read_per_call     double precision,
+    temp_read_per_sec      double precision,
+
+    wal_bytes_per_call     double precision,
+    wal_bytes_per_sec      double precision,
+
+    temp_share             double precision,
+    cache_miss_ratio       double precision,
+
+    ms_per_row             double precision,
+    read_blks_per_row      double precision,
+
+    exec_time_per_call_ms_z double precision,
+    rows_per_call_z         double precision,
+    shared_read_per_call_z  double precision,
+    wal_bytes_per_call_z    double precision,
+
+    PRIMARY KEY (window_start, instance_id, dbid, userid, queryid)
+) PARTITION BY RANGE (window_start);
+
+CREATE INDEX IF NOT EXISTS idx_features_windows_ts_brin
+    ON monitoring.features_windows USING brin (window_start);
+
+CREATE TABLE IF NOT EXISTS monitoring.anomaly_scores (
+    window_start   timestamptz NOT NULL,
+    window_end     timestamptz NOT NULL,
+    instance_id    text        NOT NULL DEFAULT 'local',
+    dbid           oid         NOT NULL,
+    userid         oid         NOT NULL,
+    queryid        bigint      NOT NULL,
+
+    model_version  text        NOT NULL,
+    anomaly_score  double precision NOT NULL,
+
+    features       jsonb       NOT NULL,
+    scored_at      timestamptz NOT NULL DEFAULT now(),
+
+    PRIMARY KEY (model_version, window_end, instance_id, dbid, userid, queryid)
+) PARTITION BY RANGE (window_end);
+
+CREATE INDEX IF NOT EXISTS idx_anomaly_scores_ts_brin
+    ON monitoring.anomaly_scores USING brin (window_end);
\ No newline at end of file
@@ -0,0 +1,17 @@
+CREATE TABLE IF NOT EXISTS monitoring.pgss_delta_carry (
+    instance_id       text        NOT NULL,
+    dbid              oid         NOT NULL,
+    userid            oid         NOT NULL,
+    queryid           bigint      NOT NULL,
+    calls             bigint      NOT NULL,
+    total_exec_time   double precision NOT NULL,
+    rows              bigint      NOT NULL,
+    shared_blks_hit   bigint      NOT NULL,
+    shared_blks_read  bigint      NOT NULL,
+    temp_blks_read    bigint      NOT NULL,
+    temp_blks_written bigint      NOT NULL,
+    wal_bytes         bigint      NOT NULL,
+    snapshot_ts       timestamptz NOT NULL,
+
+    PRIMARY KEY (instance_id, dbid, userid, queryid)
+);
\ No newline at end of file
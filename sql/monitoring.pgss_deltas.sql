@@ -1,6 +1,7 @@
 CREATE TABLE IF NOT EXISTS monitoring.pgss_deltas (
     window_start              timestamptz NOT NULL,
     window_end                timestamptz NOT NULL,
+    instance_id               text        NOT NULL DEFAULT 'local',
     dbid                      oid         NOT NULL,
     userid                    oid         NOT NULL,
     queryid                   bigint      NOT NULL,
@@ -14,8 +15,11 @@ CREATE TABLE IF NOT EXISTS monitoring.pgss_deltas (
     temp_blks_written_delta   bigint      NOT NULL,
     wal_bytes_delta           bigint      NOT NULL,
 
-    PRIMARY KEY (window_start, dbid, userid, queryid)
+    PRIMARY KEY (window_start, instance_id, dbid, userid, queryid)
 );
 
 CREATE INDEX IF NOT EXISTS idx_pgss_deltas_qid_ts
-    ON monitoring.pgss_deltas (dbid, userid, queryid, window_start);
\ No newline at end of file
+    ON monitoring.pgss_deltas (dbid, userid, queryid, window_start);
+
+CREATE INDEX IF NOT EXISTS idx_pgss_deltas_instance_end
+    ON monitoring.pgss_deltas (instance_id, window_end);
\ No newline at end of file
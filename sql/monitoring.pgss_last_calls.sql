@@ -0,0 +1,10 @@
+CREATE TABLE IF NOT EXISTS monitoring.pgss_last_calls (
+    instance_id text        NOT NULL,
+    dbid        oid         NOT NULL,
+    userid      oid         NOT NULL,
+    queryid     bigint      NOT NULL,
+    calls       bigint      NOT NULL,
+    snapshot_ts timestamptz NOT NULL,
+
+    PRIMARY KEY (instance_id, dbid, userid, queryid)
+);
\ No newline at end of file
@@ -0,0 +1,28 @@
+CREATE TABLE IF NOT EXISTS monitoring.pgss_rollup_1m (
+    window_start              timestamptz NOT NULL,
+    window_end                timestamptz NOT NULL,
+    instance_id               text        NOT NULL,
+    dbid                      oid         NOT NULL,
+    userid                    oid         NOT NULL,
+    queryid                   bigint      NOT NULL,
+
+    windows                   bigint      NOT NULL,
+    window_len_sec            double precision NOT NULL,
+
+    calls_delta               bigint      NOT NULL,
+    total_exec_time_delta     double precision NOT NULL,
+    rows_delta                bigint      NOT NULL,
+    shared_blks_hit_delta     bigint      NOT NULL,
+    shared_blks_read_delta    bigint      NOT NULL,
+    temp_blks_read_delta      bigint      NOT NULL,
+    temp_blks_written_delta   bigint      NOT NULL,
+    wal_bytes_delta           bigint      NOT NULL,
+
+    PRIMARY KEY (window_start, instance_id, dbid, userid, queryid)
+);
+
+CREATE TABLE IF NOT EXISTS monitoring.pgss_rollup_15m
+    (LIKE monitoring.pgss_rollup_1m INCLUDING ALL);
+
+CREATE TABLE IF NOT EXISTS monitoring.pgss_rollup_1h
+    (LIKE monitoring.pgss_rollup_1m INCLUDING ALL);
\ No newline at end of file
@@ -1,6 +1,7 @@
 CREATE TABLE IF NOT EXISTS monitoring.pgss_snapshots_raw (
     snapshot_id       bigserial PRIMARY KEY,
     snapshot_ts       timestamptz NOT NULL,
+    instance_id       text        NOT NULL DEFAULT 'local',
     dbid              oid         NOT NULL,
     userid            oid         NOT NULL,
     queryid           bigint      NOT NULL,
@@ -12,8 +13,12 @@ CREATE TABLE IF NOT EXISTS monitoring.pgss_snapshots_raw (
     temp_blks_read    bigint      NOT NULL,
     temp_blks_written bigint      NOT NULL,
     wal_bytes         bigint      NOT NULL,
-    query_text        text        NULL
+    query_text        text        NULL,
+    text_md5          text        NULL
 );
 
 CREATE INDEX IF NOT EXISTS idx_pgss_snapshots_raw_ts_qid
-    ON monitoring.pgss_snapshots_raw (snapshot_ts, dbid, userid, queryid);
\ No newline at end of file
+    ON monitoring.pgss_snapshots_raw (snapshot_ts, dbid, userid, queryid);
+
+CREATE INDEX IF NOT EXISTS idx_pgss_snapshots_raw_instance_ts
+    ON monitoring.pgss_snapshots_raw (instance_id, snapshot_ts);
\ No newline at end of file
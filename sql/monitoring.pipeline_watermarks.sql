@@ -0,0 +1,9 @@
+CREATE TABLE IF NOT EXISTS monitoring.pipeline_watermarks (
+    stage           text        NOT NULL,
+    instance_id     text        NOT NULL,
+    last_window_end timestamptz NULL,
+    bad_runs_streak int         NOT NULL DEFAULT 0,
+    updated_at      timestamptz NOT NULL DEFAULT now(),
+
+    PRIMARY KEY (stage, instance_id)
+);
\ No newline at end of file
@@ -0,0 +1,20 @@
+CREATE TABLE IF NOT EXISTS monitoring.query_baselines (
+    instance_id     text        NOT NULL,
+    dbid            oid         NOT NULL,
+    userid          oid         NOT NULL,
+    queryid         bigint      NOT NULL,
+
+    windows         bigint      NOT NULL,
+    last_window_end timestamptz NOT NULL,
+
+    exec_time_per_call_ms_mean double precision NOT NULL,
+    exec_time_per_call_ms_var  double precision NOT NULL,
+    rows_per_call_mean         double precision NOT NULL,
+    rows_per_call_var          double precision NOT NULL,
+    shared_read_per_call_mean  double precision NOT NULL,
+    shared_read_per_call_var   double precision NOT NULL,
+    wal_bytes_per_call_mean    double precision NOT NULL,
+    wal_bytes_per_call_var     double precision NOT NULL,
+
+    PRIMARY KEY (instance_id, dbid, userid, queryid)
+);
\ No newline at end of file
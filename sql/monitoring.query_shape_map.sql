@@ -0,0 +1,27 @@
+CREATE TABLE IF NOT EXISTS monitoring.query_shape_map (
+    instance_id text NOT NULL DEFAULT 'local',
+    dbid oid NOT NULL,
+    userid oid NOT NULL,
+    queryid bigint NOT NULL,
+
+    query_md5 text NOT NULL,
+    query_text text NULL,
+    text_md5 text NULL,
+    query_len_chars int NOT NULL,
+    is_system boolean NULL,
+
+    first_seen_ts timestamptz NOT NULL DEFAULT now(),
+    last_seen_ts  timestamptz NOT NULL DEFAULT now(),
+
+    PRIMARY KEY (instance_id, dbid, userid, queryid)
+);
+
+CREATE INDEX IF NOT EXISTS idx_query_shape_map_last_seen
+    ON monitoring.query_shape_map (last_seen_ts DESC);
+
+CREATE INDEX IF NOT EXISTS idx_query_shape_map_text_md5
+    ON monitoring.query_shape_map (text_md5);
+
+CREATE INDEX IF NOT EXISTS idx_query_shape_map_unclassified
+    ON monitoring.query_shape_map (queryid)
+    WHERE is_system IS NULL;
\ No newline at end of file
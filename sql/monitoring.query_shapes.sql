@@ -0,0 +1,24 @@
+CREATE TABLE IF NOT EXISTS monitoring.query_shapes (
+    query_md5 text PRIMARY KEY,
+
+    query_len_norm_chars int NOT NULL,
+    num_tokens int NOT NULL,
+
+    num_joins int NOT NULL,
+    num_where int NOT NULL,
+    num_group_by int NOT NULL,
+    num_order_by int NOT NULL,
+    num_having int NOT NULL,
+    num_union int NOT NULL,
+    num_subqueries int NOT NULL,
+    num_cte int NOT NULL,
+
+    has_write boolean NOT NULL,
+    has_ddl boolean NOT NULL,
+    has_tx boolean NOT NULL,
+
+    num_case int NOT NULL,
+    num_functions int NOT NULL,
+
+    first_seen_ts timestamptz NOT NULL DEFAULT now()
+);
\ No newline at end of file
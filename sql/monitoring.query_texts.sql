@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS monitoring.query_texts (
+    queryid       bigint      NOT NULL,
+    text_md5      text        NOT NULL,
+    query_text    text        NOT NULL,
+    first_seen_ts timestamptz NOT NULL DEFAULT now(),
+
+    PRIMARY KEY (queryid, text_md5)
+);
\ No newline at end of file
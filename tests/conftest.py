@@ -0,0 +1,47 @@
+"""Shared pytest fixtures; scripts/ is importable the way it runs in boot.py."""
+
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS_DIR = os.path.join(ROOT_DIR, "scripts")
+SQL_DIR = os.path.join(ROOT_DIR, "sql")
+
+sys.path.insert(0, SCRIPTS_DIR)
+
+# Tables of sql/ created (and rolled back) for database tests.
+DB_TEST_TABLES = [
+    "monitoring.pgss_snapshots_raw",
+    "monitoring.pgss_deltas",
+    "monitoring.pgss_delta_carry",
+]
+
+
+@pytest.fixture
+def db_conn():
+    """Connection to DB_CONFIG inside a transaction that is always rolled back.
+
+    Skips the test when PostgreSQL is not reachable.
+    """
+    import psycopg
+    from psycopg.rows import dict_row
+
+    from db_config import DB_CONFIG
+
+    try:
+        conn = psycopg.connect(**DB_CONFIG, row_factory=dict_row, connect_timeout=3)
+    except psycopg.Error as e:
+        pytest.skip(f"PostgreSQL is not available: {e}")
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("CREATE SCHEMA IF NOT EXISTS monitoring")
+            for table in DB_TEST_TABLES:
+                with open(os.path.join(SQL_DIR, f"{table}.sql")) as f:
+                    cur.execute(f.read())
+        yield conn
+    finally:
+        conn.rollback()
+        conn.close()
@@ -0,0 +1,147 @@
+"""Parity of the SQL and NumPy delta engines with deltas_for_window."""
+
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import build_deltas
+from build_deltas import COUNTER_COLUMNS, DELTA_COLUMNS, deltas_for_window
+
+ENGINES = {
+    "sql": build_deltas.build_instance_deltas_sql,
+    "numpy": build_deltas.build_instance_deltas_numpy,
+}
+
+BASE_TS = datetime(2024, 1, 1, tzinfo=timezone.utc)
+SNAPSHOTS = 12
+KEYS = 40
+
+INSERT_SNAPSHOT_ROW = """
+INSERT INTO monitoring.pgss_snapshots_raw (
+    snapshot_ts, instance_id, dbid, userid, queryid,
+    calls, total_exec_time, rows,
+    shared_blks_hit, shared_blks_read,
+    temp_blks_read, temp_blks_written, wal_bytes
+)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+SELECT_DELTAS = """
+SELECT *
+FROM monitoring.pgss_deltas
+WHERE instance_id = %s
+ORDER BY window_start, dbid, userid, queryid
+"""
+
+
+def make_snapshots(seed, sparse):
+    """Return ([(snapshot_ts, {key: counters})], events) of a random workload.
+
+    Keys appear over time, sit idle (calls_delta = 0), get evicted from
+    pg_stat_statements, reset their counters or move one counter backwards
+    while calls still grows. Sparse snapshots hold only changed keys.
+    """
+    rng = random.Random(seed)
+    keys = [
+        (rng.choice([1, 2]), rng.choice([10, 11]), rng.randint(-(2**63), 2**63 - 1))
+        for _ in range(KEYS)
+    ]
+    first_seen = {key: rng.randrange(SNAPSHOTS - 1) for key in keys}
+    counters = {}
+    written = {}
+    events = set()
+    snapshots = []
+
+    for i in range(SNAPSHOTS):
+        snapshot = {}
+        for key in keys:
+            if i < first_seen[key]:
+                continue
+            c = counters.get(key)
+            r = rng.random()
+            grow = r >= 0.28
+            if c is None:
+                c = {col: 0 for col in COUNTER_COLUMNS}
+                c["total_exec_time"] = 0.0
+                grow = True
+                events.add("new")
+            elif r < 0.1:
+                events.add("idle")
+            elif r < 0.15:
+                c = {col: rng.randint(0, 3) for col in COUNTER_COLUMNS}
+                c["total_exec_time"] = rng.random()
+                events.add("reset")
+            elif r < 0.22:
+                col = rng.choice(COUNTER_COLUMNS[1:])
+                c = dict(c, calls=c["calls"] + rng.randint(1, 5))
+                c[col] = c[col] - rng.randint(1, 3)
+                events.add("negative")
+            elif r < 0.28:
+                events.add("evicted")
+                continue
+            if grow:
+                c = dict(c)
+                c["calls"] += rng.randint(0, 50)
+                c["total_exec_time"] += rng.random() * 100
+                for col in COUNTER_COLUMNS[2:]:
+                    c[col] += rng.choice([0, rng.randint(1, 10_000)])
+            counters[key] = c
+            if sparse and written.get(key) == c:
+                continue
+            written[key] = c
+            snapshot[key] = c
+        snapshots.append((BASE_TS + timedelta(minutes=i), snapshot))
+    return snapshots, events
+
+
+def insert_snapshots(cur, instance_id, snapshots):
+    """Write snapshots into monitoring.pgss_snapshots_raw."""
+    cur.executemany(
+        INSERT_SNAPSHOT_ROW,
+        [
+            (ts, instance_id, *key, *(c[col] for col in COUNTER_COLUMNS))
+            for ts, snapshot in snapshots
+            for key, c in snapshot.items()
+        ],
+    )
+
+
+def expected_deltas(instance_id, snapshots, sparse):
+    """Deltas of every window computed by deltas_for_window in memory."""
+    expected = []
+    state = dict(snapshots[0][1])
+    for (start, prev), (end, curr) in zip(snapshots, snapshots[1:]):
+        expected += deltas_for_window(
+            state if sparse else prev, curr, start, end, instance_id
+        )
+        state.update(curr)
+    return sorted(
+        expected,
+        key=lambda d: (d["window_start"], d["dbid"], d["userid"], d["queryid"]),
+    )
+
+
+@pytest.mark.parametrize("seed", [1, 2])
+@pytest.mark.parametrize("sparse", [False, True], ids=["dense", "sparse"])
+@pytest.mark.parametrize("engine", sorted(ENGINES))
+def test_engine_matches_deltas_for_window(db_conn, monkeypatch, engine, sparse, seed):
+    monkeypatch.setattr(build_deltas, "SNAPSHOT_SPARSE", sparse)
+    instance_id = f"pytest_{engine}"
+    snapshots, events = make_snapshots(seed, sparse)
+    assert {"new", "idle", "reset", "negative", "evicted"} <= events
+
+    with db_conn.cursor() as cur:
+        # Two runs: the second starts from the watermark and the carry.
+        half = SNAPSHOTS // 2
+        insert_snapshots(cur, instance_id, snapshots[: half + 1])
+        ENGINES[engine](cur, instance_id)
+        insert_snapshots(cur, instance_id, snapshots[half + 1 :])
+        ENGINES[engine](cur, instance_id)
+
+        cur.execute(SELECT_DELTAS, (instance_id,))
+        actual = [{c: r[c] for c in DELTA_COLUMNS} for r in cur.fetchall()]
+
+    expected = expected_deltas(instance_id, snapshots, sparse)
+    assert expected
+    assert actual == expected
@@ -0,0 +1,135 @@
+"""compute_features_batch must match compute_features row by row."""
+
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from build_features import FEATURE_COLUMNS, compute_features, compute_features_batch
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def delta(queryid, window_sec=15.0, start=START, **counters):
+    """Return one pgss_deltas row; counters not given are zero."""
+    row = {
+        "window_start": start,
+        "window_end": start + timedelta(seconds=window_sec),
+        "instance_id": "local",
+        "dbid": 5,
+        "userid": 10,
+        "queryid": queryid,
+        "calls_delta": 1,
+        "total_exec_time_delta": 0.0,
+        "rows_delta": 0,
+        "shared_blks_hit_delta": 0,
+        "shared_blks_read_delta": 0,
+        "temp_blks_read_delta": 0,
+        "temp_blks_written_delta": 0,
+        "wal_bytes_delta": 0,
+    }
+    row.update(counters)
+    return row
+
+
+EDGE_CASES = {
+    "zero_window": delta(1, window_sec=0, calls_delta=3, total_exec_time_delta=9.5),
+    "negative_window": delta(2, window_sec=-30, calls_delta=7, rows_delta=2),
+    "fractional_window": delta(3, window_sec=0.25, calls_delta=2, rows_delta=5),
+    "null_temp_share": delta(4, calls_delta=2, shared_blks_hit_delta=8),
+    "null_cache_miss": delta(5, calls_delta=2, temp_blks_read_delta=4),
+    "null_both": delta(6, calls_delta=1, total_exec_time_delta=0.1),
+    "zero_calls": delta(7, calls_delta=0, rows_delta=5),
+    "negative_calls": delta(8, calls_delta=-1, rows_delta=5),
+    "all_temp": delta(9, calls_delta=3, temp_blks_read_delta=6),
+    "all_miss": delta(10, calls_delta=3, shared_blks_read_delta=6),
+    "big": delta(
+        11,
+        calls_delta=2**40,
+        total_exec_time_delta=1e12,
+        rows_delta=2**50,
+        shared_blks_hit_delta=2**45,
+        shared_blks_read_delta=2**45 + 1,
+        temp_blks_read_delta=3,
+        wal_bytes_delta=2**53 + 1,
+    ),
+}
+
+
+def expected_rows(deltas):
+    """Rows of compute_features in FEATURE_COLUMNS order, None rows dropped."""
+    rows = []
+    for r in deltas:
+        f = compute_features(r)
+        if f is not None:
+            rows.append(tuple(f[c] for c in FEATURE_COLUMNS))
+    return rows
+
+
+def random_deltas(n, seed):
+    """Random deltas over several windows, with zeros in every counter."""
+    rng = random.Random(seed)
+    windows = [
+        (START + timedelta(seconds=15 * i), rng.choice([0, -5, 15, 60]))
+        for i in range(8)
+    ]
+    deltas = []
+    for i in range(n):
+        start, sec = rng.choice(windows)
+        deltas.append(
+            delta(
+                i,
+                window_sec=sec,
+                start=start,
+                calls_delta=rng.choice([-1, 0, 1, rng.randint(1, 10**6)]),
+                total_exec_time_delta=rng.choice([0.0, rng.random() * 1e4]),
+                **{
+                    c: rng.choice([0, rng.randint(1, 10**9)])
+                    for c in (
+                        "rows_delta",
+                        "shared_blks_hit_delta",
+                        "shared_blks_read_delta",
+                        "temp_blks_read_delta",
+                        "temp_blks_written_delta",
+                        "wal_bytes_delta",
+                    )
+                },
+            )
+        )
+    return deltas
+
+
+@pytest.mark.parametrize("case", sorted(EDGE_CASES))
+def test_edge_case(case):
+    deltas = [EDGE_CASES[case]]
+    assert compute_features_batch(deltas) == expected_rows(deltas)
+
+
+def test_edge_case_values():
+    features = {case: compute_features(r) for case, r in EDGE_CASES.items()}
+    assert features["zero_window"]["window_len_sec"] == 1.0
+    assert features["negative_window"]["window_len_sec"] == 1.0
+    assert features["null_temp_share"]["temp_share"] is None
+    assert features["null_cache_miss"]["cache_miss_ratio"] is None
+    assert features["zero_calls"] is None
+    assert features["negative_calls"] is None
+
+
+def test_all_edge_cases_in_one_batch():
+    deltas = list(EDGE_CASES.values())
+    assert compute_features_batch(deltas) == expected_rows(deltas)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_deltas(seed):
+    deltas = random_deltas(2000, seed)
+    batch = compute_features_batch(deltas)
+    expected = expected_rows(deltas)
+    assert len(batch) == len(expected)
+    for got, want in zip(batch, expected):
+        assert got == want
+        assert [type(v) for v in got] == [type(v) for v in want]
+
+
+def test_empty():
+    assert compute_features_batch([]) == []
@@ -0,0 +1,189 @@
+"""compute_lex_features must match the multi-pass reference on a corpus."""
+
+import re
+
+import numpy as np
+import pytest
+
+from bench_lex import make_orm_query
+from build_lex_features import (
+    DDL_KEYWORDS,
+    NOT_FUNCTIONS,
+    TX_KEYWORDS,
+    WRITE_KEYWORDS,
+    compute_lex_features,
+    md5_text,
+    normalize_sql,
+)
+from detector_alerts import is_system_query
+
+FUZZ_QUERIES = 5_000
+
+# Hand-picked texts around token boundaries, comments and literals.
+EDGE_CASES = [
+    "",
+    "   ",
+    "SELECT 1",
+    "select count(*) from t",
+    "WITH x AS (SELECT 1) SELECT * FROM x",
+    "with(select 1) select 1",
+    "SELECT * FROM a JOIN b ON a.id=b.id LEFT JOIN c USING (id)",
+    "select * from t group  by a order\nby b",
+    "select * from t group.by a, order(by) b, groupby c, group_by d",
+    "select * from t where x in ( select y from z) and w in (\tselect 1)",
+    'select lower (x), upper(y), COALESCE(a,b), "quoted"(z), 1abc(q)',
+    "select count( * ), max(x1), _f(1), f_2 (2), fooé(3), éfoo(4)",
+    "select join1, t_join, join_t, join from where1 where x",
+    "select 'it''s' || $$dollar -- not comment$$ || 'a -- b' from t",
+    "select 1 -- trailing comment\n, /* block\n comment */ 2",
+    "select '/* not a comment */', '--', x from t /* unclosed",
+    "select x<=1, y>=2, z<>3, w!=4, v<<=5, u!!=6, a=>b from t",
+    "select 1.5, 10.25e3, x1.2, .5, 5., 0x1f from t",
+    "SELECT ÄÖÜ, naïve, 数据 FROM таблица WHERE поле = 1",
+    "select ½, ², ٣, x٣ from t",
+    "INSERT INTO t(a) VALUES (1) ON CONFLICT (a) DO UPDATE SET a = 2",
+    "MERGE INTO t USING s ON t.id = s.id WHEN MATCHED THEN DELETE",
+    "create table t(a int); alter table t add b int; drop table t",
+    "TRUNCATE t; BEGIN; COMMIT; ROLLBACK",
+    "select case when a then 1 else case b when 1 then 2 end end from t",
+    "select * from a union all select * from b union select * from c",
+    "select sum(x) from t group by y having (count(*) > 1)",
+]
+
+FRAGMENTS = [
+    "SELECT",
+    "select",
+    "FROM",
+    "WHERE",
+    "JOIN",
+    "LEFT JOIN",
+    "GROUP",
+    "BY",
+    "ORDER",
+    "HAVING",
+    "UNION",
+    "CASE",
+    "WHEN",
+    "END",
+    "WITH",
+    "INSERT",
+    "UPDATE",
+    "DELETE",
+    "CREATE",
+    "BEGIN",
+    "commit",
+    "(",
+    ")",
+    "( select",
+    "count(*)",
+    "lower (",
+    "t1.col_2",
+    '"t"."c"',
+    "x_1",
+    "42",
+    "3.14",
+    "'lit''eral'",
+    "$$body$$",
+    "/* c */",
+    "-- c\n",
+    "<=",
+    ">=",
+    "<>",
+    "!=",
+    "=",
+    ",",
+    ";",
+    "?",
+    "$1",
+    ".",
+    "::",
+    "é",
+    "\t",
+    "\n",
+    "",
+]
+
+_re_token = re.compile(r"[a-z_]+|\d+|<=|>=|<>|!=|[()*,;=]")
+
+
+def count_kw(norm, kw):
+    """Count keyword occurrences as standalone tokens."""
+    return len(re.findall(rf"\b{re.escape(kw)}\b", norm))
+
+
+def has_any(norm, kws):
+    """Return True if any keyword is present."""
+    return any(re.search(rf"\b{re.escape(k)}\b", norm) for k in kws)
+
+
+def count_subqueries(norm):
+    """Count subqueries matching the '( select' pattern."""
+    return len(re.findall(r"\(\s*select\b", norm))
+
+
+def count_functions(norm):
+    """Count function calls, excluding SQL keywords followed by "("."""
+    candidates = re.findall(r"\b([a-z_][a-z0-9_]*)\s*\(", norm)
+    return sum(1 for w in candidates if w not in NOT_FUNCTIONS)
+
+
+def compute_lex_features_multipass(query_text):
+    """Reference implementation: one regex scan per feature."""
+    norm = normalize_sql(query_text)
+    return {
+        "query_len_chars": len(query_text),
+        "is_system": is_system_query(query_text),
+        "query_len_norm_chars": len(norm),
+        "num_tokens": len(_re_token.findall(norm)),
+        "num_joins": count_kw(norm, "join"),
+        "num_where": count_kw(norm, "where"),
+        "num_group_by": len(re.findall(r"\bgroup\s+by\b", norm)),
+        "num_order_by": len(re.findall(r"\border\s+by\b", norm)),
+        "num_having": count_kw(norm, "having"),
+        "num_union": count_kw(norm, "union"),
+        "num_subqueries": count_subqueries(norm),
+        "num_cte": 1 if norm.startswith("with ") else 0,
+        "has_write": has_any(norm, WRITE_KEYWORDS),
+        "has_ddl": has_any(norm, DDL_KEYWORDS),
+        "has_tx": has_any(norm, TX_KEYWORDS),
+        "num_case": count_kw(norm, "case"),
+        "num_functions": count_functions(norm),
+        "query_md5": md5_text(norm),
+        "query_text": query_text,
+    }
+
+
+def make_fuzz_queries(n, seed=0):
+    """Return n random concatenations of SQL fragments."""
+    rng = np.random.default_rng(seed)
+    seps = ["", " ", "  ", "\n"]
+    queries = []
+    for _ in range(n):
+        k = int(rng.integers(1, 40))
+        frags = rng.integers(0, len(FRAGMENTS), k).tolist()
+        gaps = rng.integers(0, len(seps), k).tolist()
+        queries.append("".join(FRAGMENTS[f] + seps[g] for f, g in zip(frags, gaps)))
+    return queries
+
+
+def assert_parity(q):
+    expected = compute_lex_features_multipass(q)
+    got = compute_lex_features(q)
+    diff = {k: (expected[k], got[k]) for k in expected if expected[k] != got[k]}
+    assert not diff, f"lex features differ for {q[:80]!r}: {diff}"
+    assert got.keys() == expected.keys()
+
+
+@pytest.mark.parametrize("q", EDGE_CASES)
+def test_edge_case(q):
+    assert_parity(q)
+
+
+def test_fuzz_queries():
+    for q in make_fuzz_queries(FUZZ_QUERIES):
+        assert_parity(q)
+
+
+@pytest.mark.parametrize("size", [1_000, 50_000])
+def test_orm_query(size):
+    assert_parity(make_orm_query(size))
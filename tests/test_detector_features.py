@@ -0,0 +1,142 @@
+"""Vectorized feature coercion and log1p must match the per-element code."""
+
+import math
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import detector_features
+from bench_detector_features import coerce_reference, prepare_reference
+from detector_features import (
+    ALL_FEATURES,
+    coerce_features_df,
+    model_features_matrix,
+    prepare_model_features_df,
+)
+
+PROPERTY_ROUNDS = 200
+
+# Values seen in feature columns: driver floats and Decimals, NULLs,
+# booleans and the odd string from a hand-written view.
+SPECIAL = [
+    None,
+    np.nan,
+    np.inf,
+    -np.inf,
+    0.0,
+    -0.0,
+    1e-300,
+    -1e-300,
+    5e-324,
+    1e308,
+    -1.0,
+    True,
+    False,
+    0,
+    7,
+    -3,
+    2**63 + 1,
+    10**25,
+    Decimal("1.5"),
+    Decimal("NaN"),
+    Decimal("-0"),
+    Decimal("123456789.123456789"),
+    "2.5",
+    " 4 ",
+    "1_000",
+    "inf",
+    "nan",
+    "abc",
+    "",
+    b"3",
+]
+
+
+def random_column(rng, n):
+    """Return a column of one of the dtypes the loaders produce."""
+    kind = int(rng.integers(0, 6))
+    if kind == 0:
+        values = rng.standard_normal(n) * 10.0 ** rng.integers(-5, 12, n)
+        values[rng.random(n) < 0.1] = np.nan
+        values[rng.random(n) < 0.02] = np.inf
+        values[rng.random(n) < 0.02] = -0.0
+        return pd.Series(values)
+    if kind == 1:
+        return pd.Series(rng.integers(-5, 10**9, n))
+    if kind == 2:
+        return pd.Series(rng.random(n) < 0.3)
+    if kind == 3:
+        values = rng.random(n) * 100
+        return pd.Series(values, dtype="Float64").mask(rng.random(n) < 0.2)
+    picks = rng.integers(0, len(SPECIAL), n).tolist()
+    values = [SPECIAL[p] for p in picks]
+    if kind == 4:
+        values = [
+            Decimal(repr(float(v))) if isinstance(v, float) and math.isfinite(v) else v
+            for v in values
+        ]
+    return pd.Series(values, dtype=object)
+
+
+def make_frame(n, seed=0, drop=0):
+    """Return n rows of random feature columns; drop leaves some missing."""
+    rng = np.random.default_rng(seed)
+    cols = ALL_FEATURES[drop:] if drop else ALL_FEATURES
+    return pd.DataFrame({c: random_column(rng, n) for c in cols})
+
+
+def same_bits(a, b):
+    """True when two float arrays are identical bit for bit."""
+    a = np.ascontiguousarray(a, dtype=np.float64)
+    b = np.ascontiguousarray(b, dtype=np.float64)
+    return a.shape == b.shape and np.array_equal(a.view(np.int64), b.view(np.int64))
+
+
+def assert_parity(df):
+    expected = coerce_reference(df.copy())
+    got = coerce_features_df(df.copy())
+    for c in ALL_FEATURES:
+        assert got[c].dtype == np.float64, c
+        assert same_bits(expected[c].to_numpy(dtype=float), got[c].to_numpy()), c
+    X_expected = prepare_reference(expected).to_numpy(dtype=float)
+    assert same_bits(X_expected, prepare_model_features_df(got).to_numpy())
+    assert model_features_matrix(got).flags["C_CONTIGUOUS"]
+
+
+# NumPy's own log1p where it matches libm on this CPU, and the math.log1p
+# fallback used where it does not (AVX-512 builds).
+@pytest.fixture(
+    params=sorted({detector_features.NUMPY_LOG1P_EXACT, False}),
+    ids=lambda exact: "numpy" if exact else "libm",
+)
+def log1p_mode(request, monkeypatch):
+    monkeypatch.setattr(detector_features, "NUMPY_LOG1P_EXACT", request.param)
+    return request.param
+
+
+@pytest.mark.parametrize("seed", range(PROPERTY_ROUNDS))
+def test_random_frame(log1p_mode, seed):
+    assert_parity(make_frame(int(seed % 7) * 50, seed=seed, drop=seed % 3))
+
+
+def test_special_values(log1p_mode):
+    df = pd.DataFrame(
+        {
+            c: pd.Series(SPECIAL[i:] + SPECIAL[:i], dtype=object)
+            for i, c in enumerate(ALL_FEATURES)
+        }
+    )
+    assert_parity(df)
+
+
+def test_log1p_fallback_is_libm(monkeypatch):
+    monkeypatch.setattr(detector_features, "NUMPY_LOG1P_EXACT", False)
+    values = np.concatenate(
+        [np.geomspace(1e-12, 1e12, 10_000), [0.0, -0.0, -1.0, 5e-324, np.nan]]
+    )
+    col = values.copy()
+    detector_features._log1p_positive(col)
+    expected = [math.log1p(v) if v > 0 else 0.0 for v in values.tolist()]
+    assert same_bits(col, expected)